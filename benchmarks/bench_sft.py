@@ -0,0 +1,403 @@
+"""Throughput and latency benchmarks of SFT over loopback.
+
+Each case transfers a generated file from an SFTListener to an
+SFTClientResponser (or the other way) and is run in its own process, so that
+its CPU time and peak RSS are not mixed with the other cases. The results are
+written as JSON, they can be compared with an earlier run to catch
+regressions:
+
+    python benchmarks/bench_sft.py --output bench.json
+    python benchmarks/bench_sft.py --output new.json --baseline bench.json
+
+Both ends run in the same process, the CPU time and the peak RSS are the
+ones of the whole transfer.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import statistics
+import threading
+import multiprocessing
+
+from hks_pylib.cryptography.ciphers.symmetrics import AES_CTR, NoCipher
+
+from sft.listener import SFTListener
+from sft.client import SFTClientResponser
+from sft.parallel import reserve_local_nodes
+from sft.protocol.definition import SFTProtocols, SFTRoles, SFTSenderStates
+
+
+KEY = b"0123456789abcedffedcba9876543210"
+
+KB = 2 ** 10
+MB = 2 ** 20
+GB = 2 ** 30
+
+DEFAULT_SIZES = [KB, MB, 64 * MB]
+FULL_SIZES = [KB, MB, 64 * MB, GB, 4 * GB]
+DEFAULT_BUFFER_SIZES = [64 * KB, MB, 4 * MB]
+DEFAULT_CIPHERS = ["none", "aes_ctr"]
+
+# The side which activates the transfer, the client sends or receives.
+INITIATORS = ["sender", "receiver"]
+
+DEFAULT_PORT = 19000
+DEFAULT_TIMEOUT = 600  # seconds
+
+SEED = 2021
+BLOCK_SIZE = MB
+
+
+def parse_size(text: str) -> int:
+    """Parse a size such as 512, 64K, 16M or 2G."""
+    units = {"K": KB, "M": MB, "G": GB}
+
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+
+    return int(text)
+
+
+def format_size(size: int) -> str:
+    for unit, value in (("G", GB), ("M", MB), ("K", KB)):
+        if size >= value and size % value == 0:
+            return "{}{}".format(size // value, unit)
+
+    return str(size)
+
+
+def create_cipher(name: str):
+    if name == "none":
+        return NoCipher()
+
+    if name == "aes_ctr":
+        return AES_CTR(KEY)
+
+    raise Exception("Invalid cipher {}".format(repr(name)))
+
+
+def generate_file(directory: str, size: int) -> str:
+    """Return the path of a file of size pseudo-random bytes, the same bytes
+    for every run."""
+    path = os.path.join(directory, "input.{}".format(format_size(size)))
+    if os.path.isfile(path) and os.path.getsize(path) == size:
+        return path
+
+    with open(path, "wb") as stream:
+        index = 0
+        remain = size
+        while remain > 0:
+            nbytes = min(remain, BLOCK_SIZE)
+            generator = random.Random(SEED + index)
+            stream.write(generator.getrandbits(8 * nbytes).to_bytes(nbytes, "little"))
+
+            remain -= nbytes
+            index += 1
+
+    return path
+
+
+def track_first_data(responser, marks: dict):
+    """Record when the receiving responser gets the first data packet."""
+    get_response = responser.get_response
+
+    def wrapper(source, packet):
+        if "first_data" not in marks and packet.state() == SFTSenderStates.SEND:
+            marks["first_data"] = time.perf_counter()
+
+        return get_response(source, packet)
+
+    responser.get_response = wrapper
+
+
+def track_end(responser, role: SFTRoles, marks: dict):
+    """Record when the session of the role gets its result, wait_result only
+    notices it up to Session.TIME_PERIODIC later."""
+    def stamp(**kwargs):
+        marks.setdefault("end", time.perf_counter())
+
+    session = responser.session_manager().get_session(SFTProtocols.SFT, role)
+    session.add_cancle_hook(stamp)
+
+
+def run_case(case: dict, path: str, output_directory: str, port: int) -> dict:
+    """Run one transfer and return its measures, called in a child process."""
+    reserve_local_nodes(2)
+
+    address = ("127.0.0.1", port)
+    client_role = SFTRoles[case["initiator"].upper()]
+    server_role = SFTRoles.RECEIVER if client_role == SFTRoles.SENDER else SFTRoles.SENDER
+
+    listener = SFTListener(
+            cipher=create_cipher(case["cipher"]),
+            address=address,
+            buffer_size=case["buffer_size"] + MB
+        )
+
+    listener.get_scheme(SFTProtocols.SFT, SFTRoles.RECEIVER).config(directory=output_directory)
+    listener.get_scheme(SFTProtocols.SFT, SFTRoles.SENDER).config(buffer_size=case["buffer_size"])
+    listener.listen()
+
+    marks = {}
+    server_results = []
+
+    def serve():
+        responser = listener.accept(start_responser=False)
+        listener.close()
+
+        if server_role == SFTRoles.RECEIVER:
+            track_first_data(responser, marks)
+
+        responser.start(thread=True)
+        server_results.append(responser.wait_result(SFTProtocols.SFT, server_role, timeout=DEFAULT_TIMEOUT))
+        responser.close()
+
+    server_thread = threading.Thread(target=serve)
+    server_thread.start()
+
+    client = SFTClientResponser(
+            cipher=create_cipher(case["cipher"]),
+            address=address,
+            name="SFTClient",
+            buffer_size=case["buffer_size"] + MB
+        )
+
+    client.get_scheme(SFTProtocols.SFT, SFTRoles.RECEIVER).config(directory=output_directory)
+    client.get_scheme(SFTProtocols.SFT, SFTRoles.SENDER).config(buffer_size=case["buffer_size"])
+
+    if client_role == SFTRoles.RECEIVER:
+        track_first_data(client, marks)
+
+    track_end(client, client_role, marks)
+
+    client.connect()
+    client.start(thread=True)
+
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start_time = time.perf_counter()
+
+    if client_role == SFTRoles.SENDER:
+        client.activate(SFTProtocols.SFT, client_role, path=path)
+    else:
+        client.activate(SFTProtocols.SFT, client_role, token=path)
+
+    client_result = client.wait_result(SFTProtocols.SFT, client_role, timeout=DEFAULT_TIMEOUT)
+    server_thread.join()
+
+    end_time = marks.get("end", time.perf_counter())
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    client.close()
+
+    results = [client_result] + server_results
+    seconds = end_time - start_time
+    first_data = marks.get("first_data")
+
+    # ru_maxrss is in KB on Linux but in bytes on macOS.
+    peak_rss = end_usage.ru_maxrss * (1 if sys.platform == "darwin" else KB)
+
+    return {
+        "ok": all(result is not None and result.value for result in results),
+        "seconds": seconds,
+        "mbps": case["size"] / MB / seconds if seconds > 0 else None,
+        "ttfb": first_data - start_time if first_data is not None else None,
+        "cpu_seconds": (end_usage.ru_utime - start_usage.ru_utime)
+            + (end_usage.ru_stime - start_usage.ru_stime),
+        "peak_rss": peak_rss
+    }
+
+
+def _run_case_process(queue, case, path, output_directory, port):
+    # The sockets complain on stderr when they are closed.
+    sys.stderr = open(os.devnull, "w")
+
+    try:
+        queue.put(run_case(case, path, output_directory, port))
+    except Exception as e:
+        queue.put({"ok": False, "error": str(e)})
+
+
+def run_isolated(case: dict, path: str, output_directory: str, port: int) -> dict:
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+
+    process = context.Process(
+            target=_run_case_process,
+            args=(queue, case, path, output_directory, port)
+        )
+    process.start()
+
+    try:
+        result = queue.get(timeout=DEFAULT_TIMEOUT + 60)
+    except Exception:
+        result = {"ok": False, "error": "Timeout"}
+
+    process.join(10)
+    if process.is_alive():
+        process.kill()
+
+    return result
+
+
+def summarize(runs: list) -> dict:
+    summary = {}
+    for key in ("seconds", "mbps", "ttfb", "cpu_seconds", "peak_rss"):
+        values = [run[key] for run in runs if run.get(key) is not None]
+        summary[key] = statistics.median(values) if values else None
+
+    return summary
+
+
+def case_key(case: dict) -> tuple:
+    return (case["size"], case["buffer_size"], case["cipher"], case["initiator"])
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Return the cases whose median throughput dropped by more than
+    tolerance (a fraction) from the baseline."""
+    baseline_cases = {case_key(case): case for case in baseline["cases"]}
+
+    regressions = []
+    for case in report["cases"]:
+        old_case = baseline_cases.get(case_key(case))
+        if old_case is None:
+            continue
+
+        old_mbps = old_case["median"]["mbps"]
+        new_mbps = case["median"]["mbps"]
+        if not old_mbps:
+            continue
+
+        if new_mbps is None or new_mbps < old_mbps * (1 - tolerance):
+            regressions.append({
+                "size": case["size"],
+                "buffer_size": case["buffer_size"],
+                "cipher": case["cipher"],
+                "initiator": case["initiator"],
+                "baseline_mbps": old_mbps,
+                "mbps": new_mbps
+            })
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark SFT over loopback.")
+    parser.add_argument("--sizes", default=None,
+        help="comma separated file sizes, e.g. 1K,1M,1G (default {})".format(
+            ",".join(format_size(size) for size in DEFAULT_SIZES)))
+    parser.add_argument("--full", action="store_true",
+        help="also run the multi-GB files")
+    parser.add_argument("--buffer-sizes", default=",".join(format_size(size)
+        for size in DEFAULT_BUFFER_SIZES), help="comma separated buffer sizes")
+    parser.add_argument("--ciphers", default=",".join(DEFAULT_CIPHERS),
+        help="comma separated ciphers among none, aes_ctr")
+    parser.add_argument("--initiators", default=",".join(INITIATORS),
+        help="comma separated initiators among sender, receiver")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+        help="the first port, each run uses the next one")
+    parser.add_argument("--workdir", default="bench_data")
+    parser.add_argument("--output", default=None,
+        help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", default=None,
+        help="a previous report, exit with 1 if a case is slower")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+        help="the allowed drop of throughput from the baseline (default 0.1)")
+    args = parser.parse_args(argv)
+
+    if args.sizes is not None:
+        sizes = [parse_size(size) for size in args.sizes.split(",")]
+    else:
+        sizes = FULL_SIZES if args.full else DEFAULT_SIZES
+
+    buffer_sizes = [parse_size(size) for size in args.buffer_sizes.split(",")]
+    ciphers = args.ciphers.split(",")
+    initiators = args.initiators.split(",")
+
+    for cipher in ciphers:
+        create_cipher(cipher)
+
+    for initiator in initiators:
+        if initiator not in INITIATORS:
+            raise Exception("Invalid initiator {}".format(repr(initiator)))
+
+    input_directory = os.path.join(args.workdir, "input")
+    output_directory = os.path.join(args.workdir, "output")
+    os.makedirs(input_directory, exist_ok=True)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "cases": []
+    }
+
+    port = args.port
+    for size in sizes:
+        path = os.path.abspath(generate_file(input_directory, size))
+
+        for buffer_size in buffer_sizes:
+            for cipher in ciphers:
+                for initiator in initiators:
+                    case = {
+                        "size": size,
+                        "buffer_size": buffer_size,
+                        "cipher": cipher,
+                        "initiator": initiator
+                    }
+
+                    runs = []
+                    for _ in range(args.repeat):
+                        shutil.rmtree(output_directory, ignore_errors=True)
+                        os.makedirs(output_directory)
+
+                        runs.append(run_isolated(case, path, output_directory, port))
+                        port += 1
+
+                    case["runs"] = runs
+                    case["median"] = summarize([run for run in runs if run["ok"]])
+                    report["cases"].append(case)
+
+                    print("{:>6} buffer={:>5} {:<8} {:<8} {}".format(
+                            format_size(size),
+                            format_size(buffer_size),
+                            cipher,
+                            initiator,
+                            "{:.1f} MB/s".format(case["median"]["mbps"])
+                                if case["median"]["mbps"] is not None else "FAILED"
+                        ), file=sys.stderr)
+
+    shutil.rmtree(output_directory, ignore_errors=True)
+
+    exit_code = 0
+    if args.baseline is not None:
+        with open(args.baseline, "r") as stream:
+            baseline = json.load(stream)
+
+        report["regressions"] = compare(report, baseline, args.tolerance)
+        if report["regressions"]:
+            exit_code = 1
+
+    if any(not run["ok"] for case in report["cases"] for run in case["runs"]):
+        exit_code = 1
+
+    if args.output is not None:
+        with open(args.output, "w") as stream:
+            json.dump(report, stream, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,11 @@
 from sft.listener import SFTListener
+from sft.service import SFTService
+from sft.aio import AsyncSFTListener, AsyncSFTClient
 from sft.client import SFTClientResponser
+from sft.cache import DigestCache
+from sft.store import ContentStore
+from sft.ratelimit import RateLimiter
+from sft.scheduler import TransferScheduler
+from sft.metrics import MetricsSink, PrometheusMetricsSink
+from sft.sink import Sink
 from sft.version import __version__
\ No newline at end of file
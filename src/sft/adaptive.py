@@ -0,0 +1,107 @@
+import time
+from typing import Dict, Tuple
+
+
+DEFAULT_MIN_CHUNK_SIZE = 2 ** 14  # bytes
+DEFAULT_MAX_CHUNK_SIZE = 2 ** 22  # bytes
+INITIAL_CHUNK_SIZE = 2 ** 18  # bytes
+
+# A chunk takes at least this long to arrive, so that the cost of a packet
+# stays small on links with a very short round trip.
+MIN_CHUNK_TIME = 0.02  # seconds
+
+# A chunk is made smaller only if it takes longer than this to arrive. A
+# peer may spend a fixed time on each packet, a smaller chunk would then
+# lower the throughput further.
+MAX_CHUNK_TIME = 1.0  # seconds
+
+# The weight of a new sample in the throughput estimate.
+THROUGHPUT_GAIN = 0.25
+
+# The chunk size at most doubles or halves at each update.
+MAX_GROWTH = 2
+
+
+class ChunkSizer(object):
+    """Choose the size of the next required chunks from the measured
+    throughput and round trip time.
+
+    The window of outstanding chunks should hold the bandwidth-delay
+    product, so the target size is throughput * rtt / window_size. The
+    round trip time is the smallest delay between a REQUIRE and its SEND,
+    once the chunks which were queued ahead of it are taken off.
+    """
+    def __init__(self,
+                min_size: int = DEFAULT_MIN_CHUNK_SIZE,
+                max_size: int = DEFAULT_MAX_CHUNK_SIZE,
+                initial_size: int = INITIAL_CHUNK_SIZE
+            ) -> None:
+        if min_size <= 0 or max_size < min_size:
+            raise Exception("Invalid chunk size bounds ({}, {}).".format(min_size, max_size))
+
+        self._min_size = min_size
+        self._max_size = max_size
+        self._size = min(max(initial_size, min_size), max_size)
+
+        # offset -> (time of the REQUIRE, size, bytes outstanding before it).
+        self._requires: Dict[int, Tuple[float, int, int]] = {}
+        self._outstanding_size = 0
+
+        self._throughput: float = None  # bytes per second
+        self._rtt: float = None  # seconds
+        self._last_arrival: float = None
+
+    def size(self) -> int:
+        return self._size
+
+    def throughput(self) -> float:
+        return self._throughput
+
+    def rtt(self) -> float:
+        return self._rtt
+
+    def on_require(self, offset: int, size: int):
+        """Record a REQUIRE of size bytes at offset."""
+        if offset in self._requires:
+            self._outstanding_size -= self._requires[offset][1]
+
+        self._requires[offset] = (time.monotonic(), size, self._outstanding_size)
+        self._outstanding_size += size
+
+    def on_receive(self, offset: int, nbytes: int, window_size: int = 1):
+        """Record the SEND of nbytes at offset and update the chunk size."""
+        now = time.monotonic()
+
+        if self._last_arrival is not None and now > self._last_arrival:
+            sample = nbytes / (now - self._last_arrival)
+            if self._throughput is None:
+                self._throughput = sample
+            else:
+                self._throughput += THROUGHPUT_GAIN * (sample - self._throughput)
+
+        self._last_arrival = now
+
+        require = self._requires.pop(offset, None)
+        if require is None:
+            return
+
+        require_time, size, queued_size = require
+        self._outstanding_size -= size
+
+        if self._throughput is None:
+            return
+
+        rtt = max(0.0, now - require_time - (queued_size + nbytes) / self._throughput)
+        if self._rtt is None or rtt < self._rtt:
+            self._rtt = rtt
+
+        target = max(
+                self._throughput * self._rtt / max(window_size, 1),
+                self._throughput * MIN_CHUNK_TIME
+            )
+
+        if target < self._size:
+            target = min(self._size, self._throughput * MAX_CHUNK_TIME)
+
+        target = min(max(target, self._size / MAX_GROWTH), self._size * MAX_GROWTH)
+        self._size = int(min(max(target, self._min_size), self._max_size))
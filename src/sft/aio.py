@@ -0,0 +1,461 @@
+import copy
+import time
+import struct
+import asyncio
+import functools
+import threading
+from typing import Dict, List, Set
+
+from hks_pylib.done import Done
+from hks_pylib.logger import LoggerGenerator, Display
+from hks_pylib.logger import InvisibleLoggerGenerator
+from hks_pylib.logger.standard import StdUsers, StdLevels
+from hks_pylib.cryptography.ciphers.hkscipher import HKSCipher
+
+from hks_pynetwork.packet import MIN_HEADER_SIZE
+from hks_pynetwork.secure_packet import SecurePacketEncoder, SecurePacketDecoder
+
+from csbuilder.cspacket import CSPacket
+from csbuilder.session import Session, SessionManager
+
+from sft.metrics import Stopwatch, PHASE_CRYPTO
+from sft.responser import rebind_session_hooks
+from sft.protocol import DEFAULT_TIMEOUT
+from sft.protocol import SFTProtocols, SFTRoles
+from sft.protocol.scheme import SFTScheme
+from sft.protocol.sender import SFTSenderScheme
+from sft.protocol.receiver import SFTReceiverScheme
+
+
+_encode_lock = threading.Lock()
+
+
+def create_session_manager(name: str,
+                            logger_generator: LoggerGenerator = InvisibleLoggerGenerator(),
+                            display: dict = {}
+                        ) -> SessionManager:
+    """Return a session manager holding the SFT schemes of both roles, the
+    connections clone their sessions from it."""
+    session_manager = SessionManager(
+            name=name,
+            logger_generator=logger_generator,
+            display=display
+        )
+
+    session_manager.create_session(
+            scheme=SFTSenderScheme(forwarder=None),
+            timeout=DEFAULT_TIMEOUT
+        )
+
+    session_manager.create_session(
+            scheme=SFTReceiverScheme(forwarder=None),
+            timeout=DEFAULT_TIMEOUT
+        )
+
+    return session_manager
+
+
+class AsyncSFTConnection(object):
+    """Run the SFT schemes over an asyncio stream.
+
+    The packets are framed and encrypted as STCPSocket does, so the other
+    end may be a thread-based SFT responser. The schemes are synchronous:
+    each incoming packet is handled in the executor of the loop, where the
+    file is read or written, one packet at a time per connection. A
+    transfer waiting for the admission of a TransferScheduler waits in the
+    loop, not in the executor.
+    """
+    def __init__(self,
+                reader: asyncio.StreamReader,
+                writer: asyncio.StreamWriter,
+                cipher: HKSCipher,
+                session_manager: SessionManager,
+                name: str,
+                logger_generator: LoggerGenerator = InvisibleLoggerGenerator(),
+                display: dict = {}
+            ) -> None:
+        self._reader = reader
+        self._writer = writer
+        self._name = name
+
+        self._print = logger_generator.generate(name, display)
+
+        # The outgoing and incoming packets are encrypted by their own cipher
+        # (see separate_ciphers).
+        self._encoder = SecurePacketEncoder(copy.copy(cipher))
+        self._decoder = SecurePacketDecoder(copy.copy(cipher))
+        self._send_lock = asyncio.Lock()
+        self._crypto_stopwatch = Stopwatch()
+
+        self._loop = asyncio.get_running_loop()
+
+        # The host at the other end, the rate limits of a peer apply to it.
+        peer = str(writer.get_extra_info("peername", ("",))[0])
+
+        # The sessions of this connection, the schemes answer to its name.
+        self._session_manager = SessionManager(
+                name="SessionManager of {}".format(name),
+                logger_generator=logger_generator,
+                display=display
+            )
+        self._session_manager.extend(session_manager)
+
+        self._is_responding = False
+        self._ended_events: List[asyncio.Event] = []
+
+        self._result_events: Dict[SFTRoles, asyncio.Event] = {}
+        for role in (SFTRoles.SENDER, SFTRoles.RECEIVER):
+            session = self._session_manager.get_session(SFTProtocols.SFT, role)
+            rebind_session_hooks(session)
+            session.scheme().config(forwarder=name, peer=peer)
+
+            # A session is canceled once its result is set, even on timeout.
+            self._result_events[role] = asyncio.Event()
+            session.add_cancle_hook(self.__notify_result, event=self._result_events[role])
+
+    def name(self) -> str:
+        return self._name
+
+    def session_manager(self) -> SessionManager:
+        return self._session_manager
+
+    def __notify_result(self, event: asyncio.Event, **kwargs):
+        # Called by the thread which ends the session.
+        try:
+            self._loop.call_soon_threadsafe(self.__set_result_event, event)
+        except RuntimeError:
+            # The loop is closed.
+            pass
+
+    def __set_result_event(self, event: asyncio.Event):
+        # The last response of the session is sent before its result is
+        # given, the connection may be closed as soon as the result comes.
+        if self._is_responding:
+            self._ended_events.append(event)
+        else:
+            event.set()
+
+    async def __recv(self) -> bytes:
+        header = await self._reader.readexactly(MIN_HEADER_SIZE)
+
+        header_size, payload_size = struct.unpack(">HI", header)
+        if header_size < MIN_HEADER_SIZE:
+            raise Exception("Invalid packet header")
+
+        packet = header + await self._reader.readexactly(header_size - MIN_HEADER_SIZE + payload_size)
+
+        packet_dict = await self._loop.run_in_executor(None, self.__decode, packet)
+
+        return packet_dict["payload"]
+
+    def __decode(self, packet: bytes) -> dict:
+        with self._crypto_stopwatch.measure():
+            return self._decoder.decode(packet)
+
+    def __encode(self, packet: CSPacket) -> bytes:
+        data = packet.to_bytes()
+
+        # The encoders hash the name of the cipher with hash objects shared
+        # by the whole process.
+        with _encode_lock, self._crypto_stopwatch.measure():
+            self._encoder.cipher.reset()
+            return self._encoder.encode(data)
+
+    async def __send(self, packet: CSPacket):
+        async with self._send_lock:
+            data = await self._loop.run_in_executor(None, self.__encode, packet)
+            self._writer.write(data)
+            await self._writer.drain()
+
+    async def __send_response(self, packet: CSPacket):
+        if packet is not None:
+            await self.__send(packet)
+
+        # The extra packets queued by the schemes (see SFTScheme.push_packet).
+        for role in (SFTRoles.SENDER, SFTRoles.RECEIVER):
+            scheme = self._session_manager.get_scheme(SFTProtocols.SFT, role)
+
+            for _, extra_packet in scheme.pop_packets():
+                await self.__send(extra_packet)
+
+    async def run(self):
+        """Respond to the packets of the other end until the connection is
+        closed."""
+        while True:
+            try:
+                data = await self.__recv()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self._print(StdUsers.DEV, StdLevels.INFO, "Connection closed.")
+                break
+            except Exception as e:
+                self._print(StdUsers.DEV, StdLevels.WARNING, "Error when data "
+                "receiving ({}).".format(e))
+                break
+
+            try:
+                packet = CSPacket.from_bytes(data)
+            except Exception as e:
+                self._print(StdUsers.DEV, StdLevels.WARNING, "Error when data "
+                "extracting ({})".format(e))
+                continue
+
+            # The time spent on the packets since the previous one goes to the
+            # scheme answering this one.
+            if packet.protocol() == SFTProtocols.SFT:
+                role = SFTRoles.RECEIVER if packet.role() == SFTRoles.SENDER else SFTRoles.SENDER
+                scheme = self._session_manager.get_scheme(SFTProtocols.SFT, role)
+                scheme.metrics().add_time(PHASE_CRYPTO, self._crypto_stopwatch.take())
+
+            self._is_responding = True
+            try:
+                if packet.protocol() == SFTProtocols.SFT:
+                    await self.__admit(scheme, packet)
+
+                result = await self._loop.run_in_executor(
+                        None,
+                        self._session_manager.respond,
+                        self._name,
+                        packet
+                    )
+
+                await self.__send_response(result.packet)
+            except ConnectionError:
+                # The connection is closed while sending.
+                break
+            except Exception as e:
+                self._print(StdUsers.DEV, StdLevels.ERROR, "Unknown error occurs "
+                "when solving data ({})".format(e))
+                continue
+            finally:
+                self._is_responding = False
+
+                for event in self._ended_events:
+                    event.set()
+                self._ended_events.clear()
+
+        await self.close()
+
+    async def __admit(self, scheme: SFTScheme, packet: CSPacket):
+        """Admit the transfer requested by packet, if the scheme has to, in
+        the loop. The transfer doesn't hold a thread of the executor while
+        it waits (see SFTSenderScheme.get_admission_priority)."""
+        priority = await self._loop.run_in_executor(None, scheme.get_admission_priority, packet)
+        if priority is None:
+            return
+
+        start_time = time.monotonic()
+        slot = await scheme.scheduler().admit_async(priority)
+        scheme.set_admission(slot, time.monotonic() - start_time)
+
+    async def activate(self, role: SFTRoles, **kwargs):
+        self._result_events[role].clear()
+
+        _, packet = await self._loop.run_in_executor(
+                None,
+                functools.partial(self._session_manager.activate, SFTProtocols.SFT, role, **kwargs)
+            )
+
+        await self.__send_response(packet)
+
+    async def wait_result(self, role: SFTRoles, timeout: float = None) -> Done:
+        """Wait for the result of the session of the role, return None if it
+        does not end in time."""
+        try:
+            await asyncio.wait_for(self._result_events[role].wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+        self._result_events[role].clear()
+
+        result = self._session_manager.wait_result(SFTProtocols.SFT, role, Session.TIME_PERIODIC)
+        if result is None:
+            return Done(False, reason="Connection closed")
+
+        return result
+
+    def is_connected(self) -> bool:
+        return not self._writer.is_closing()
+
+    async def close(self):
+        if not self._writer.is_closing():
+            self._writer.close()
+
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+
+        # Nothing comes anymore, the waiting results are given up.
+        for event in self._result_events.values():
+            event.set()
+
+
+class AsyncSFTListener(object):
+    """Serve SFT clients from an event loop.
+
+    A connection costs no thread while it is idle: its packets are read by
+    the loop and only handled in the executor of the loop.
+    """
+    def __init__(self,
+                cipher: HKSCipher,
+                address: tuple,
+                name: str = "AsyncSFTListener",
+                logger_generator: LoggerGenerator = InvisibleLoggerGenerator(),
+                display: dict = {StdUsers.DEV: Display.ALL}
+            ) -> None:
+        self._cipher = cipher
+        self._address = address
+        self._name = name
+
+        self._logger_generator = logger_generator
+        self._display = display
+        self._print = logger_generator.generate(name, display)
+
+        self._session_manager = create_session_manager(
+                name="Session Manager of {}".format(name),
+                logger_generator=logger_generator,
+                display=display
+            )
+
+        self._server: asyncio.AbstractServer = None
+        self._connections: Set[AsyncSFTConnection] = set()
+
+    def session_manager(self) -> SessionManager:
+        return self._session_manager
+
+    def config(self, role: SFTRoles, **kwargs):
+        """Configure the scheme of the role for the connections which are
+        accepted from now on."""
+        self._session_manager.get_scheme(SFTProtocols.SFT, role).config(**kwargs)
+
+    def connections(self) -> int:
+        return len(self._connections)
+
+    async def listen(self):
+        self._server = await asyncio.start_server(self.__serve, *self._address)
+
+        self._print(StdUsers.USER, StdLevels.INFO, "Listener started.")
+        self._print(StdUsers.DEV, StdLevels.INFO, "Listener started.")
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.listen()
+
+        await self._server.serve_forever()
+
+    async def __serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = writer.get_extra_info("peername")[:2]
+
+        self._print(StdUsers.USER, StdLevels.INFO, "Client {} connect "
+        "to server".format(address))
+
+        connection = AsyncSFTConnection(
+                reader=reader,
+                writer=writer,
+                cipher=self._cipher,
+                session_manager=self._session_manager,
+                name="Async Server Responser [{}]".format(address),
+                logger_generator=self._logger_generator,
+                display=self._display
+            )
+
+        self._connections.add(connection)
+        try:
+            await connection.run()
+        finally:
+            self._connections.discard(connection)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+        for connection in list(self._connections):
+            await connection.close()
+
+        self._print(StdUsers.USER, StdLevels.INFO, "Listener closed.")
+        self._print(StdUsers.DEV, StdLevels.INFO, "Listener closed.")
+
+
+class AsyncSFTClient(object):
+    """The asyncio counterpart of QSFTClient, its connection is kept open
+    between transfers and opened again if the server has closed it."""
+    def __init__(self,
+                cipher: HKSCipher,
+                address: tuple,
+                name: str = "AsyncSFTClient",
+                logger_generator: LoggerGenerator = InvisibleLoggerGenerator(),
+                display: dict = {StdUsers.DEV: Display.ALL}
+            ) -> None:
+        self._cipher = cipher
+        self._address = address
+        self._name = name
+
+        self._logger_generator = logger_generator
+        self._display = display
+
+        self._session_manager = create_session_manager(
+                name="Session Manager of {}".format(name),
+                logger_generator=logger_generator,
+                display=display
+            )
+
+        self._connection: AsyncSFTConnection = None
+        self._task: asyncio.Task = None
+
+    def config(self, role: SFTRoles, **kwargs):
+        self._session_manager.get_scheme(SFTProtocols.SFT, role).config(**kwargs)
+
+    def is_connected(self) -> bool:
+        return self._connection is not None and self._connection.is_connected()
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection(*self._address)
+
+        self._connection = AsyncSFTConnection(
+                reader=reader,
+                writer=writer,
+                cipher=self._cipher,
+                session_manager=self._session_manager,
+                name=self._name,
+                logger_generator=self._logger_generator,
+                display=self._display
+            )
+
+        self._task = asyncio.ensure_future(self._connection.run())
+
+    async def __transfer(self, role: SFTRoles, **kwargs) -> Done:
+        if not self.is_connected():
+            await self.connect()
+
+        await self._connection.activate(role, **kwargs)
+
+        # The session times out by itself if the server stops responding.
+        return await self._connection.wait_result(role)
+
+    async def send(self, path: str, stream=None) -> Done:
+        if stream is None:
+            return await self.__transfer(SFTRoles.SENDER, path=path)
+
+        return await self.__transfer(SFTRoles.SENDER, path=path, stream=stream)
+
+    async def receive(self, filename: str, sink=None) -> Done:
+        if sink is None:
+            return await self.__transfer(SFTRoles.RECEIVER, token=filename)
+
+        return await self.__transfer(SFTRoles.RECEIVER, token=filename, sink=sink)
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+            await self._task
+
+            self._connection = None
+            self._task = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
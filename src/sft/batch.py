@@ -0,0 +1,312 @@
+import os
+import bisect
+from typing import Dict, List
+
+from hks_pylib.done import Done
+from hks_pylib.cryptography.hashes import SHA256
+
+from sft.file import File, FileReader, FileWriter, FSYNC_NONE
+from sft.cache import DigestCache
+from sft.protocol import DEFAULT_INT_SIZE
+
+
+class BatchEntry(object):
+    def __init__(self, path: str, size: int, digest: bytes) -> None:
+        # The path relative to the root of the batch, separated by "/".
+        self.path = path
+        self.size = size
+        self.digest = digest
+
+
+def check_path(path: str):
+    """Raise an exception if the relative path could leave the root of the
+    batch once it is joined to it."""
+    if not path or "\0" in path or "\\" in path or os.path.isabs(path):
+        raise Exception("Invalid path {}".format(repr(path)))
+
+    for part in path.split("/"):
+        if part in ("", ".", ".."):
+            raise Exception("Invalid path {}".format(repr(path)))
+
+
+class BatchManifest(object):
+    """The files of a batch transfer.
+
+    The content of a batch is the concatenation of its files in the order
+    of the manifest, it is transferred as a single file so that small files
+    share the same chunks.
+    """
+    def __init__(self, entries: List[BatchEntry]) -> None:
+        self.entries = entries
+
+        # The offset of each file in the content of the batch.
+        self.offsets = []
+
+        size = 0
+        for entry in entries:
+            self.offsets.append(size)
+            size += entry.size
+
+        self._size = size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def size(self):
+        return self._size
+
+    def locate(self, offset: int) -> int:
+        """Return the index of the file containing the offset."""
+        return bisect.bisect_right(self.offsets, offset) - 1
+
+    @staticmethod
+    def from_directory(root: str, cache: DigestCache = None):
+        """Return the manifest of the regular files under root, empty
+        directories are not part of it."""
+        entries = []
+        for directory, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+
+            for filename in sorted(filenames):
+                path = os.path.join(directory, filename)
+                if not os.path.isfile(path):
+                    continue
+
+                relpath = os.path.relpath(path, root).replace(os.sep, "/")
+                size = os.path.getsize(path)
+                digest = File(path).digest(cache=cache)
+
+                entries.append(BatchEntry(relpath, size, digest))
+
+        return BatchManifest(entries)
+
+    def to_bytes(self, int_size: int) -> bytes:
+        data = []
+        for entry in self.entries:
+            path = entry.path.encode()
+
+            data.append(len(path).to_bytes(DEFAULT_INT_SIZE, "big"))
+            data.append(path)
+            data.append(len(entry.digest).to_bytes(DEFAULT_INT_SIZE, "big"))
+            data.append(entry.digest)
+            data.append(entry.size.to_bytes(int_size, "big"))
+
+        return b"".join(data)
+
+    @staticmethod
+    def from_bytes(data: bytes, int_size: int):
+        entries = []
+        paths = set()
+
+        cursor = 0
+        while cursor < len(data):
+            path_size = int.from_bytes(data[cursor: cursor + DEFAULT_INT_SIZE], "big")
+            cursor += DEFAULT_INT_SIZE
+
+            path = data[cursor: cursor + path_size].decode()
+            cursor += path_size
+
+            digest_size = int.from_bytes(data[cursor: cursor + DEFAULT_INT_SIZE], "big")
+            cursor += DEFAULT_INT_SIZE
+
+            digest = data[cursor: cursor + digest_size]
+            cursor += digest_size
+
+            bsize = data[cursor: cursor + int_size]
+            cursor += int_size
+
+            if len(bsize) != int_size or len(digest) != digest_size:
+                raise Exception("Invalid manifest")
+
+            check_path(path)
+            if path in paths:
+                raise Exception("Duplicated path {}".format(repr(path)))
+            paths.add(path)
+
+            entries.append(BatchEntry(path, int.from_bytes(bsize, "big"), digest))
+
+        return BatchManifest(entries)
+
+
+class BatchReader(File):
+    """Read the content of a batch, the files are opened one at a time with
+    reader_cls."""
+    def __init__(self, root: str, manifest: BatchManifest, reader_cls: type = FileReader) -> None:
+        super().__init__(root)
+
+        self._manifest = manifest
+        self._reader_cls = reader_cls
+
+        self._reader: FileReader = None
+        self._reader_index: int = None
+
+    def size(self):
+        return self._manifest.size()
+
+    def manifest(self):
+        return self._manifest
+
+    def digest(self, *args, **kwargs):
+        """The digest of a batch is the one of its manifest, which holds the
+        digests of the files."""
+        if self._digest is None:
+            hash_obj = SHA256()
+            hash_obj.update(self._manifest.to_bytes(DEFAULT_INT_SIZE))
+            self._digest = hash_obj.finalize()
+
+        return self._digest
+
+    def streamed_digest(self):
+        return None
+
+    def __get_reader(self, index: int) -> FileReader:
+        if self._reader_index != index:
+            self.__close_reader()
+
+            path = os.path.join(self._filename, *self._manifest.entries[index].path.split("/"))
+
+            # A file removed since the manifest was built is read as empty.
+            try:
+                self._reader = self._reader_cls(path)
+            except Exception:
+                self._reader = None
+
+            self._reader_index = index
+
+        return self._reader
+
+    def __close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+
+        self._reader = None
+        self._reader_index = None
+
+    def read(self, start: int, length: int):
+        end = min(start + length, self._manifest.size())
+
+        data = []
+        position = start
+        index = self._manifest.locate(start)
+        while position < end:
+            entry = self._manifest.entries[index]
+            entry_start = self._manifest.offsets[index]
+            nbytes = min(end, entry_start + entry.size) - position
+
+            if nbytes > 0:
+                reader = self.__get_reader(index)
+                chunk = b"" if reader is None else reader.read(position - entry_start, nbytes)
+
+                # A file which has shrunk since the manifest was built is
+                # padded, the receiver detects it with the digest of the file.
+                if len(chunk) < nbytes:
+                    chunk += bytes(nbytes - len(chunk))
+
+                data.append(chunk)
+                position += nbytes
+
+            index += 1
+
+        return b"".join(data)
+
+    def close(self):
+        self.__close_reader()
+        super().close()
+
+
+class BatchWriter(File):
+    """Write the content of a batch into the files of the manifest under
+    root. A file is closed and checked as soon as it is complete."""
+    def __init__(self, root: str, manifest: BatchManifest, fsync: str = FSYNC_NONE) -> None:
+        super().__init__(root)
+
+        self._manifest = manifest
+        self._fsync = fsync
+
+        self._current_size = 0
+        self._writers: Dict[int, FileWriter] = {}
+        self._results: Dict[str, Done] = {}
+
+        os.makedirs(root, exist_ok=True)
+
+        for index, entry in enumerate(self._manifest.entries):
+            if entry.size == 0:
+                self.__get_writer(index)
+                self.__complete(index)
+
+    def __get_path(self, index: int):
+        return os.path.join(self._filename, *self._manifest.entries[index].path.split("/"))
+
+    def __get_writer(self, index: int) -> FileWriter:
+        if index not in self._writers:
+            path = self.__get_path(index)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._writers[index] = FileWriter(path, SHA256())
+
+        return self._writers[index]
+
+    def __complete(self, index: int):
+        entry = self._manifest.entries[index]
+        writer = self._writers.pop(index)
+
+        writer.flush(self._fsync)
+        writer.close()
+
+        if writer.digest() != entry.digest:
+            self._results[entry.path] = Done(False, reason="Integrity is compromised")
+        else:
+            self._results[entry.path] = Done(True, path=self.__get_path(index))
+
+    def write(self, data: bytes, offset: int):
+        end = offset + len(data)
+
+        position = offset
+        index = self._manifest.locate(offset)
+        while position < end:
+            entry = self._manifest.entries[index]
+            entry_start = self._manifest.offsets[index]
+            nbytes = min(end, entry_start + entry.size) - position
+
+            # A completed file is never opened again.
+            if nbytes > 0 and entry.path not in self._results:
+                writer = self.__get_writer(index)
+                writer.write(data[position - offset: position - offset + nbytes], position - entry_start)
+
+                if writer.size() == entry.size:
+                    self.__complete(index)
+
+            position += max(nbytes, 0)
+            index += 1
+
+        self._current_size += len(data)
+
+        return len(data)
+
+    def hashed_size(self):
+        return 0
+
+    def preallocate(self, size: int):
+        pass
+
+    def flush(self, fsync: str = FSYNC_NONE):
+        for writer in self._writers.values():
+            writer.flush(fsync)
+
+    def results(self) -> Dict[str, Done]:
+        """Return the result of each file of the manifest."""
+        results = {}
+        for entry in self._manifest.entries:
+            results[entry.path] = self._results.get(entry.path, Done(False, reason="Not received"))
+
+        return results
+
+    def size(self):
+        return self._current_size
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+
+        self._writers.clear()
+
+        super().close()
@@ -0,0 +1,94 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
+
+DEFAULT_CACHE_CAPACITY = 1024  # entries
+
+
+class DigestCache(object):
+    """A LRU cache of file digests.
+
+    An entry is keyed by (path, inode, size, mtime_ns, algorithm), so it is
+    invalidated as soon as the file is replaced or modified. If index_path is
+    given, the entries are also kept in that file and reloaded on the next
+    start.
+
+    The cache is shared by all sessions which are cloned from the same scheme.
+    """
+    def __init__(self, capacity: int = DEFAULT_CACHE_CAPACITY, index_path: str = None) -> None:
+        if not isinstance(capacity, int) or capacity <= 0:
+            raise Exception("Parameter capacity must be a positive integer.")
+
+        if index_path is not None and not isinstance(index_path, str):
+            raise Exception("Parameter index_path must be a str.")
+
+        self._capacity = capacity
+        self._index_path = index_path
+
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+        if self._index_path and os.path.isfile(self._index_path):
+            self._load()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def key(self, path: str, algorithm: str) -> Tuple:
+        stat = os.stat(path)
+        return (
+                os.path.realpath(path),
+                stat.st_ino,
+                stat.st_size,
+                stat.st_mtime_ns,
+                algorithm
+            )
+
+    def get(self, key: Tuple) -> bytes:
+        self._lock.acquire()
+
+        digest = self._entries.get(key, None)
+        if digest is not None:
+            self._entries.move_to_end(key)
+
+        self._lock.release()
+
+        return digest
+
+    def put(self, key: Tuple, digest: bytes):
+        self._lock.acquire()
+
+        self._entries[key] = digest
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+        if self._index_path:
+            self._save()
+
+        self._lock.release()
+
+    def _load(self):
+        try:
+            with open(self._index_path, "r") as stream:
+                entries = json.load(stream)
+        except (OSError, ValueError):
+            # A broken index only costs a recomputation of the digests.
+            return
+
+        for entry in entries[-self._capacity:]:
+            *key, digest = entry
+            self._entries[tuple(key)] = bytes.fromhex(digest)
+
+    def _save(self):
+        entries = [list(key) + [digest.hex()] for key, digest in self._entries.items()]
+
+        tmp_path = "{}.tmp".format(self._index_path)
+        with open(tmp_path, "w") as stream:
+            json.dump(entries, stream)
+
+        os.replace(tmp_path, self._index_path)
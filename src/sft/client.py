@@ -6,12 +6,14 @@ from hks_pylib.cryptography.ciphers.hkscipher import HKSCipher
 
 from csbuilder.client import ClientResponser
 
+from sft.responser import SFTResponser, prepare_socket
 from sft.protocol.sender import SFTSenderScheme
 from sft.protocol.receiver import SFTReceiverScheme
 from sft.protocol import DEFAULT_TIMEOUT, DEFAULT_BUFFER_SIZE
+from sft.protocol import SFTProtocols, SFTRoles
 
 
-class SFTClientResponser(ClientResponser):
+class SFTClientResponser(SFTResponser, ClientResponser):
     def __init__(self,
                 cipher: HKSCipher,
                 address: tuple,
@@ -44,3 +46,10 @@ class SFTClientResponser(ClientResponser):
                 display=display
             )
 
+        # The rate limits of a peer apply to the server.
+        for role in (SFTRoles.SENDER, SFTRoles.RECEIVER):
+            self.session_manager().get_scheme(SFTProtocols.SFT, role).config(peer=address[0])
+
+    def connect(self) -> None:
+        super().connect()
+        self._crypto_stopwatch = prepare_socket(self._socket)
@@ -0,0 +1,107 @@
+import bz2
+import lzma
+import zlib
+from typing import List, Tuple
+
+
+# Codec identifiers on the wire, CODEC_NONE marks uncompressed chunks.
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_BZ2 = 2
+CODEC_LZMA = 3
+
+CODEC_SIZE = 1  # bytes
+
+CODECS = {
+    "zlib": CODEC_ZLIB,
+    "bz2": CODEC_BZ2,
+    "lzma": CODEC_LZMA
+}
+
+# A chunk is sent uncompressed if compressing saves less than this.
+DEFAULT_COMPRESSION_THRESHOLD = 0.9  # compressed size / original size
+MAX_BYPASSED_CHUNKS = 64
+
+
+def get_codecs(names: List[str]) -> List[int]:
+    codecs = []
+    for name in names:
+        if name not in CODECS:
+            raise Exception("Unknown codec {} (expected one of {}).".format(name, list(CODECS)))
+
+        codecs.append(CODECS[name])
+
+    return codecs
+
+
+def compress(codec: int, data: bytes) -> bytes:
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data)
+
+    if codec == CODEC_BZ2:
+        return bz2.compress(data)
+
+    if codec == CODEC_LZMA:
+        return lzma.compress(data)
+
+    raise Exception("Unknown codec {}".format(codec))
+
+
+def decompress(codec: int, data: bytes, max_length: int) -> bytes:
+    """Decompress data, refuse to produce more than max_length bytes."""
+    if codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+        output = decompressor.decompress(data, max_length)
+        is_complete = decompressor.eof and not decompressor.unconsumed_tail
+    elif codec == CODEC_BZ2:
+        decompressor = bz2.BZ2Decompressor()
+        output = decompressor.decompress(data, max_length)
+        is_complete = decompressor.eof
+    elif codec == CODEC_LZMA:
+        decompressor = lzma.LZMADecompressor()
+        output = decompressor.decompress(data, max_length)
+        is_complete = decompressor.eof
+    else:
+        raise Exception("Unknown codec {}".format(codec))
+
+    if not is_complete:
+        raise Exception("Invalid or too large compressed chunk")
+
+    return output
+
+
+class ChunkCompressor(object):
+    """Compress chunks with a codec, and bypass the codec while the chunks
+    turn out to be incompressible.
+
+    After an incompressible chunk, the next chunks are sent as is; the number
+    of bypassed chunks doubles each time the next probe fails again.
+    """
+    def __init__(self, codec: int, threshold: float = DEFAULT_COMPRESSION_THRESHOLD) -> None:
+        self._codec = codec
+        self._threshold = threshold
+
+        self._bypass = 0
+        self._remain_bypassed_chunks = 0
+
+    def codec(self) -> int:
+        return self._codec
+
+    def compress(self, data: bytes) -> Tuple[int, bytes]:
+        """Return the codec which is actually used and the payload."""
+        if self._codec == CODEC_NONE or not data:
+            return CODEC_NONE, data
+
+        if self._remain_bypassed_chunks > 0:
+            self._remain_bypassed_chunks -= 1
+            return CODEC_NONE, data
+
+        compressed = compress(self._codec, data)
+
+        if len(compressed) >= self._threshold * len(data):
+            self._bypass = min(max(1, 2 * self._bypass), MAX_BYPASSED_CHUNKS)
+            self._remain_bypassed_chunks = self._bypass
+            return CODEC_NONE, data
+
+        self._bypass = 0
+        return self._codec, compressed
@@ -0,0 +1,190 @@
+import math
+import zlib
+from typing import Dict, List, Tuple
+
+from hks_pylib.cryptography.hashes import SHA256
+
+from sft.file import FileReader
+
+
+MIN_DELTA_BLOCK_SIZE = 4096  # bytes
+WEAK_CHECKSUM_SIZE = 4  # bytes
+STRONG_CHECKSUM_SIZE = 16  # bytes
+
+_ADLER_MOD = 65521
+
+
+def get_block_size(filesize: int) -> int:
+    """Blocks of about sqrt(filesize) bytes keep both the signatures and the
+    literal data small (as rsync does)."""
+    return max(MIN_DELTA_BLOCK_SIZE, math.isqrt(filesize))
+
+
+def weak_checksum(data: bytes) -> int:
+    return zlib.adler32(data)
+
+
+def roll_weak_checksum(checksum: int, out_byte: int, in_byte: int, block_size: int) -> int:
+    """Return the adler32 checksum of the window moved forward by one byte."""
+    a = checksum & 0xffff
+    b = checksum >> 16
+
+    a = (a - out_byte + in_byte) % _ADLER_MOD
+    b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+
+    return (b << 16) | a
+
+
+def strong_checksum(data: bytes) -> bytes:
+    hash_obj = SHA256()
+    hash_obj.update(data)
+    return hash_obj.finalize()[:STRONG_CHECKSUM_SIZE]
+
+
+class Signatures(object):
+    """The checksums of the complete blocks of a file."""
+    def __init__(self, block_size: int, weaks: List[int], strongs: List[bytes]) -> None:
+        self.block_size = block_size
+        self.weaks = weaks
+        self.strongs = strongs
+
+        # weak checksum -> strong checksum -> the first block having them.
+        self._lookup: Dict[int, Dict[bytes, int]] = {}
+        for index, (weak, strong) in enumerate(zip(weaks, strongs)):
+            self._lookup.setdefault(weak, {}).setdefault(strong, index)
+
+    def __len__(self):
+        return len(self.weaks)
+
+    def __contains__(self, weak: int):
+        return weak in self._lookup
+
+    @staticmethod
+    def from_file(path: str, block_size: int):
+        weaks, strongs = [], []
+
+        with open(path, "rb") as stream:
+            while True:
+                block = stream.read(block_size)
+                if len(block) < block_size:
+                    break
+
+                weaks.append(weak_checksum(block))
+                strongs.append(strong_checksum(block))
+
+        return Signatures(block_size, weaks, strongs)
+
+    def to_bytes(self, int_size: int) -> bytes:
+        data = [self.block_size.to_bytes(int_size, "big")]
+
+        for weak, strong in zip(self.weaks, self.strongs):
+            data.append(weak.to_bytes(WEAK_CHECKSUM_SIZE, "big"))
+            data.append(strong)
+
+        return b"".join(data)
+
+    @staticmethod
+    def from_bytes(data: bytes, int_size: int):
+        block_size = int.from_bytes(data[0: int_size], "big")
+        if block_size <= 0:
+            raise Exception("Invalid block size")
+
+        entry_size = WEAK_CHECKSUM_SIZE + STRONG_CHECKSUM_SIZE
+        if (len(data) - int_size) % entry_size != 0:
+            raise Exception("Invalid signatures")
+
+        weaks, strongs = [], []
+        for cursor in range(int_size, len(data), entry_size):
+            weaks.append(int.from_bytes(data[cursor: cursor + WEAK_CHECKSUM_SIZE], "big"))
+            strongs.append(data[cursor + WEAK_CHECKSUM_SIZE: cursor + entry_size])
+
+        return Signatures(block_size, weaks, strongs)
+
+    def find(self, weak: int, block: bytes, preferred_index: int = None) -> int:
+        """Return the index of a block equal to the given one, or None. The
+        preferred index is returned if it matches, it keeps runs of copied
+        blocks contiguous in files having repeated blocks."""
+        strongs = self._lookup.get(weak, None)
+        if strongs is None:
+            return None
+
+        strong = strong_checksum(block)
+
+        if preferred_index is not None and preferred_index < len(self.weaks) \
+                and self.weaks[preferred_index] == weak \
+                and self.strongs[preferred_index] == strong:
+            return preferred_index
+
+        return strongs.get(strong, None)
+
+
+def match_blocks(reader: FileReader, signatures: Signatures, buffer_size: int) -> List[Tuple[int, int, int]]:
+    """Scan the file of reader for the blocks described by signatures.
+
+    Return the runs of (offset in the file, index of the first block, number
+    of blocks). The file is read sequentially, which keeps a streaming
+    digest of reader up to date.
+    """
+    block_size = signatures.block_size
+    filesize = reader.size()
+    buffer_size = max(buffer_size, 2 * block_size)
+
+    runs: List[List[int]] = []
+
+    data = b""
+    data_start = 0
+    position = 0
+    weak = None
+
+    while len(signatures) > 0 and position + block_size <= filesize:
+        # Keep the window and the next byte in the buffer.
+        if position + block_size + 1 > data_start + len(data):
+            data_end = data_start + len(data)
+            data = data[position - data_start:] + reader.read(data_end, buffer_size)
+            data_start = position
+
+        cursor = position - data_start
+
+        if weak is None:
+            weak = weak_checksum(data[cursor: cursor + block_size])
+
+        index = None
+        if weak in signatures:
+            preferred_index = None
+            if runs and runs[-1][0] + runs[-1][2] * block_size == position:
+                preferred_index = runs[-1][1] + runs[-1][2]
+
+            index = signatures.find(weak, data[cursor: cursor + block_size], preferred_index)
+
+        if index is not None:
+            if runs and index == runs[-1][1] + runs[-1][2] \
+                    and position == runs[-1][0] + runs[-1][2] * block_size:
+                runs[-1][2] += 1
+            else:
+                runs.append([position, index, 1])
+
+            position += block_size
+            weak = None
+            continue
+
+        if position + block_size >= filesize:
+            break
+
+        weak = roll_weak_checksum(weak, data[cursor], data[cursor + block_size], block_size)
+        position += 1
+
+    return [tuple(run) for run in runs]
+
+
+def encode_runs(runs: List[Tuple[int, int, int]], int_size: int) -> bytes:
+    return b"".join(value.to_bytes(int_size, "big") for run in runs for value in run)
+
+
+def decode_runs(data: bytes, int_size: int) -> List[Tuple[int, int, int]]:
+    if len(data) % (3 * int_size) != 0:
+        raise Exception("Invalid delta")
+
+    values = [int.from_bytes(data[cursor: cursor + int_size], "big")
+        for cursor in range(0, len(data), int_size)]
+
+    return [tuple(values[i: i + 3]) for i in range(0, len(values), 3)]
@@ -1,19 +1,62 @@
+import io
 import os
+import mmap
+import queue
+import threading
+import collections.abc
+from collections import deque
+from typing import Deque, Dict, Tuple
 from hks_pylib.cryptography.hashes import HKSHash, SHA256
 
+from sft.cache import DigestCache
+
+
+# What is flushed to the disk when a received file is completed.
+FSYNC_NONE = "none"
+FSYNC_DATA = "data"  # file content only (fdatasync)
+FSYNC_FULL = "full"  # file content and metadata (fsync)
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_DATA, FSYNC_FULL)
+
+DEFAULT_WRITE_BEHIND_SIZE = 4  # chunks
+DEFAULT_STREAM_HISTORY_SIZE = 8  # chunks
+
 
 class File(object):
-    def __init__(self, filename: str) -> None:
+    def __init__(self, filename: str, hash_obj: HKSHash = None) -> None:
         self._filename = filename
         self._stream = None
 
+        # If hash_obj is given, the digest is computed while the data is
+        # streamed instead of reading the file again in digest().
+        self._hash_obj = hash_obj
+        self._hashed_size = 0
+        self._digest: bytes = None
+
     def name(self):
         return self._filename
 
     def size(self):
         raise NotImplementedError()
 
-    def digest(self, hash_obj: HKSHash = SHA256(), buffer_size: int = 65535):
+    def digest(self,
+                hash_obj: HKSHash = None,
+                buffer_size: int = 65535,
+                cache: DigestCache = None
+            ):
+        if self._digest is not None:
+            return self._digest
+
+        # A new hash object for each call, concurrent sessions may hash files
+        # at the same time.
+        if hash_obj is None:
+            hash_obj = SHA256()
+
+        if cache is not None:
+            key = cache.key(self._filename, type(hash_obj).__name__)
+            digest = cache.get(key)
+            if digest is not None:
+                return digest
+
         hash_obj.reset()
         with open(self._filename, "rb") as stream:
             while True:
@@ -21,7 +64,13 @@ class File(object):
                 if not data:
                     break
                 hash_obj.update(data)
-        return hash_obj.finalize()
+        digest = hash_obj.finalize()
+
+        # Don't cache the digest of a file which was modified while hashing.
+        if cache is not None and cache.key(self._filename, type(hash_obj).__name__) == key:
+            cache.put(key, digest)
+
+        return digest
 
     def close(self):
         if self._stream:
@@ -30,34 +79,438 @@ class File(object):
 
 
 class FileReader(File):
-    def __init__(self, filename: str) -> None:
-        super().__init__(filename)
+    def __init__(self, filename: str, hash_obj: HKSHash = None) -> None:
+        super().__init__(filename, hash_obj)
 
         if os.path.isfile(self._filename) is False:
             raise Exception("File not found")
 
-        self._stream = open(self._filename, "rb")
+        # Unbuffered, the chunks are read positionally into a single bytes
+        # object which becomes the packet payload as is.
+        self._stream = open(self._filename, "rb", buffering=0)
         self._filesize = os.path.getsize(filename)
+        self._position = 0
 
     def size(self):
         return self._filesize
 
     def read(self, start: int = None, length: int = None):
-        if start is not None:
-            self._stream.seek(start)
+        if start is None:
+            start = self._position
+
+        if length is None:
+            length = max(self._filesize - start, 0)
+
+        data = self._pread(start, length)
+        self._position = start + len(data)
+
+        if self._hash_obj is not None and self._digest is None:
+            self.__update_digest(start, data)
+
+        return data
+
+    def _pread(self, start: int, length: int) -> bytes:
+        if hasattr(os, "pread"):
+            return os.pread(self._stream.fileno(), length, start)
+
+        self._stream.seek(start)
         return self._stream.read(length)
 
+    def __update_digest(self, start: int, data: bytes, buffer_size: int = 65535):
+        # Chunks which are read ahead of the hashed part leave a gap, it is
+        # read again here so that the digest always covers the whole file.
+        while self._hashed_size < start:
+            gap = self._pread(self._hashed_size, min(buffer_size, start - self._hashed_size))
+            if not gap:
+                break
+            self._hash_obj.update(gap)
+            self._hashed_size += len(gap)
+
+        end = start + len(data)
+        if start <= self._hashed_size < end:
+            self._hash_obj.update(data[self._hashed_size - start:])
+            self._hashed_size = end
+
+        if self._hashed_size == self._filesize:
+            self._digest = self._hash_obj.finalize()
+
+    def streamed_digest(self):
+        """Return the digest computed while reading, or None if some parts of
+        the file have not been read yet."""
+        return self._digest
+
 
 class FileWriter(File):
-    def __init__(self, filename: str) -> None:
-        super().__init__(filename)
-        self._stream = open(self._filename, "wb")
+    def __init__(self,
+                    filename: str,
+                    hash_obj: HKSHash = None,
+                    offset: int = 0,
+                    truncate: bool = True
+                ) -> None:
+        """If offset is positive, the first offset bytes already in the file
+        (e.g. from an interrupted transfer) are kept and hashed again. If
+        truncate is False, the content of an existing file is kept (e.g.
+        several writers fill different ranges of the same file)."""
+        super().__init__(filename, hash_obj)
+
+        # Unbuffered, a chunk is in the OS as soon as write() returns, so
+        # the hashed prefix survives a crash of the process.
+        if offset > 0 or not truncate:
+            # Writers of the other ranges may create the file concurrently.
+            fd = os.open(self._filename, os.O_RDWR | os.O_CREAT, 0o666)
+            self._stream = open(fd, "r+b", buffering=0)
+        else:
+            self._stream = open(self._filename, "w+b", buffering=0)
+
         self._current_size = 0
+        self._position = 0
+
+        # Chunks written ahead of the hashed part (offset -> length).
+        self._unhashed_chunks: Dict[int, int] = {}
+
+        if offset > 0:
+            self.__restore(offset)
+
+    def __restore(self, size: int, buffer_size: int = 65535):
+        self._stream.seek(0)
+        while self._current_size < size:
+            data = self._stream.read(min(buffer_size, size - self._current_size))
+            if not data:
+                break
+
+            if self._hash_obj is not None:
+                self._hash_obj.update(data)
+                self._hashed_size += len(data)
+
+            self._current_size += len(data)
+
+        self._position = self._current_size
+
+    def write(self, data: bytes, offset: int = None):
+        if offset is None:
+            offset = self._position
+
+        self._stream.seek(offset)
+
+        written_nbytes = 0
+        view = memoryview(data)
+        while written_nbytes < len(data):
+            written_nbytes += self._stream.write(view[written_nbytes:])
 
-    def write(self, data: bytes):
-        written_nbytes = self._stream.write(data)
         self._current_size += written_nbytes
+        self._position = offset + written_nbytes
+
+        if self._hash_obj is not None:
+            self.__update_digest(offset, data)
+
         return written_nbytes
 
+    def __update_digest(self, offset: int, data: bytes):
+        if offset != self._hashed_size:
+            if offset > self._hashed_size:
+                self._unhashed_chunks[offset] = len(data)
+            return
+
+        self._hash_obj.update(data)
+        self._hashed_size += len(data)
+
+        # The gap is filled, the chunks written ahead are read back to hash.
+        while self._hashed_size in self._unhashed_chunks:
+            length = self._unhashed_chunks.pop(self._hashed_size)
+            self._stream.seek(self._hashed_size)
+            self._hash_obj.update(self._stream.read(length))
+            self._hashed_size += length
+
+    def hashed_size(self):
+        """Return the size of the prefix which is written and hashed."""
+        return self._hashed_size
+
+    def preallocate(self, size: int):
+        """Reserve the disk space of the whole file up front, if the platform
+        and the file system support it."""
+        if size <= 0 or not hasattr(os, "posix_fallocate"):
+            return
+
+        try:
+            os.posix_fallocate(self._stream.fileno(), 0, size)
+        except OSError:
+            pass
+
+    def flush(self, fsync: str = FSYNC_NONE):
+        self._stream.flush()
+
+        if fsync == FSYNC_DATA and hasattr(os, "fdatasync"):
+            os.fdatasync(self._stream.fileno())
+        elif fsync != FSYNC_NONE:
+            os.fsync(self._stream.fileno())
+
+    def digest(self, *args, **kwargs):
+        if self._hash_obj is not None and self._hashed_size == self._current_size:
+            if self._digest is None:
+                self._digest = self._hash_obj.finalize()
+
+            return self._digest
+
+        return super().digest(*args, **kwargs)
+
     def size(self):
         return self._current_size
+
+
+class BackgroundFileWriter(FileWriter):
+    """A FileWriter which queues the chunks to a writer thread, so that the
+    caller can go on receiving while the previous chunks are being written.
+
+    At most queue_size chunks are waiting at the same time, write() blocks
+    when the queue is full. A failure of the writer thread is raised by the
+    next write() or flush().
+    """
+    def __init__(self,
+                    filename: str,
+                    hash_obj: HKSHash = None,
+                    queue_size: int = DEFAULT_WRITE_BEHIND_SIZE,
+                    offset: int = 0,
+                    truncate: bool = True
+                ) -> None:
+        super().__init__(filename, hash_obj, offset, truncate)
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._accepted_size = self._current_size
+        self._accepted_position = self._position
+        self._error: Exception = None
+
+        self._thread = threading.Thread(target=self.__write_loop, daemon=True)
+        self._thread.start()
+
+    def __write_loop(self):
+        while True:
+            item = self._queue.get()
+
+            if item is not None and self._error is None:
+                try:
+                    super().write(*item)
+                except Exception as e:
+                    self._error = e
+
+            self._queue.task_done()
+
+            if item is None:
+                break
+
+    def __raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, data: bytes, offset: int = None):
+        self.__raise_error()
+
+        if offset is None:
+            offset = self._accepted_position
+
+        self._queue.put((data, offset))
+        self._accepted_size += len(data)
+        self._accepted_position = offset + len(data)
+
+        return len(data)
+
+    def flush(self, fsync: str = FSYNC_NONE):
+        self._queue.join()
+        self.__raise_error()
+
+        super().flush(fsync)
+
+    def digest(self, *args, **kwargs):
+        self._queue.join()
+
+        return super().digest(*args, **kwargs)
+
+    def size(self):
+        # The queued chunks are counted, they are written sooner or later.
+        return self._accepted_size
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+        super().close()
+
+
+class MappedFileReader(FileReader):
+    """A FileReader serving the chunks from a memory mapping of the file.
+
+    Random offsets don't go through a file position and concurrent sessions
+    serving the same file share its page cache pages.
+    """
+    def __init__(self, filename: str, hash_obj: HKSHash = None) -> None:
+        super().__init__(filename, hash_obj)
+
+        # Empty files can not be mapped, they are read normally.
+        self._mapping = None
+        if self._filesize > 0:
+            self._mapping = mmap.mmap(self._stream.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__advise(getattr(mmap, "MADV_SEQUENTIAL", None))
+
+    def __advise(self, option: int, start: int = 0, length: int = None):
+        if option is None or not hasattr(self._mapping, "madvise"):
+            return
+
+        # The start of the advised range must be aligned to a page.
+        aligned_start = start - start % mmap.PAGESIZE
+        if length is None:
+            length = self._filesize - aligned_start
+        else:
+            length = min(length + start - aligned_start, self._filesize - aligned_start)
+
+        if length > 0:
+            self._mapping.madvise(option, aligned_start, length)
+
+    def _pread(self, start: int, length: int) -> bytes:
+        if self._mapping is None:
+            return super()._pread(start, length)
+
+        data = self._mapping[start: start + length]
+
+        # Windows are usually served in order, prefetch the next chunk.
+        self.__advise(getattr(mmap, "MADV_WILLNEED", None), start + length, length)
+
+        return data
+
+    def close(self):
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+        super().close()
+
+
+class IterableStream(object):
+    """A readable object over an iterable of bytes, e.g. a generator."""
+    def __init__(self, iterable) -> None:
+        self._iterator = iter(iterable)
+        self._buffer = b""
+
+    def read(self, length: int) -> bytes:
+        while not self._buffer:
+            try:
+                self._buffer = bytes(next(self._iterator))
+            except StopIteration:
+                return b""
+
+        data, self._buffer = self._buffer[:length], self._buffer[length:]
+        return data
+
+
+def is_stream(source) -> bool:
+    """Return True if source can be opened by open_stream(). Only an
+    iterator is taken as an iterable of bytes, so that e.g. a list or a dict
+    is not mistaken for a stream."""
+    return isinstance(source, (bytes, bytearray, memoryview, collections.abc.Iterator)) \
+        or callable(getattr(source, "read", None))
+
+
+def open_stream(source):
+    """Return a readable object over a readable binary file object (e.g. the
+    stdout of a subprocess), a bytes-like buffer or an iterable of bytes."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+
+    if callable(getattr(source, "read", None)):
+        return source
+
+    try:
+        return IterableStream(source)
+    except TypeError:
+        raise Exception("Parameter stream must be a readable object, a bytes-like "
+                        "object or an iterable of bytes.")
+
+
+class StreamReader(File):
+    """A FileReader over a source which is read only once, sequentially, and
+    whose size is unknown until its end is reached.
+
+    The data is hashed as it is read. The last history_size chunks are kept,
+    so that a chunk which is required again can still be served.
+    """
+    def __init__(self,
+                    filename: str,
+                    source,
+                    hash_obj: HKSHash = None,
+                    history_size: int = DEFAULT_STREAM_HISTORY_SIZE
+                ) -> None:
+        super().__init__(filename, hash_obj if hash_obj is not None else SHA256())
+
+        self._source = open_stream(source)
+
+        self._position = 0
+        self._is_eof = False
+
+        self._history: Deque[Tuple[int, bytes]] = deque(maxlen=history_size)
+
+    def size(self):
+        """Return the size read so far, that is the size of the whole source
+        once is_eof() is True."""
+        return self._position
+
+    def is_eof(self):
+        return self._is_eof
+
+    def __read_source(self, length: int) -> bytes:
+        # Pipes and sockets may return less than asked before their end.
+        pieces = []
+        while length > 0 and not self._is_eof:
+            piece = self._source.read(length)
+            if not piece:
+                self._is_eof = True
+                break
+
+            pieces.append(piece)
+            length -= len(piece)
+
+        data = b"".join(pieces) if len(pieces) != 1 else bytes(pieces[0])
+
+        if data:
+            self._hash_obj.update(data)
+            self._history.append((self._position, data))
+            self._position += len(data)
+
+        if self._is_eof and self._digest is None:
+            self._digest = self._hash_obj.finalize()
+
+        return data
+
+    def read(self, start: int = None, length: int = None):
+        if start is None:
+            start = self._position
+
+        if length is None:
+            raise Exception("The length of a stream read must be given.")
+
+        if start < self._position:
+            for chunk_start, chunk in self._history:
+                if chunk_start <= start < chunk_start + len(chunk):
+                    return chunk[start - chunk_start: start - chunk_start + length]
+
+            raise Exception("Offset {} of the stream is not available anymore".format(start))
+
+        # The data before start is skipped, it stays in the history.
+        if start > self._position:
+            self.__read_source(start - self._position)
+
+        return self.__read_source(length)
+
+    def streamed_digest(self):
+        """Return the digest of the source, or None if its end is not reached
+        yet."""
+        return self._digest
+
+    def digest(self, *args, **kwargs):
+        if self._digest is None:
+            raise Exception("The digest of a stream is known at its end only.")
+
+        return self._digest
+
+    def close(self):
+        # The source belongs to the caller.
+        self._source = None
@@ -0,0 +1,93 @@
+import hashlib
+from typing import List
+
+from hks_pylib.cryptography.hashes import HKSHash, SHA256
+
+
+# Hash algorithm identifiers on the wire. HASH_SHA256 is the digest of
+# peers which don't negotiate the algorithm.
+HASH_SHA256 = 1
+HASH_BLAKE2B = 2
+HASH_BLAKE2S = 3
+HASH_SHA512_256 = 4
+
+HASH_ID_SIZE = 1  # bytes
+
+
+class HashlibHash(HKSHash):
+    """A HKSHash backed by hashlib, whose hash functions release the GIL
+    while hashing large buffers."""
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._hash = hashlib.new(name)
+
+    def update(self, msg: bytes) -> None:
+        self._hash.update(msg)
+
+    def finalize(self, msg: bytes = None) -> bytes:
+        if msg is not None:
+            self.update(msg)
+
+        return self._hash.digest()
+
+    def reset(self) -> None:
+        self._hash = hashlib.new(self._name)
+
+    @property
+    def digest_size(self) -> int:
+        return self._hash.digest_size
+
+
+# Each algorithm has its own class, the digest cache is keyed by the class
+# name.
+class BLAKE2b(HashlibHash):
+    def __init__(self) -> None:
+        super().__init__("blake2b")
+
+
+class BLAKE2s(HashlibHash):
+    def __init__(self) -> None:
+        super().__init__("blake2s")
+
+
+class SHA512_256(HashlibHash):
+    def __init__(self) -> None:
+        super().__init__("sha512_256")
+
+
+HASHES = {
+    "sha256": HASH_SHA256,
+    "blake2b": HASH_BLAKE2B,
+    "blake2s": HASH_BLAKE2S,
+    "sha512_256": HASH_SHA512_256
+}
+
+_HASH_CLASSES = {
+    HASH_SHA256: SHA256,
+    HASH_BLAKE2B: BLAKE2b,
+    HASH_BLAKE2S: BLAKE2s,
+    HASH_SHA512_256: SHA512_256
+}
+
+
+def get_hashes(names: List[str]) -> List[int]:
+    hashes = []
+    for name in names:
+        if name not in HASHES:
+            raise Exception("Unknown hash algorithm {} (expected one of {}).".format(name, list(HASHES)))
+
+        hashes.append(HASHES[name])
+
+    return hashes
+
+
+def new_hash(algorithm: int = HASH_SHA256) -> HKSHash:
+    """Return a new hash object of the algorithm."""
+    if algorithm not in _HASH_CLASSES:
+        raise Exception("Unknown hash algorithm {}".format(algorithm))
+
+    return _HASH_CLASSES[algorithm]()
+
+
+def get_digest_size(algorithm: int) -> int:
+    return new_hash(algorithm).digest_size
@@ -1,9 +1,20 @@
+import queue
+import socket
+import threading
+from typing import List
+
+from hks_pylib.done import Done
 from hks_pylib.logger import LoggerGenerator, Display
 from hks_pylib.logger import InvisibleLoggerGenerator
+from hks_pylib.logger.standard import StdUsers, StdLevels
 from hks_pylib.cryptography.ciphers.hkscipher import HKSCipher
 
 from csbuilder.server import Listener
+from hks_pynetwork.errors.internal import ChannelSlotError
 
+from sft.server import SFTServerResponser
+from sft.responser import rebind_session_hooks
+from sft.parallel import reserve_local_nodes, release_local_nodes
 from sft.protocol import DEFAULT_TIMEOUT
 from sft.protocol import DEFAULT_BUFFER_SIZE
 
@@ -12,19 +23,29 @@ from sft.protocol import SFTProtocols, SFTRoles
 from sft.protocol.receiver import SFTReceiverScheme
 
 
+DEFAULT_MAX_CONNECTIONS = 16  # connections open at the same time
+
+
 class SFTListener(Listener):
     def __init__(self,
                 cipher: HKSCipher,
                 address: tuple,
                 name: str = "SFTListener",
                 buffer_size: int = DEFAULT_BUFFER_SIZE,
+                max_connections: int = DEFAULT_MAX_CONNECTIONS,
                 logger_generator: LoggerGenerator = InvisibleLoggerGenerator(),
                 display: dict = {"dev": Display.ALL}
             ) -> None:
+        """The local nodes of max_connections connections are reserved while
+        the listener is listening (see sft.parallel.reserve_local_nodes), a
+        connection beyond them is closed right away."""
+        if not isinstance(max_connections, int) or max_connections <= 0:
+            raise Exception("Parameter max_connections must be a positive integer.")
 
         super().__init__(
                 address=address,
                 cipher=cipher,
+                responser_cls=SFTServerResponser,
                 name=name,
                 buffer_size=buffer_size,
                 logger_generator=logger_generator,
@@ -41,20 +62,126 @@ class SFTListener(Listener):
                 timeout=DEFAULT_TIMEOUT
             )
 
+        self._accepted_responsers: queue.Queue = queue.Queue()
+        self._accept_thread: threading.Thread = None
+
+        self._max_connections = max_connections
+        self._reserved_connections = 0
+
+    def listen(self, *args, **kwargs) -> None:
+        super().listen(*args, **kwargs)
+
+        reserve_local_nodes(self._max_connections)
+        self._reserved_connections = self._max_connections
+
 
     def construct_responser(self, socket, address):
-        responser = super().construct_responser(socket, address)
+        try:
+            responser = super().construct_responser(socket, address)
+        except ChannelSlotError:
+            # Too many connections are open.
+            socket.close()
+            raise
 
         forwarder = responser._forwarder.name
 
+        for role in (SFTRoles.SENDER, SFTRoles.RECEIVER):
+            rebind_session_hooks(responser.session_manager().get_session(SFTProtocols.SFT, role))
+
         responser.session_manager().get_scheme(
                 SFTProtocols.SFT,
                 SFTRoles.SENDER
-            ).config(forwarder=forwarder)
+            ).config(forwarder=forwarder, peer=address[0])
 
         responser.session_manager().get_scheme(
                 SFTProtocols.SFT,
                 SFTRoles.RECEIVER
-            ).config(forwarder=forwarder)
+            ).config(forwarder=forwarder, peer=address[0])
 
         return responser
+
+    def __accept_loop(self):
+        while True:
+            try:
+                self._accepted_responsers.put(self.accept(start_responser=True))
+            except socket.timeout:
+                continue
+            except ChannelSlotError:
+                self._print(StdUsers.DEV, StdLevels.WARNING, "Too many connections, "
+                "a connection is closed.")
+                continue
+            except Exception:
+                # The listener is closed.
+                break
+
+    def next_responser(self, timeout: float = DEFAULT_TIMEOUT) -> SFTServerResponser:
+        """Return the next connection, or None if no client connects in time.
+
+        The connections are accepted in the background as soon as they come,
+        so that they are never lost between two calls. The listener must be
+        listening.
+        """
+        if self._accept_thread is None:
+            self._accept_thread = threading.Thread(
+                    target=self.__accept_loop,
+                    name="Accept thread of {}".format(self._name),
+                    daemon=True
+                )
+            self._accept_thread.start()
+
+        try:
+            return self._accepted_responsers.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def accept_parts(self,
+                        role: SFTRoles,
+                        timeout: float = None,
+                        responser: SFTServerResponser = None
+                    ) -> List[Done]:
+        """Serve one transfer as the given role and return its results.
+
+        The client may split the transfer into parts sent over several
+        connections (see QSFTClient), the connections of the other parts are
+        served in parallel until all parts are done. If responser is given,
+        the first part comes over this connection and it is left open (e.g.
+        a kept-alive connection). The listener must be listening.
+        """
+        is_closed = responser is None
+        if responser is None:
+            responser = self.next_responser()
+
+        if responser is None:
+            return [Done(False, reason="No client connected")]
+
+        result = responser.wait_transfer_result(role, timeout)
+        if is_closed:
+            responser.close()
+
+        results = [result]
+
+        # The first part tells how many parts the client sends.
+        count = 1
+        if result.value and result.has("part"):
+            count = result.part[1]
+
+        while len(results) < count:
+            part_responser = self.next_responser()
+            if part_responser is None:
+                results.append(Done(False, reason="Missing connection of part {}".format(len(results))))
+                continue
+
+            results.append(part_responser.wait_transfer_result(role, timeout))
+            part_responser.close()
+
+        return results
+
+    def close(self) -> None:
+        super().close()
+
+        release_local_nodes(self._reserved_connections)
+        self._reserved_connections = 0
+
+        # The connections which were accepted but never served.
+        while not self._accepted_responsers.empty():
+            self._accepted_responsers.get().close()
@@ -0,0 +1,69 @@
+import os
+import json
+
+
+class PartialManifest(object):
+    """The state of a partial transfer.
+
+    It is kept next to the temporary file of the transfer, so that a later
+    session receiving the same file (same name, digest and size) continues
+    from the verified offset instead of starting over.
+    """
+    def __init__(self,
+                    path: str,
+                    file_path: str,
+                    digest: bytes,
+                    filesize: int,
+                    verified: int = 0
+                ) -> None:
+        self.path = path
+        self.file_path = file_path
+        self.digest = digest
+        self.filesize = filesize
+
+        # The size of the prefix of file_path which is written and hashed.
+        self.verified = verified
+
+    @staticmethod
+    def get_path(directory: str, filename: str, digest: bytes) -> str:
+        return os.path.join(directory, ".{}.{}.manifest".format(filename, digest.hex()[:16]))
+
+    @staticmethod
+    def load(path: str):
+        """Return the manifest stored in path, or None if there is no usable
+        manifest."""
+        try:
+            with open(path, "r") as stream:
+                content = json.load(stream)
+
+            return PartialManifest(
+                    path,
+                    content["file_path"],
+                    bytes.fromhex(content["digest"]),
+                    content["filesize"],
+                    content["verified"]
+                )
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def match(self, digest: bytes, filesize: int) -> bool:
+        return self.digest == digest and self.filesize == filesize \
+            and os.path.isfile(self.file_path)
+
+    def save(self):
+        content = {
+            "file_path": self.file_path,
+            "digest": self.digest.hex(),
+            "filesize": self.filesize,
+            "verified": self.verified
+        }
+
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as stream:
+            json.dump(content, stream)
+
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -0,0 +1,246 @@
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+
+# The phases of a transfer which are timed.
+PHASE_DIGEST = "digest"  # hashing the file before it is sent
+PHASE_READ = "read"  # reading the chunks (and hashing them while streaming)
+PHASE_WRITE = "write"  # writing the chunks (and hashing them while streaming)
+PHASE_COMPRESSION = "compression"  # compressing or decompressing the chunks
+PHASE_DELTA = "delta"  # computing signatures, matching and copying blocks
+PHASE_VERIFY = "verify"  # flushing and checking the received file
+PHASE_CRYPTO = "crypto"  # encrypting and decrypting the packets
+PHASE_THROTTLE = "throttle"  # waiting for the rate limiter
+PHASE_ADMISSION = "admission"  # waiting for the scheduler to admit the transfer
+PHASE_WAIT = "wait"  # the rest, mostly waiting on the network and the peer
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)  # seconds
+
+
+class Stopwatch(object):
+    """Accumulate the time spent in the measured blocks, the blocks may run
+    in several threads."""
+    def __init__(self) -> None:
+        self._total = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._total += seconds
+
+    def take(self) -> float:
+        """Return the time accumulated since the last call."""
+        with self._lock:
+            total, self._total = self._total, 0.0
+
+        return total
+
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(time.perf_counter() - start)
+
+
+class TransferMetrics(object):
+    """The metrics of a single transfer, collected by the SFT schemes."""
+    def __init__(self, role: str) -> None:
+        self.role = role
+
+        self.bytes = 0  # bytes of the file which are transferred
+        self.wire_bytes = 0  # bytes of the SEND payloads, once compressed
+        self.chunks = 0
+        self.retries = 0
+        self.success = False
+
+        self._phases: Dict[str, float] = {}
+        self._start_time: float = None
+        self._end_time: float = None
+
+    def start(self):
+        self._start_time = time.perf_counter()
+
+    def stop(self):
+        if self._start_time is not None and self._end_time is None:
+            self._end_time = time.perf_counter()
+
+    def is_started(self) -> bool:
+        return self._start_time is not None
+
+    def elapsed(self) -> float:
+        if self._start_time is None:
+            return 0.0
+
+        end_time = self._end_time if self._end_time is not None else time.perf_counter()
+        return end_time - self._start_time
+
+    def add_time(self, phase: str, seconds: float):
+        self._phases[phase] = self._phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def measure(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def phases(self) -> Dict[str, float]:
+        """Return the seconds spent in each phase, the time which isn't
+        measured is counted as waiting."""
+        phases = dict(self._phases)
+        phases[PHASE_WAIT] = max(0.0, self.elapsed() - sum(self._phases.values()))
+
+        return phases
+
+    def to_dict(self) -> dict:
+        return {
+            "role": self.role,
+            "success": self.success,
+            "seconds": self.elapsed(),
+            "bytes": self.bytes,
+            "wire_bytes": self.wire_bytes,
+            "chunks": self.chunks,
+            "retries": self.retries,
+            "phases": self.phases()
+        }
+
+
+def merge_metrics(metrics_list: List[dict]) -> dict:
+    """Merge the metrics (see TransferMetrics.to_dict) of the parts of a
+    parallel transfer, the parts run at the same time."""
+    merged = {
+        "role": metrics_list[0]["role"],
+        "success": all(metrics["success"] for metrics in metrics_list),
+        "seconds": max(metrics["seconds"] for metrics in metrics_list),
+        "phases": {}
+    }
+
+    for key in ("bytes", "wire_bytes", "chunks", "retries"):
+        merged[key] = sum(metrics[key] for metrics in metrics_list)
+
+    for metrics in metrics_list:
+        for phase, seconds in metrics["phases"].items():
+            merged["phases"][phase] = merged["phases"].get(phase, 0.0) + seconds
+
+    return merged
+
+
+class MetricsSink(object):
+    """Receive the metrics of every transfer once it ends, successfully or
+    not. A sink is shared by all sessions which are cloned from the same
+    scheme, record() may be called by several threads at the same time and
+    must not raise."""
+    def record(self, metrics: TransferMetrics):
+        raise NotImplementedError()
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class PrometheusMetricsSink(MetricsSink):
+    """Aggregate the metrics of the transfers into counters and histograms,
+    expose() returns them in the Prometheus text format to be scraped."""
+    def __init__(self, buckets: Tuple[float] = DEFAULT_BUCKETS, prefix: str = "sft") -> None:
+        self._buckets = tuple(sorted(buckets))
+        self._prefix = prefix
+
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+
+        # (name, labels) -> [count of each bucket, sum, count]
+        self._histograms: Dict[Tuple[str, Tuple], List] = {}
+
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * len(self._buckets), 0.0, 0]
+                self._histograms[key] = histogram
+
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+
+            histogram[1] += value
+            histogram[2] += 1
+
+    def record(self, metrics: TransferMetrics):
+        result = "success" if metrics.success else "failure"
+
+        self.inc("transfers_total", role=metrics.role, result=result)
+        self.inc("bytes_total", metrics.bytes, role=metrics.role)
+        self.inc("wire_bytes_total", metrics.wire_bytes, role=metrics.role)
+        self.inc("chunks_total", metrics.chunks, role=metrics.role)
+        self.inc("retries_total", metrics.retries, role=metrics.role)
+
+        self.observe("transfer_duration_seconds", metrics.elapsed(), role=metrics.role)
+        for phase, seconds in metrics.phases().items():
+            self.observe("phase_duration_seconds", seconds, role=metrics.role, phase=phase)
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name: str, **labels) -> dict:
+        """Return the cumulative count of each bucket, the sum and the count
+        of the observed values."""
+        with self._lock:
+            histogram = self._histograms.get((name, tuple(sorted(labels.items()))))
+            if histogram is None:
+                return {"buckets": {bound: 0 for bound in self._buckets}, "sum": 0.0, "count": 0}
+
+            return {
+                "buckets": dict(zip(self._buckets, histogram[0])),
+                "sum": histogram[1],
+                "count": histogram[2]
+            }
+
+    def __format_name(self, name: str, labels: Tuple, extra_label: Tuple = None) -> str:
+        if extra_label is not None:
+            labels = labels + (extra_label,)
+
+        name = "{}_{}".format(self._prefix, name)
+        if not labels:
+            return name
+
+        return "{}{{{}}}".format(name, ",".join('{}="{}"'.format(key, value) for key, value in labels))
+
+    def expose(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append("# TYPE {}_{} counter".format(self._prefix, name))
+                for (counter_name, labels), value in sorted(self._counters.items()):
+                    if counter_name == name:
+                        lines.append("{} {}".format(self.__format_name(name, labels), value))
+
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append("# TYPE {}_{} histogram".format(self._prefix, name))
+                for (histogram_name, labels), histogram in sorted(self._histograms.items()):
+                    if histogram_name != name:
+                        continue
+
+                    for bound, count in zip(self._buckets, histogram[0]):
+                        lines.append("{} {}".format(
+                            self.__format_name(name + "_bucket", labels, ("le", bound)), count))
+
+                    lines.append("{} {}".format(
+                        self.__format_name(name + "_bucket", labels, ("le", "+Inf")), histogram[2]))
+                    lines.append("{} {}".format(self.__format_name(name + "_sum", labels), histogram[1]))
+                    lines.append("{} {}".format(self.__format_name(name + "_count", labels), histogram[2]))
+
+        return "\n".join(lines) + "\n"
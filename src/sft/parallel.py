@@ -0,0 +1,105 @@
+import time
+import contextlib
+from typing import List
+
+from hks_pylib.done import Done
+from hks_pynetwork.internal import LocalNode
+
+from sft.file import File
+from sft.hashes import new_hash
+from sft.metrics import merge_metrics, PHASE_VERIFY
+
+
+NODES_PER_CONNECTION = 2  # the responser node and its forwarder
+
+# The limit of the local nodes which is not reserved by any connection, and
+# the number of the connections reserved on top of it.
+_base_max_nodes = LocalNode.MAX_NODES
+_reserved_connections = 0
+
+
+def _close_local_node(node: LocalNode, close=LocalNode.close):
+    """LocalNode.close() looks up the slot of the node and deletes it from the
+    shared lists of the nodes without the lock, two nodes closing at the same
+    time (e.g. the parts of a parallel transfer) may delete the slot of a
+    third one. The slots are deleted under the lock of the lists."""
+    with LocalNode.lock:
+        close(node)
+
+
+LocalNode.close = _close_local_node
+
+
+def reserve_local_nodes(connections: int):
+    """Make room for the local nodes of more connections.
+
+    The local nodes of a process are limited (LocalNode.MAX_NODES) and each
+    connection takes some of them, the limit is raised for the extra
+    connections (e.g. of parallel transfers). The room must be given back
+    with release_local_nodes() once the connections are closed, see
+    local_nodes().
+    """
+    global _reserved_connections
+
+    with LocalNode.lock:
+        _reserved_connections += connections
+        LocalNode.MAX_NODES = _base_max_nodes + _reserved_connections * NODES_PER_CONNECTION
+
+
+def release_local_nodes(connections: int):
+    reserve_local_nodes(-connections)
+
+
+@contextlib.contextmanager
+def local_nodes(connections: int):
+    """Reserve the local nodes of the connections while the context runs."""
+    reserve_local_nodes(connections)
+    try:
+        yield
+    finally:
+        release_local_nodes(connections)
+
+
+def merge_results(results: List[Done], verify: bool = False) -> Done:
+    """Merge the results of the parts of a parallel transfer into the result
+    of the whole transfer.
+
+    The receiver of the parts checks the digest of the whole file here
+    (verify=True), each part alone can't be checked.
+    """
+    if not results:
+        return Done(False, reason="No part is transferred")
+
+    # Not a parallel transfer.
+    if len(results) == 1 and not results[0].has("part"):
+        return results[0]
+
+    for result in results:
+        if not result.value:
+            return result
+
+    info = {"filename": results[0].filename}
+
+    # The metrics of the parts, legacy peers don't give them.
+    metrics_list = [result.metrics for result in results if result.has("metrics")]
+    if metrics_list:
+        info["metrics"] = merge_metrics(metrics_list)
+
+    if verify:
+        path = results[0].path
+        if any(result.path != path for result in results):
+            return Done(False, reason="The parts are written into different files")
+
+        info["path"] = path
+
+        verify_start = time.perf_counter()
+        if File(path).digest(new_hash(results[0].hash)) != results[0].digest:
+            return Done(False, reason="Integrity is compromised")
+
+        if metrics_list:
+            verify_time = time.perf_counter() - verify_start
+            info["metrics"]["seconds"] += verify_time
+            info["metrics"]["phases"][PHASE_VERIFY] = \
+                info["metrics"]["phases"].get(PHASE_VERIFY, 0.0) + verify_time
+
+    return Done(True, **info)
@@ -1,3 +1,5 @@
+from typing import Dict, Tuple
+
 from sft.protocol.definition import SFTRoles
 from sft.protocol.definition import SFTProtocols
 
@@ -7,5 +9,136 @@ DEFAULT_TOKEN_LIST = ["default", "default1"]
 DEFAULT_FILE_LIST = ["tests/file.10MB", "tests/file.500MB"]
 
 DEFAULT_INT_SIZE = 4  # bytes
+LONG_INT_SIZE = 8  # bytes
 DEFAULT_TIMEOUT = 60  # seconds
-DEFAULT_BUFFER_SIZE = 10 ** 7  # bytes
\ No newline at end of file
+DEFAULT_BUFFER_SIZE = 10 ** 7  # bytes
+DEFAULT_WINDOW_SIZE = 4  # chunks
+
+# Version 1 is the original wire format (32-bit offsets and sizes), it is
+# assumed whenever the peer doesn't announce a version.
+# Version 2 uses 64-bit offsets and sizes.
+# Version 3 allows the sender to announce the digest in a trailing DIGEST
+# packet instead of INFO.
+# Version 4 allows the receiver to send the SIGNATURE of its old copy of the
+# file, the sender answers with the DELTA of blocks which can be reused.
+# Version 5 allows the sender to send a stream whose size is unknown, the
+# size comes in the option field of the trailing DIGEST packet.
+# Version 6 allows the receiver to check each block of the file against a
+# chunk tree announced by the sender (INFO and HASHES).
+# Version 7 negotiates the hash algorithm of the digest, its id follows the
+# digest size in the payload of INFO.
+LEGACY_VERSION = 1
+TRAILING_DIGEST_VERSION = 3
+DELTA_VERSION = 4
+STREAM_VERSION = 5
+CHUNK_TREE_VERSION = 6
+HASH_VERSION = 7
+PROTOCOL_VERSION = 7
+VERSION_SIZE = 1  # bytes
+
+# Negotiated options follow the version in the option field of REQUEST,
+# ACCEPT and INFO packets, each one is encoded as type, length and value.
+# Peers ignore the options which they don't know.
+OPTION_TYPE_SIZE = 1  # bytes
+OPTION_LENGTH_SIZE = 2  # bytes
+
+# The codecs accepted by the receiver (REQUEST/ACCEPT), or the codec chosen
+# by the sender (INFO).
+OPTION_CODECS = 1
+
+# The part (index, count) of the file which is transferred, the transfer
+# is split into count parts sent over separate connections. The requester
+# announces it (REQUEST), the peer confirms it (ACCEPT/INFO).
+OPTION_PART = 2
+PART_FIELD_SIZE = 4  # bytes
+
+# The receiver accepts batches (REQUEST/ACCEPT), or the sender sends a batch
+# whose manifest follows the file size in the payload (INFO). The value is
+# empty.
+OPTION_BATCH = 3
+
+# The sender sends a stream (INFO), the file size and the digest in INFO are
+# empty, they come in the DIGEST packet once the end of the stream is read.
+# The value is empty.
+OPTION_STREAM = 4
+
+# The receiver checks the blocks of the file as they land (REQUEST/ACCEPT,
+# the value is empty), or the sender announces the block size and the
+# Merkle root of the hashes of the blocks (INFO), the hashes follow in a
+# HASHES packet.
+OPTION_CHUNK_TREE = 5
+
+# The hash algorithms accepted by the receiver for the digest (REQUEST/
+# ACCEPT), one byte each in order of preference. SHA256 is always accepted.
+OPTION_HASHES = 6
+
+
+def get_int_size(version: int) -> int:
+    """Return the size of offsets and file sizes in the given wire format."""
+    if version >= 2:
+        return LONG_INT_SIZE
+
+    return DEFAULT_INT_SIZE
+
+
+def get_version(option: bytes) -> int:
+    """Return the version announced in the option field of REQUEST, ACCEPT
+    or INFO packets. Legacy peers send an empty option field."""
+    if not option:
+        return LEGACY_VERSION
+
+    return int.from_bytes(option[0: VERSION_SIZE], "big")
+
+
+def encode_options(version: int, options: Dict[int, bytes]) -> bytes:
+    """Return the option field announcing the version and the options."""
+    data = [version.to_bytes(VERSION_SIZE, "big")]
+
+    for option_type, value in options.items():
+        data.append(option_type.to_bytes(OPTION_TYPE_SIZE, "big"))
+        data.append(len(value).to_bytes(OPTION_LENGTH_SIZE, "big"))
+        data.append(value)
+
+    return b"".join(data)
+
+
+def encode_part(part: Tuple[int, int]) -> bytes:
+    index, count = part
+    return index.to_bytes(PART_FIELD_SIZE, "big") + count.to_bytes(PART_FIELD_SIZE, "big")
+
+
+def decode_part(value: bytes) -> Tuple[int, int]:
+    if len(value) != 2 * PART_FIELD_SIZE:
+        raise Exception("Invalid part")
+
+    index = int.from_bytes(value[0: PART_FIELD_SIZE], "big")
+    count = int.from_bytes(value[PART_FIELD_SIZE:], "big")
+
+    if not 0 <= index < count:
+        raise Exception("Invalid part ({}/{})".format(index, count))
+
+    return index, count
+
+
+def get_part_range(filesize: int, part: Tuple[int, int]) -> Tuple[int, int]:
+    """Return the range [start, end) of the file covered by the part."""
+    index, count = part
+    return filesize * index // count, filesize * (index + 1) // count
+
+
+def get_options(option: bytes) -> Dict[int, bytes]:
+    """Return the options following the version in the option field."""
+    options = {}
+
+    cursor = VERSION_SIZE
+    while cursor + OPTION_TYPE_SIZE + OPTION_LENGTH_SIZE <= len(option):
+        option_type = int.from_bytes(option[cursor: cursor + OPTION_TYPE_SIZE], "big")
+        cursor += OPTION_TYPE_SIZE
+
+        length = int.from_bytes(option[cursor: cursor + OPTION_LENGTH_SIZE], "big")
+        cursor += OPTION_LENGTH_SIZE
+
+        options[option_type] = option[cursor: cursor + length]
+        cursor += length
+
+    return options
@@ -20,6 +20,9 @@ class SFTSenderStates(States):
     INFO = 2
     SEND = 3
     DENY = 4
+    DIGEST = 5
+    DELTA = 6
+    HASHES = 7
 
 
 @csbuilder.states(SFTProtocols.SFT, SFTRoles.RECEIVER)
@@ -31,3 +34,4 @@ class SFTReceiverStates(States):
     SUCCESS = 4
     FAILURE = 5
     REQUEST = 6
+    SIGNATURE = 7
@@ -1,18 +1,42 @@
 import os
 import time
-from typing import Callable
+from collections import deque
+from typing import Callable, Deque, Dict, List, Tuple
 
 import csbuilder
 
 from hks_pylib.done import Done
 from hks_pylib.hksenum import HKSEnum
+from hks_pylib.cryptography.hashes import SHA256
 
 from csbuilder.cspacket import CSPacket
-from csbuilder.scheme import Scheme, SchemeResult
-
-from sft.file import FileWriter
+from csbuilder.scheme import SchemeResult
+
+from sft.file import FileWriter, BackgroundFileWriter
+from sft.file import FSYNC_NONE, FSYNC_POLICIES
+from sft.manifest import PartialManifest
+from sft.batch import BatchManifest, BatchWriter
+from sft.sink import Sink, SinkWriter, get_sink
+from sft.store import ContentStore
+from sft.tree import ChunkTree, BlockVerifier
+from sft.hashes import HASH_SHA256, HASH_ID_SIZE, get_hashes, new_hash
+from sft.adaptive import ChunkSizer, DEFAULT_MIN_CHUNK_SIZE, DEFAULT_MAX_CHUNK_SIZE
+from sft.metrics import MetricsSink, TransferMetrics
+from sft.metrics import PHASE_WRITE, PHASE_COMPRESSION, PHASE_DELTA, PHASE_VERIFY, PHASE_THROTTLE
+from sft.metrics import PHASE_ADMISSION
+from sft.ratelimit import RateLimiter, Throttle
+from sft.scheduler import TransferScheduler, Slot
+from sft.delta import Signatures, get_block_size, decode_runs
+from sft.compression import CODEC_NONE, CODEC_SIZE, get_codecs, decompress
 from sft.protocol import DEFAULT_INT_SIZE
-from sft.protocol import DEFAULT_BUFFER_SIZE, DEFAULT_TOKEN
+from sft.protocol import LEGACY_VERSION, PROTOCOL_VERSION, TRAILING_DIGEST_VERSION, DELTA_VERSION
+from sft.protocol import STREAM_VERSION, CHUNK_TREE_VERSION, HASH_VERSION
+from sft.protocol import get_int_size, get_version, encode_options, get_options
+from sft.protocol import OPTION_CODECS, OPTION_PART, OPTION_BATCH, OPTION_STREAM, OPTION_CHUNK_TREE
+from sft.protocol import OPTION_HASHES
+from sft.protocol import encode_part, decode_part, get_part_range
+from sft.protocol.scheme import SFTScheme
+from sft.protocol import DEFAULT_BUFFER_SIZE, DEFAULT_TOKEN, DEFAULT_WINDOW_SIZE
 from sft.protocol.definition import SFTSenderStates, SFTProtocols, SFTRoles
 
 
@@ -20,6 +44,8 @@ class ReceiverStep(HKSEnum):
     NONE = "none"
     REQUESTING = "requesting"
     ACCEPTED = "accepted"
+    COMPARING = "comparing"
+    HASHING = "hashing"
     RECEIVING = "receiving"
 
 
@@ -27,7 +53,7 @@ DEFAULT_RECV_DIRECTORY = "./"
 
 
 @csbuilder.scheme(SFTProtocols.SFT, SFTRoles.RECEIVER, SFTSenderStates.REQUEST)
-class SFTReceiverScheme(Scheme):
+class SFTReceiverScheme(SFTScheme):
     DEFAULT_NTRIES = 3
 
     def __init__(self, forwarder: str = None) -> None:
@@ -40,6 +66,79 @@ class SFTReceiverScheme(Scheme):
         self._detoken_fn: Callable = lambda x: x
 
         self._buffer_size = DEFAULT_BUFFER_SIZE
+        self._window_size = DEFAULT_WINDOW_SIZE
+
+        # Adapt the size of the required chunks to the measured throughput
+        # and round trip time, within [min_buffer_size, max_buffer_size].
+        self._adaptive = False
+        self._min_buffer_size = DEFAULT_MIN_CHUNK_SIZE
+        self._max_buffer_size = DEFAULT_MAX_CHUNK_SIZE
+        self._sizer: ChunkSizer = None
+
+        # The number of chunks queued to a background writer, 0 means the
+        # chunks are written synchronously.
+        self._write_behind = 0
+        self._preallocate = False
+        self._fsync = FSYNC_NONE
+
+        # Keep a manifest of partial transfers and resume them later.
+        self._resume = False
+        self._manifest: PartialManifest = None
+
+        # Reuse the blocks of an old copy of the file in the directory.
+        self._delta = False
+        self._delta_path: str = None
+        self._delta_block_size: int = None
+
+        # Take the files whose digest is already known from a local store
+        # instead of receiving them, and store the received files.
+        self._store: ContentStore = None
+
+        # Ask the sender for the hashes of the blocks of the file, check each
+        # chunk as it lands and require the corrupted blocks again.
+        self._chunk_tree = False
+        self._tree_block_size: int = None
+        self._tree_root: bytes = None
+        self._verifier: BlockVerifier = None
+        self._block_retries: Dict[int, int] = {}
+
+        # The codecs accepted for SEND payloads, and the one chosen by the
+        # sender for the current transfer.
+        self._codecs: List[int] = []
+        self._codec = CODEC_NONE
+
+        # The hash algorithms accepted for the digest besides SHA256, and the
+        # one chosen by the sender for the current transfer.
+        self._hashes: List[int] = []
+        self._hash = HASH_SHA256
+
+        self._metrics_sink: MetricsSink = None
+        self._metrics = TransferMetrics("receiver")
+
+        # Limit the bandwidth of the transfers (see sft.ratelimit), the
+        # share of a transfer is proportional to weight. The peer is the
+        # host at the other end of the connection.
+        self._rate_limiter: RateLimiter = None
+        self._weight = 1
+        self._peer: str = None
+        self._throttle: Throttle = None
+
+        # Admit the transfers requested by the peer by priority (see
+        # sft.scheduler), the slot is held until the transfer ends.
+        self._scheduler: TransferScheduler = None
+        self._slot: Slot = None
+
+        # The admission of the next request and its waiting time, when the
+        # engine admits it before it is answered (see
+        # get_admission_priority()), and the token resolved for it.
+        self._admission: Tuple[Slot, float] = None
+        self._detoken_result: Tuple[str, object] = None
+
+        # Pass the received data to a sink instead of writing it into the
+        # directory, the sink given to activation() is used for that
+        # transfer only.
+        self._sink: Sink = None
+        self._transfer_sink: Sink = None
 
         self._step = ReceiverStep.NONE
 
@@ -47,6 +146,26 @@ class SFTReceiverScheme(Scheme):
         self._expected_filesize: int = None
         self._expected_digest: bytes = None
 
+        # The part (index, count) of the file received in this session, and
+        # the range [start, end) which it covers. The end of a stream is None
+        # until the sender reaches it.
+        self._part: Tuple[int, int] = None
+        self._range_start: int = 0
+        self._range_end: int = None
+
+        # The files of the batch received in this session, if any.
+        self._batch: BatchManifest = None
+
+        self._version = LEGACY_VERSION
+        self._int_size = get_int_size(LEGACY_VERSION)
+
+        # The window granted by the sender, it is None until the sender
+        # answers (legacy senders never do, so only one REQUIRE is in flight).
+        self._granted_window_size: int = None
+        self._next_offset: int = 0
+        self._missing_ranges: Deque[Tuple[int, int]] = deque()
+        self._outstanding_ranges: Dict[int, int] = {}
+
         self._remain_ntries = self.DEFAULT_NTRIES
 
         self._info = {}
@@ -55,6 +174,25 @@ class SFTReceiverScheme(Scheme):
         directory = kwargs.pop("directory", None)
         detoken = kwargs.pop("detoken", None)
         buffer_size = kwargs.pop("buffer_size", None)
+        window_size = kwargs.pop("window_size", None)
+        adaptive = kwargs.pop("adaptive", None)
+        min_buffer_size = kwargs.pop("min_buffer_size", None)
+        max_buffer_size = kwargs.pop("max_buffer_size", None)
+        write_behind = kwargs.pop("write_behind", None)
+        preallocate = kwargs.pop("preallocate", None)
+        fsync = kwargs.pop("fsync", None)
+        resume = kwargs.pop("resume", None)
+        delta = kwargs.pop("delta", None)
+        compression = kwargs.pop("compression", None)
+        hashes = kwargs.pop("hashes", None)
+        store = kwargs.pop("store", None)
+        chunk_tree = kwargs.pop("chunk_tree", None)
+        metrics_sink = kwargs.pop("metrics_sink", None)
+        rate_limiter = kwargs.pop("rate_limiter", None)
+        weight = kwargs.pop("weight", None)
+        peer = kwargs.pop("peer", None)
+        scheduler = kwargs.pop("scheduler", None)
+        sink = kwargs.pop("sink", None)
         forwarder = kwargs.pop("forwarder", None)
 
         if kwargs:
@@ -75,6 +213,120 @@ class SFTReceiverScheme(Scheme):
 
             self._buffer_size = buffer_size
 
+        if window_size:
+            if not isinstance(window_size, int) or window_size <= 0:
+                raise Exception("Window size must be a positive integer.")
+
+            self._window_size = window_size
+
+        if adaptive is not None:
+            if not isinstance(adaptive, bool):
+                raise Exception("Parameter adaptive must be a bool.")
+
+            self._adaptive = adaptive
+
+        if min_buffer_size:
+            if not isinstance(min_buffer_size, int) or min_buffer_size <= 0:
+                raise Exception("Parameter min_buffer_size must be a positive integer.")
+
+            self._min_buffer_size = min_buffer_size
+
+        if max_buffer_size:
+            if not isinstance(max_buffer_size, int) or max_buffer_size <= 0:
+                raise Exception("Parameter max_buffer_size must be a positive integer.")
+
+            self._max_buffer_size = max_buffer_size
+
+        if self._min_buffer_size > self._max_buffer_size:
+            raise Exception("Parameter min_buffer_size must not exceed max_buffer_size.")
+
+        if write_behind is not None:
+            if not isinstance(write_behind, int) or write_behind < 0:
+                raise Exception("Parameter write_behind must be a non-negative integer.")
+
+            self._write_behind = write_behind
+
+        if preallocate is not None:
+            if not isinstance(preallocate, bool):
+                raise Exception("Parameter preallocate must be a bool.")
+
+            self._preallocate = preallocate
+
+        if fsync is not None:
+            if fsync not in FSYNC_POLICIES:
+                raise Exception("Parameter fsync must be one of {}.".format(FSYNC_POLICIES))
+
+            self._fsync = fsync
+
+        if resume is not None:
+            if not isinstance(resume, bool):
+                raise Exception("Parameter resume must be a bool.")
+
+            self._resume = resume
+
+        if delta is not None:
+            if not isinstance(delta, bool):
+                raise Exception("Parameter delta must be a bool.")
+
+            self._delta = delta
+
+        if compression is not None:
+            if not isinstance(compression, (list, tuple)):
+                raise Exception("Parameter compression must be a list of codec names.")
+
+            self._codecs = get_codecs(compression)
+
+        if hashes is not None:
+            if not isinstance(hashes, (list, tuple)):
+                raise Exception("Parameter hashes must be a list of hash algorithm names.")
+
+            self._hashes = get_hashes(hashes)
+
+        if store:
+            if not isinstance(store, ContentStore):
+                raise Exception("Parameter store must be a ContentStore.")
+
+            self._store = store
+
+        if chunk_tree is not None:
+            if not isinstance(chunk_tree, bool):
+                raise Exception("Parameter chunk_tree must be a bool.")
+
+            self._chunk_tree = chunk_tree
+
+        if metrics_sink:
+            if not isinstance(metrics_sink, MetricsSink):
+                raise Exception("Parameter metrics_sink must be a MetricsSink.")
+
+            self._metrics_sink = metrics_sink
+
+        if rate_limiter:
+            if not isinstance(rate_limiter, RateLimiter):
+                raise Exception("Parameter rate_limiter must be a RateLimiter.")
+
+            self._rate_limiter = rate_limiter
+
+        if weight is not None:
+            if not isinstance(weight, (int, float)) or weight <= 0:
+                raise Exception("Parameter weight must be a positive number.")
+
+            self._weight = weight
+
+        if peer is not None:
+            if not isinstance(peer, str):
+                raise Exception("Parameter peer must be a str.")
+
+            self._peer = peer
+
+        if scheduler:
+            if not isinstance(scheduler, TransferScheduler):
+                raise Exception("Parameter scheduler must be a TransferScheduler.")
+
+            self._scheduler = scheduler
+
+        if sink is not None:
+            self._sink = get_sink(sink)
+
         if detoken:
             if not callable(detoken):
                 raise Exception("Paramameter tokens must be a Callable.")
@@ -92,30 +344,177 @@ class SFTReceiverScheme(Scheme):
 
         if self._file:
             self._file.close()
+
+            # Remember how far the transfer went for the next session.
+            if self._manifest is not None:
+                self.__save_manifest()
+
             self._file = None
 
+        self._manifest = None
+
+        self._delta_path = None
+        self._delta_block_size = None
+
+        self._codec = CODEC_NONE
+
+        self._hash = HASH_SHA256
+
+        self._tree_block_size = None
+        self._tree_root = None
+        self._verifier = None
+        self._block_retries.clear()
+
         self._expected_filesize = None
         self._expected_digest = None
 
+        self._part = None
+        self._range_start = 0
+        self._range_end = None
+
+        self._batch = None
+
+        self._transfer_sink = None
+
+        self._version = LEGACY_VERSION
+        self._int_size = get_int_size(LEGACY_VERSION)
+
+        self._granted_window_size = None
+        self._next_offset = 0
+        self._missing_ranges.clear()
+        self._outstanding_ranges.clear()
+
+        self._sizer = None
+
+        if self._throttle is not None:
+            self._throttle.close()
+            self._throttle = None
+
+        if self._slot is not None:
+            self._slot.release()
+            self._slot = None
+
+        # The request was denied before its admission was taken.
+        if self._admission is not None:
+            if self._admission[0] is not None:
+                self._admission[0].release()
+            self._admission = None
+
+        self._detoken_result = None
+
         self._remain_ntries = self.DEFAULT_NTRIES
 
         self._info = {}
 
+        metrics, self._metrics = self._metrics, TransferMetrics("receiver")
+
         super().cancel(*args, **kwargs)
+
+        if metrics.is_started():
+            metrics.stop()
+
+            if self._metrics_sink is not None:
+                self._metrics_sink.record(metrics)
+
+    def metrics(self) -> TransferMetrics:
+        """Return the metrics of the current transfer."""
+        return self._metrics
+
+    def scheduler(self) -> TransferScheduler:
+        return self._scheduler
+
+    def __get_throttle(self) -> Throttle:
+        """Return the share of the bandwidth of the current transfer, or None
+        if it is not limited."""
+        if self._rate_limiter is not None and self._throttle is None:
+            self._throttle = self._rate_limiter.open(self._peer, self._weight)
+
+        return self._throttle
+
+    def __throttle(self, nbytes: int):
+        throttle = self.__get_throttle()
+        if throttle is not None:
+            self._metrics.add_time(PHASE_THROTTLE, throttle.wait(nbytes))
+
+    def __admit(self, priority: int) -> bool:
+        """Wait for the scheduler to admit the transfer, return False if it
+        is not admitted in time."""
+        if self._admission is not None:
+            self._slot, admission_time = self._admission
+            self._admission = None
+            self._metrics.add_time(PHASE_ADMISSION, admission_time)
+        else:
+            with self._metrics.measure(PHASE_ADMISSION):
+                self._slot = self._scheduler.admit(priority)
+
+        if self._slot is None:
+            return False
+
+        self._info["priority"] = priority
+        return True
+
+    def __detoken(self, token: str):
+        if self._detoken_result is not None and self._detoken_result[0] == token:
+            value = self._detoken_result[1]
+        else:
+            value = self._detoken_fn(token)
+
+        self._detoken_result = None
+        return value
+
+    def get_admission_priority(self, packet: CSPacket) -> int:
+        """Return the priority of the transfer requested by packet if the
+        scheduler has to admit it, None otherwise.
+
+        admit() of the scheduler blocks the thread answering the request.
+        An engine which doesn't want that (see sft.aio) admits the transfer
+        itself, e.g. with admit_async(), and gives the slot with
+        set_admission() before the packet is answered.
+        """
+        if self._scheduler is None or self._step is not ReceiverStep.NONE \
+                or packet.state() != SFTSenderStates.REQUEST:
+            return None
+
+        try:
+            token = packet.payload().decode()
+            value = self._detoken_fn(token)
+            priority = self._scheduler.get_priority(token, value)
+        except Exception:
+            # The request is denied when it is answered.
+            return None
+
+        self._detoken_result = (token, value)
+        return priority
+
+    def set_admission(self, slot: Slot, admission_time: float):
+        """Give the slot of the next request (None if it was not admitted in
+        time) and the seconds it waited for it."""
+        self._admission = (slot, admission_time)
     
     
     @csbuilder.active_activation
-    def activation(self, token: str = DEFAULT_TOKEN):
+    def activation(self, token: str = DEFAULT_TOKEN, part: Tuple[int, int] = None, sink=None):
         if self._step is not ReceiverStep.NONE:
             return None, None
 
         if not isinstance(token, str):
             raise Exception("Parameter token must be a str.")
 
+        if sink is not None:
+            self._transfer_sink = get_sink(sink)
+
+        if part is not None:
+            if self.__get_sink() is not None:
+                raise Exception("A part can't be received into a sink.")
+
+            self._part = decode_part(encode_part(part))
+
         request_packet = self.generate_packet(self._states.REQUEST)
+        request_packet.option(encode_options(PROTOCOL_VERSION, self.__get_options()))
         request_packet.payload(token.encode())
 
         self._step = ReceiverStep.REQUESTING
+        self._metrics.start()
 
         return self._forwarder, request_packet
 
@@ -130,7 +529,8 @@ class SFTReceiverScheme(Scheme):
 
     @csbuilder.response(SFTSenderStates.DENY)
     def resp_deny(self, source: str, packet: CSPacket):
-        if self._step == ReceiverStep.REQUESTING:
+        if self._step in (ReceiverStep.REQUESTING, ReceiverStep.ACCEPTED, ReceiverStep.COMPARING,
+                            ReceiverStep.HASHING, ReceiverStep.RECEIVING):
             return SchemeResult(
                     None,
                     None,
@@ -143,12 +543,14 @@ class SFTReceiverScheme(Scheme):
     @csbuilder.response(SFTSenderStates.REQUEST)
     def resp_request(self, source: str, packet: CSPacket):
         if self._step is ReceiverStep.NONE:
+            self._metrics.start()
+
             deny_reason = None
             deny_packet = self.generate_packet(self._states.DENY)
 
             try:
                 recv_token = packet.payload().decode()
-                self._info["detoken_value"] = self._detoken_fn(recv_token)
+                self._info["detoken_value"] = self.__detoken(recv_token)
 
             except TimeoutError:
                 deny_packet.payload(b"Expired token")
@@ -157,6 +559,29 @@ class SFTReceiverScheme(Scheme):
                 deny_packet.payload(b"Invalid token")
                 deny_reason = "Invalid token ({})".format(e)
 
+            options = get_options(packet.option())
+            if not deny_reason and OPTION_PART in options:
+                try:
+                    self._part = decode_part(options[OPTION_PART])
+                except Exception as e:
+                    deny_packet.payload(b"Invalid part")
+                    deny_reason = "Invalid part ({})".format(e)
+
+                if not deny_reason and self.__get_sink() is not None:
+                    deny_packet.payload(b"Parallel transfer is not supported")
+                    deny_reason = "A part can't be received into a sink"
+
+            if not deny_reason and self._scheduler is not None:
+                try:
+                    priority = self._scheduler.get_priority(recv_token, self._info["detoken_value"])
+                except Exception as e:
+                    deny_packet.payload(b"Invalid token")
+                    deny_reason = "Invalid priority ({})".format(e)
+                else:
+                    if not self.__admit(priority):
+                        deny_packet.payload(b"Server busy")
+                        deny_reason = "Server busy"
+
             if deny_reason:
                 return SchemeResult(
                         source,
@@ -167,26 +592,133 @@ class SFTReceiverScheme(Scheme):
 
             self._step = ReceiverStep.ACCEPTED
 
+            version = min(get_version(packet.option()), PROTOCOL_VERSION)
+
             accept_packet = self.generate_packet(self._states.ACCEPT)
+            accept_packet.option(encode_options(version, self.__get_options()))
             return SchemeResult(source, accept_packet, True)
         else:
             return self.ignore(source, reason="Invalid step")
 
-    def __get_require_packet(self):
-        boffset = self._file.size().to_bytes(DEFAULT_INT_SIZE, "big")
-        bbuffer_size = self._buffer_size.to_bytes(DEFAULT_INT_SIZE, "big")
+    def __get_options(self):
+        options = {}
+
+        if self._codecs:
+            options[OPTION_CODECS] = bytes(self._codecs)
+
+        if self._hashes:
+            options[OPTION_HASHES] = bytes(self._hashes)
+
+        if self._part is not None:
+            options[OPTION_PART] = encode_part(self._part)
+        elif self.__get_sink() is None:
+            options[OPTION_BATCH] = b""
+
+        # The blocks of a part would be cut at the boundaries of the part.
+        if self._chunk_tree and self._part is None:
+            options[OPTION_CHUNK_TREE] = b""
+
+        return options
+
+    def __get_sink(self) -> Sink:
+        if self._transfer_sink is not None:
+            return self._transfer_sink
+
+        return self._sink
+
+    def __is_complete(self):
+        if self._range_end is None:
+            return False
+
+        return self._file.size() == self._range_end - self._range_start
+
+    def __get_buffer_size(self):
+        if self._sizer is not None:
+            buffer_size = self._sizer.size()
+        else:
+            buffer_size = self._buffer_size
+
+        # A throttled chunk is required in pieces which don't wait too long.
+        throttle = self.__get_throttle()
+        if throttle is not None and throttle.chunk_size() is not None:
+            buffer_size = min(buffer_size, throttle.chunk_size())
+
+        # A chunk made of whole blocks is checked as soon as it lands.
+        if self._verifier is not None:
+            block_size = self._tree_block_size
+            buffer_size = max(block_size, buffer_size - buffer_size % block_size)
+
+        return buffer_size
+
+    def __get_require_packet(self, offset: int, buffer_size: int):
+        if self._sizer is not None:
+            self._sizer.on_require(offset, buffer_size)
+
+        self.__throttle(buffer_size)
+
+        boffset = offset.to_bytes(self._int_size, "big")
+        bbuffer_size = buffer_size.to_bytes(self._int_size, "big")
+        bwindow_size = self._window_size.to_bytes(self._int_size, "big")
 
         packet = self.generate_packet(self._states.REQUIRE)
         packet.payload(boffset)
         packet.update_payload(bbuffer_size)
+        packet.update_payload(bwindow_size)
 
         return packet
 
+    def __next_require_packet(self):
+        chunk_size = self.__get_buffer_size()
+
+        if self._missing_ranges:
+            offset, buffer_size = self._missing_ranges.popleft()
+
+            # A gap larger than a chunk is required piece by piece.
+            if buffer_size > chunk_size:
+                self._missing_ranges.appendleft((offset + chunk_size, buffer_size - chunk_size))
+                buffer_size = chunk_size
+        elif self._range_end is None:
+            # The chunks of a stream are required until its end is known.
+            offset = self._next_offset
+            buffer_size = chunk_size
+            self._next_offset += buffer_size
+        elif self._next_offset < self._range_end:
+            offset = self._next_offset
+            buffer_size = min(chunk_size, self._range_end - offset)
+            self._next_offset += buffer_size
+        else:
+            return None
+
+        self._outstanding_ranges[offset] = buffer_size
+
+        return self.__get_require_packet(offset, buffer_size)
+
+    def __fill_window(self, source: str):
+        """Return the next REQUIRE packet and queue as many extra REQUIREs as
+        needed to keep the granted window full."""
+        window_size = self._granted_window_size or 1
+
+        require_packet = self.__next_require_packet()
+
+        while require_packet is not None and len(self._outstanding_ranges) < window_size:
+            extra_packet = self.__next_require_packet()
+            if extra_packet is None:
+                break
+
+            self.push_packet(source, extra_packet)
+
+        return require_packet
+
     @csbuilder.response(SFTSenderStates.INFO)
     def resp_info(self, source: str, packet: CSPacket):
         if self._step == ReceiverStep.ACCEPTED or self._step == ReceiverStep.REQUESTING:
             payload = packet.payload()
 
+            # The sender answers with the version it agreed on, a legacy
+            # sender answers nothing and uses the original format.
+            self._version = min(get_version(packet.option()), PROTOCOL_VERSION)
+            self._int_size = get_int_size(self._version)
+
             cursor = 0
 
             filename_size = int.from_bytes(payload[cursor: cursor + DEFAULT_INT_SIZE], "big")
@@ -198,11 +730,58 @@ class SFTReceiverScheme(Scheme):
             digest_size = int.from_bytes(payload[cursor: cursor + DEFAULT_INT_SIZE], "big")
             cursor += DEFAULT_INT_SIZE
 
+            if self._version >= HASH_VERSION:
+                self._hash = int.from_bytes(payload[cursor: cursor + HASH_ID_SIZE], "big")
+                cursor += HASH_ID_SIZE
+
+                if self._hash != HASH_SHA256 and self._hash not in self._hashes:
+                    reason = "Unsupported hash algorithm"
+                    failure_packet = self.generate_packet(self._states.FAILURE)
+                    failure_packet.payload(reason.encode())
+                    return SchemeResult(
+                            source,
+                            failure_packet,
+                            False,
+                            Done(False, reason=reason)
+                        )
+
             digest = payload[cursor: cursor + digest_size]
             cursor += digest_size
 
-            filesize = int.from_bytes(payload[cursor: cursor + DEFAULT_INT_SIZE], "big")
-            cursor += DEFAULT_INT_SIZE
+            filesize = int.from_bytes(payload[cursor: cursor + self._int_size], "big")
+            cursor += self._int_size
+
+            # The manifest of a batch takes the rest of the payload.
+            if OPTION_BATCH in get_options(packet.option()):
+                reason = None
+                manifest_data = payload[cursor:]
+                cursor = len(payload)
+
+                try:
+                    self._batch = BatchManifest.from_bytes(manifest_data, self._int_size)
+
+                    # The digest announced for a batch is the one of its
+                    # manifest, the files are checked one by one.
+                    hash_obj = SHA256()
+                    hash_obj.update(self._batch.to_bytes(DEFAULT_INT_SIZE))
+                    if hash_obj.finalize() != digest or self._batch.size() != filesize:
+                        reason = "Invalid manifest"
+                except Exception as e:
+                    reason = "Invalid manifest ({})".format(e)
+
+                # The receiver didn't accept a batch.
+                if not reason and self.__get_sink() is not None:
+                    reason = "A batch can't be received into a sink"
+
+                if reason:
+                    failure_packet = self.generate_packet(self._states.FAILURE)
+                    failure_packet.payload(b"Invalid manifest")
+                    return SchemeResult(
+                            source,
+                            failure_packet,
+                            False,
+                            Done(False, reason=reason)
+                        )
 
             if len(payload[cursor:]) > 0:
                 reason = "Too many parameters"
@@ -215,37 +794,439 @@ class SFTReceiverScheme(Scheme):
                         Done(False, reason=reason)
                     )
 
+            # The codec chosen by the sender for SEND payloads, if any.
+            codec = get_options(packet.option()).get(OPTION_CODECS, b"")
+            if codec:
+                self._codec = int.from_bytes(codec, "big")
+
+                if self._codec not in self._codecs:
+                    reason = "Unsupported codec"
+                    failure_packet = self.generate_packet(self._states.FAILURE)
+                    failure_packet.payload(reason.encode())
+                    return SchemeResult(
+                            source,
+                            failure_packet,
+                            False,
+                            Done(False, reason=reason)
+                        )
+
+            is_stream = OPTION_STREAM in get_options(packet.option())
+            if is_stream and (self._version < STREAM_VERSION or digest_size != 0 or filesize != 0):
+                reason = "Invalid stream"
+                failure_packet = self.generate_packet(self._states.FAILURE)
+                failure_packet.payload(reason.encode())
+                return SchemeResult(
+                        source,
+                        failure_packet,
+                        False,
+                        Done(False, reason=reason)
+                    )
+
+            tree_option = get_options(packet.option()).get(OPTION_CHUNK_TREE, None)
+            if tree_option is not None:
+                reason = None
+                if not self._chunk_tree or self._version < CHUNK_TREE_VERSION or is_stream \
+                        or self._part is not None or self._batch is not None:
+                    reason = "Invalid chunk tree"
+                else:
+                    try:
+                        self._tree_block_size, self._tree_root = ChunkTree.parse_option(
+                                tree_option, self._hash)
+                    except Exception as e:
+                        reason = "Invalid chunk tree ({})".format(e)
+
+                if reason:
+                    failure_packet = self.generate_packet(self._states.FAILURE)
+                    failure_packet.payload(b"Invalid chunk tree")
+                    return SchemeResult(
+                            source,
+                            failure_packet,
+                            False,
+                            Done(False, reason=reason)
+                        )
+
+            if self._part is not None:
+                reason = None
+                if get_options(packet.option()).get(OPTION_PART, None) != encode_part(self._part):
+                    reason = "Parallel transfer is not supported"
+                elif digest_size == 0:
+                    reason = "Parallel transfer needs the digest"
+
+                if reason:
+                    failure_packet = self.generate_packet(self._states.FAILURE)
+                    failure_packet.payload(reason.encode())
+                    return SchemeResult(
+                            source,
+                            failure_packet,
+                            False,
+                            Done(False, reason=reason)
+                        )
+
             original_filename = os.path.split(filename)[1]
 
             tmp_filename = ".".join([original_filename, str(time.time_ns())])
             tmp_path = os.path.join(self._directory, tmp_filename)
 
-            self._file = FileWriter(tmp_path)
+            offset = 0
+
+            if self.__is_storable(digest_size) and self._store.restore(digest, filesize, tmp_path):
+                # The file is already here, nothing is required.
+                self._info["filename"] = original_filename
+                self._info["path"] = tmp_path
+                self._info["deduplicated"] = True
+                return self.__succeed(source)
+
+            if self._part is not None:
+                # All parts are written into one file named after the digest,
+                # the digest of the whole file is checked once all parts are
+                # received (see sft.parallel).
+                tmp_filename = ".".join([original_filename, digest.hex()[:16]])
+                tmp_path = os.path.join(self._directory, tmp_filename)
+
+            # Without the digest up front, a partial file can't be matched.
+            # The data passed to a sink can't be read again.
+            elif self._resume and digest_size > 0 and self._batch is None \
+                    and self.__get_sink() is None:
+                manifest_path = PartialManifest.get_path(self._directory, original_filename, digest)
+                self._manifest = PartialManifest.load(manifest_path)
+
+                if self._manifest is not None and self._manifest.match(digest, filesize):
+                    tmp_path = self._manifest.file_path
+                    offset = self._manifest.verified
+
+                    # The blocks are checked whole, the last one is received
+                    # again if it is cut.
+                    if self._tree_root is not None:
+                        offset -= offset % self._tree_block_size
+                else:
+                    self._manifest = PartialManifest(manifest_path, tmp_path, digest, filesize)
+
+            hash_obj = new_hash(self._hash) if self._part is None else None
+            truncate = self._part is None
+
+            if self.__get_sink() is not None:
+                tmp_path = None
+                self._file = SinkWriter(self.__get_sink(), hash_obj)
+            elif self._batch is not None:
+                self._file = BatchWriter(tmp_path, self._batch, self._fsync)
+            elif self._write_behind > 0:
+                self._file = BackgroundFileWriter(
+                        tmp_path, hash_obj, self._write_behind, offset, truncate)
+            else:
+                self._file = FileWriter(tmp_path, hash_obj, offset, truncate)
+
+            if (self._preallocate or self._part is not None) and self._batch is None:
+                self._file.preallocate(filesize)
+
+            if self._manifest is not None:
+                self.__save_manifest()
+
             self._expected_digest = digest
             self._expected_filesize = filesize
 
+            self._range_start, self._range_end = 0, filesize
+            if is_stream:
+                self._range_end = None
+            elif self._part is not None:
+                self._range_start, self._range_end = get_part_range(filesize, self._part)
+                self._info["part"] = self._part
+                self._info["digest"] = digest
+
+            if digest_size == 0 and self._version >= TRAILING_DIGEST_VERSION:
+                # The digest will come in a DIGEST packet.
+                self._expected_digest = None
+
             self._step = ReceiverStep.RECEIVING
 
-            packet = self.__get_require_packet()
+            if self._adaptive:
+                self._sizer = ChunkSizer(self._min_buffer_size, self._max_buffer_size)
 
             self._info["filename"] = original_filename
-            self._info["path"] = tmp_path
+            self._info["hash"] = self._hash
+            if tmp_path is not None:
+                self._info["path"] = tmp_path
+            if self._batch is not None:
+                self._info["files"] = {}
+
+            self._next_offset = self._range_start + self._file.size()
+
+            if self._tree_root is not None:
+                # Wait for the HASHES packet.
+                self._step = ReceiverStep.HASHING
+                return SchemeResult(source, None, True)
+
+            return self.__start(source)
+        else:
+            return self.ignore(source, reason="Invalid step")
+
+    def __start(self, source: str):
+        """Require the first chunks of the file once its INFO (and HASHES)
+        is received."""
+        if self.__is_complete() and self._expected_digest is not None:
+            return self.__finish(source)
+
+        signature_packet = self.__create_signature_packet(self._info["filename"])
+        if signature_packet is not None:
+            self._step = ReceiverStep.COMPARING
+            return SchemeResult(source, signature_packet, True)
+
+        packet = self.__fill_window(source)
+
+        return SchemeResult(source, packet, True)
+
+    @csbuilder.response(SFTSenderStates.HASHES)
+    def resp_hashes(self, source: str, packet: CSPacket):
+        if self._step == ReceiverStep.HASHING:
+            try:
+                tree = ChunkTree.from_bytes(
+                        packet.payload(), self._tree_block_size, self._expected_filesize,
+                        self._tree_root, self._hash)
+            except Exception as e:
+                failure_packet = self.generate_packet(self._states.FAILURE)
+                failure_packet.payload(b"Invalid chunk hashes")
+                return SchemeResult(
+                        source,
+                        failure_packet,
+                        False,
+                        Done(False, reason="Invalid chunk hashes ({})".format(e))
+                    )
+
+            self._verifier = BlockVerifier(tree)
+            self._step = ReceiverStep.RECEIVING
+
+            return self.__start(source)
+        else:
+            return self.ignore(source, reason="Invalid step")
+
+    def __is_storable(self, digest_size: int) -> bool:
+        """Return True if the file of the transfer can be taken from or put
+        into the store, that is a whole file whose digest is known up front
+        and which is written into the directory."""
+        return self._store is not None and digest_size > 0 and self._part is None \
+            and self._batch is None and self.__get_sink() is None
+
+    def __create_signature_packet(self, filename: str):
+        """Return the SIGNATURE of the old copy of the file, or None if there
+        is nothing to compare with."""
+        if not self._delta or self._version < DELTA_VERSION or self._part is not None \
+                or self._batch is not None or self.__get_sink() is not None \
+                or self._range_end is None or self._verifier is not None:
+            return None
+
+        path = os.path.join(self._directory, filename)
+        if not os.path.isfile(path):
+            return None
+
+        block_size = get_block_size(os.path.getsize(path))
+        with self._metrics.measure(PHASE_DELTA):
+            signatures = Signatures.from_file(path, block_size)
+
+        if len(signatures) == 0:
+            return None
+
+        self._delta_path = path
+        self._delta_block_size = block_size
+
+        signature_packet = self.generate_packet(self._states.SIGNATURE)
+        signature_packet.payload(signatures.to_bytes(self._int_size))
+
+        return signature_packet
+
+    def __copy_blocks(self, runs):
+        """Copy the blocks of the old file into the new one, return the copied
+        ranges (offset, length)."""
+        block_size = self._delta_block_size
+        old_filesize = os.path.getsize(self._delta_path)
+
+        copied_ranges = []
+        with open(self._delta_path, "rb") as stream:
+            for offset, index, nblocks in runs:
+                length = nblocks * block_size
+                source_offset = index * block_size
+
+                if offset + length > self._expected_filesize \
+                        or source_offset + length > old_filesize:
+                    raise Exception("Invalid delta")
+
+                # The resumed prefix is already there.
+                skip = max(0, min(length, self._next_offset - offset))
+                offset, source_offset, length = offset + skip, source_offset + skip, length - skip
+
+                copied_ranges.append((offset, length))
+
+                while length > 0:
+                    stream.seek(source_offset)
+                    data = stream.read(min(length, self._buffer_size))
+                    self._file.write(data, offset)
+
+                    offset += len(data)
+                    source_offset += len(data)
+                    length -= len(data)
+
+        return copied_ranges
+
+    @csbuilder.response(SFTSenderStates.DELTA)
+    def resp_delta(self, source: str, packet: CSPacket):
+        if self._step == ReceiverStep.COMPARING:
+            try:
+                runs = decode_runs(packet.payload(), self._int_size)
+
+                with self._metrics.measure(PHASE_DELTA):
+                    copied_ranges = self.__copy_blocks(runs)
+            except Exception as e:
+                failure_packet = self.generate_packet(self._states.FAILURE)
+                failure_packet.payload(b"Invalid delta")
+                return SchemeResult(
+                        source,
+                        failure_packet,
+                        False,
+                        Done(False, reason="Invalid delta ({})".format(e))
+                    )
+
+            # Only the gaps between the copied blocks are required.
+            start = self._next_offset
+            for offset, length in sorted(copied_ranges) + [(self._expected_filesize, 0)]:
+                while start < offset:
+                    buffer_size = min(self._buffer_size, offset - start)
+                    self._missing_ranges.append((start, buffer_size))
+                    start += buffer_size
+
+                start = max(start, offset + length)
+
+            self._next_offset = self._expected_filesize
+
+            self._step = ReceiverStep.RECEIVING
+
+            if self._manifest is not None:
+                self.__save_manifest()
+
+            if self.__is_complete():
+                if self._expected_digest is None:
+                    # Wait for the DIGEST packet.
+                    return SchemeResult(source, None, True)
+
+                return self.__finish(source)
+
+            packet = self.__fill_window(source)
 
             return SchemeResult(source, packet, True)
         else:
             return self.ignore(source, reason="Invalid step")
 
+    def __save_manifest(self):
+        self._manifest.verified = self._file.hashed_size()
+        self._manifest.save()
+
+    def __finish(self, source: str):
+        failure_packet = self.generate_packet(self._states.FAILURE)
+
+        verify_start = time.perf_counter()
+
+        try:
+            self._file.flush(self._fsync)
+
+            # A sink is told whether its data is valid before it is closed,
+            # closing it first would abort it.
+            if isinstance(self._file, SinkWriter):
+                if self._file.digest() == self._expected_digest:
+                    self._file.finish()
+                else:
+                    self._file.abort("Integrity is compromised")
+
+            self._file.close()
+
+            # The files of a batch are checked one by one as they complete.
+            if self._batch is not None:
+                self._info["files"] = self._file.results()
+
+                failed_files = [path for path, result in self._info["files"].items() if not result.value]
+                if failed_files:
+                    failure_packet.payload("Integrity is compromised ({} files)".format(
+                        len(failed_files)).encode())
+                    return SchemeResult(
+                            source,
+                            failure_packet,
+                            False,
+                            Done(False, reason="Integrity is compromised", files=self._info["files"])
+                        )
+
+            # A part can't be checked alone.
+            elif self._part is None and self._file.digest() != self._expected_digest:
+                # The partial file is useless, the next session starts over.
+                if self._manifest is not None:
+                    self._manifest.remove()
+                    self._manifest = None
+
+                failure_packet.payload(b"Integrity is compromised")
+                return SchemeResult(
+                        source,
+                        failure_packet,
+                        False,
+                        Done(False, reason="Integrity is compromised")
+                    )
+
+        except Exception as e:
+            failure_packet.payload(b"Unknown error")
+            return SchemeResult(
+                    source,
+                    failure_packet,
+                    False,
+                    Done(False, reason="Unknown error ({}).".format(e))
+                )
+        finally:
+            self._metrics.add_time(PHASE_VERIFY, time.perf_counter() - verify_start)
+
+        if self._manifest is not None:
+            self._manifest.remove()
+            self._manifest = None
+
+        if self.__is_storable(len(self._expected_digest)):
+            self._store.add(self._expected_digest, self._info["path"])
+
+        return self.__succeed(source)
+
+    def __succeed(self, source: str):
+        self._metrics.success = True
+        self._metrics.stop()
+        self._info["metrics"] = self._metrics.to_dict()
+
+        success_packet = self.generate_packet(self._states.SUCCESS)
+        return SchemeResult(
+                source,
+                success_packet,
+                False,
+                Done(True, **self._info)
+            )
+
     @csbuilder.response(SFTSenderStates.SEND)
     def resp_send(self, source: str, packet: CSPacket):
         if self._step == ReceiverStep.RECEIVING:
             failure_packet = self.generate_packet(self._states.FAILURE)
 
-            offset = int.from_bytes(packet.option()[0:DEFAULT_INT_SIZE], "big")
+            int_size = self._int_size
 
-            if offset != self._file.size():
+            offset = int.from_bytes(packet.option()[0: int_size], "big")
+            bwindow_size = packet.option()[int_size: 2 * int_size]
+            bcodec = packet.option()[2 * int_size: 2 * int_size + CODEC_SIZE]
+            data = packet.payload()
+
+            if offset not in self._outstanding_ranges or not data:
                 if self._remain_ntries > 0:
-                    require_packet = self.__get_require_packet()
                     self._remain_ntries -= 1
+                    self._metrics.retries += 1
+
+                    if offset in self._outstanding_ranges:
+                        buffer_size = self._outstanding_ranges.pop(offset)
+                        self._missing_ranges.appendleft((offset, buffer_size))
+
+                    require_packet = self.__fill_window(source)
+
+                    if require_packet is None:
+                        # The window is full, require the oldest gap again.
+                        offset = min(self._outstanding_ranges)
+                        buffer_size = self._outstanding_ranges[offset]
+                        require_packet = self.__get_require_packet(offset, buffer_size)
+
                     return SchemeResult(source, require_packet, True)
 
                 else:
@@ -257,59 +1238,156 @@ class SFTReceiverScheme(Scheme):
                             False,
                             Done(False, reason=reason)
                         )
-            try:
-                self._file.write(packet.payload())
-            except Exception as e:
-                failure_packet.payload(b"Unknown error")
-                return SchemeResult(
-                        source,
-                        failure_packet,
-                        False,
-                        Done(False, reason="Unknown error ({})".format(e))
-                    )
 
-            if self._file.size() == self._expected_filesize:
-                try:
-                    self._file.close()
+            buffer_size = self._outstanding_ranges.pop(offset)
 
-                    if self._file.digest() != self._expected_digest:
-                        failure_packet.payload(b"Integrity is compromised")
-                        return SchemeResult(
-                                source,
-                                failure_packet,
-                                False,
-                                Done(False, reason="Integrity is compromised")
-                            )
+            self._metrics.wire_bytes += len(data)
+
+            codec = int.from_bytes(bcodec, "big")
+            if codec != CODEC_NONE:
+                try:
+                    if codec != self._codec:
+                        raise Exception("Codec {} is not negotiated".format(codec))
 
+                    with self._metrics.measure(PHASE_COMPRESSION):
+                        data = decompress(codec, data, buffer_size)
                 except Exception as e:
-                    failure_packet.payload(b"Unknown error")
+                    failure_packet.payload(b"Invalid compressed data")
                     return SchemeResult(
                             source,
                             failure_packet,
                             False,
-                            Done(False, reason="Unknown error ({}).".format(e))
+                            Done(False, reason="Invalid compressed data ({})".format(e))
                         )
 
-                success_packet = self.generate_packet(self._states.SUCCESS)
+            if len(data) > buffer_size:
+                failure_packet.payload(b"Received too much")
                 return SchemeResult(
                         source,
-                        success_packet,
+                        failure_packet,
                         False,
-                        Done(True, **self._info)
+                        Done(False, reason="Received too much")
                     )
 
-            elif self._file.size() > self._expected_filesize:
-                failure_packet.payload(b"Received too much")
+            if len(data) < buffer_size:
+                # The sender may clamp the chunk to its own buffer size.
+                self._missing_ranges.appendleft((offset + len(data), buffer_size - len(data)))
+
+            try:
+                if self._verifier is not None:
+                    with self._metrics.measure(PHASE_VERIFY):
+                        blocks, corrupted_ranges = self._verifier.verify(offset, data)
+                else:
+                    blocks, corrupted_ranges = [(offset, data)], []
+
+                with self._metrics.measure(PHASE_WRITE):
+                    for block_offset, block in blocks:
+                        self._file.write(block, block_offset)
+            except Exception as e:
+                failure_packet.payload(b"Unknown error")
                 return SchemeResult(
                         source,
                         failure_packet,
                         False,
-                        Done(False, reason="Received too much")
+                        Done(False, reason="Unknown error ({})".format(e))
                     )
 
+            self._metrics.bytes += len(data)
+            self._metrics.chunks += 1
+
+            # Only the corrupted blocks are required again.
+            for block_offset, length in reversed(corrupted_ranges):
+                ntries = self._block_retries.get(block_offset, 0) + 1
+                if ntries > self.DEFAULT_NTRIES:
+                    reason = "Integrity is compromised (block at {})".format(block_offset)
+                    failure_packet.payload(b"Integrity is compromised")
+                    return SchemeResult(
+                            source,
+                            failure_packet,
+                            False,
+                            Done(False, reason=reason)
+                        )
+
+                self._block_retries[block_offset] = ntries
+                self._metrics.retries += 1
+                self._missing_ranges.appendleft((block_offset, length))
+
+            if self._manifest is not None:
+                self.__save_manifest()
+
+            if bwindow_size:
+                window_size = int.from_bytes(bwindow_size, "big")
+                self._granted_window_size = max(1, min(window_size, self._window_size))
+
+            if self._sizer is not None:
+                self._sizer.on_receive(offset, len(data), self._granted_window_size or 1)
+
+            if self.__is_complete():
+                if self._expected_digest is None:
+                    # Wait for the DIGEST packet.
+                    return SchemeResult(source, None, True)
+
+                return self.__finish(source)
+
             self._remain_ntries = self.DEFAULT_NTRIES
-            require_packet = self.__get_require_packet()
+            require_packet = self.__fill_window(source)
 
             return SchemeResult(source, require_packet, True)
         else:
             return self.ignore(source, reason="Invalid step")
+
+    @csbuilder.response(SFTSenderStates.DIGEST)
+    def resp_digest(self, source: str, packet: CSPacket):
+        if self._step == ReceiverStep.RECEIVING and self._expected_digest is None:
+            self._expected_digest = packet.payload()
+
+            if self._range_end is None:
+                reason = self.__end_stream(packet.option())
+                if reason:
+                    failure_packet = self.generate_packet(self._states.FAILURE)
+                    failure_packet.payload(reason.encode())
+                    return SchemeResult(
+                            source,
+                            failure_packet,
+                            False,
+                            Done(False, reason=reason)
+                        )
+
+            if self.__is_complete():
+                return self.__finish(source)
+
+            # The chunks required past the end of a stream are dropped, the
+            # rest may still be missing.
+            packet = None
+            if not self._outstanding_ranges:
+                packet = self.__fill_window(source)
+
+            return SchemeResult(source, packet, True)
+        else:
+            return self.ignore(source, reason="Invalid step")
+
+    def __end_stream(self, option: bytes) -> str:
+        """Set the end of the stream announced in the option field of the
+        DIGEST packet, return the reason why it is invalid if it is."""
+        if len(option) != self._int_size:
+            return "Invalid stream size"
+
+        size = int.from_bytes(option, "big")
+        if size < self._file.size():
+            return "Received too much"
+
+        self._range_end = self._expected_filesize = size
+        self._next_offset = min(self._next_offset, size)
+
+        missing_ranges = [(offset, min(length, size - offset))
+                            for offset, length in self._missing_ranges if offset < size]
+        self._missing_ranges.clear()
+        self._missing_ranges.extend(missing_ranges)
+
+        for offset in list(self._outstanding_ranges):
+            if offset >= size:
+                del self._outstanding_ranges[offset]
+            else:
+                self._outstanding_ranges[offset] = min(self._outstanding_ranges[offset], size - offset)
+
+        return None
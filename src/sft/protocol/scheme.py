@@ -0,0 +1,52 @@
+import copy
+import threading
+from typing import List, Tuple
+
+from csbuilder.scheme import Scheme
+from csbuilder.cspacket import CSPacket
+
+
+class SFTScheme(Scheme):
+    """The common base of SFT schemes.
+
+    A csbuilder response can only return one packet. SFT schemes which need
+    to emit more than one packet for a single incoming packet (e.g. to keep
+    several REQUIREs in flight) push the additional packets here; they are
+    flushed by the SFT responsers right after the main response is sent.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+
+        self._extra_packets: List[Tuple[str, CSPacket]] = []
+        self._extra_packets_lock = threading.Lock()
+
+    def push_packet(self, destination: str, packet: CSPacket):
+        self._extra_packets_lock.acquire()
+        self._extra_packets.append((destination, packet))
+        self._extra_packets_lock.release()
+
+    def pop_packets(self) -> List[Tuple[str, CSPacket]]:
+        self._extra_packets_lock.acquire()
+        packets, self._extra_packets = self._extra_packets, []
+        self._extra_packets_lock.release()
+
+        return packets
+
+    def cancel(self, *args, **kwargs):
+        self.pop_packets()
+        super().cancel(*args, **kwargs)
+
+    def __deepcopy__(self, memo):
+        # Sessions are cloned by deepcopy for each new responser, the lock
+        # can not be copied so a fresh one is created for the clone.
+        cls = type(self)
+        clone = cls.__new__(cls)
+        memo[id(self)] = clone
+
+        for key, value in self.__dict__.items():
+            if key == "_extra_packets_lock":
+                clone.__dict__[key] = threading.Lock()
+            else:
+                clone.__dict__[key] = copy.deepcopy(value, memo)
+
+        return clone
@@ -1,20 +1,65 @@
 import os
-from typing import Callable
+from typing import Callable, List, Tuple
 import csbuilder
 
 from hks_pylib.done import Done
 from hks_pylib.hksenum import HKSEnum
-
-from csbuilder.scheme import Scheme
 from csbuilder.scheme.result import SchemeResult
 from csbuilder.cspacket.cspacket import CSPacket
 
-from sft.file import FileReader
+from sft.file import FileReader, MappedFileReader, StreamReader, is_stream
+from sft.batch import BatchManifest, BatchReader
+from sft.cache import DigestCache
+from sft.tree import ChunkTree, DEFAULT_TREE_BLOCK_SIZE
+from sft.hashes import HASH_SHA256, HASH_ID_SIZE, get_hashes, new_hash
+from sft.metrics import MetricsSink, TransferMetrics
+from sft.metrics import PHASE_DIGEST, PHASE_READ, PHASE_COMPRESSION, PHASE_DELTA, PHASE_THROTTLE
+from sft.metrics import PHASE_ADMISSION
+from sft.ratelimit import RateLimiter, Throttle
+from sft.scheduler import TransferScheduler, Slot
+from sft.delta import Signatures, match_blocks, encode_runs
+from sft.compression import CODEC_SIZE, ChunkCompressor, get_codecs
 from sft.protocol import DEFAULT_INT_SIZE
-from sft.protocol import DEFAULT_BUFFER_SIZE, DEFAULT_TOKEN
+from sft.protocol import LEGACY_VERSION, PROTOCOL_VERSION, TRAILING_DIGEST_VERSION, STREAM_VERSION
+from sft.protocol import CHUNK_TREE_VERSION, HASH_VERSION
+from sft.protocol import get_int_size, get_version, encode_options, get_options
+from sft.protocol import OPTION_CODECS, OPTION_PART, OPTION_BATCH, OPTION_STREAM, OPTION_CHUNK_TREE
+from sft.protocol import OPTION_HASHES
+from sft.protocol import encode_part, decode_part
+from sft.protocol.scheme import SFTScheme
+from sft.protocol import DEFAULT_BUFFER_SIZE, DEFAULT_TOKEN, DEFAULT_WINDOW_SIZE
 from sft.protocol.definition import SFTReceiverStates, SFTProtocols, SFTRoles
 
 
+def resolve_token_value(value) -> Tuple[str, object]:
+    """Return the path and the stream (one of them is None) which the value
+    returned by the detoken function of a sender stands for.
+
+    The value is a path (a str or an os.PathLike), a stream (see
+    sft.file.is_stream), or an object or a dict whose path or stream holds
+    one of them (e.g. along with the priority of the transfer, see
+    sft.scheduler.default_priority).
+    """
+    if isinstance(value, (str, os.PathLike)):
+        return os.fspath(value), None
+
+    if is_stream(value):
+        return None, value
+
+    if isinstance(value, dict):
+        path, stream = value.get("path", None), value.get("stream", None)
+    else:
+        path, stream = getattr(value, "path", None), getattr(value, "stream", None)
+
+    if isinstance(path, (str, os.PathLike)):
+        return os.fspath(path), None
+
+    if stream is not None and is_stream(stream):
+        return None, stream
+
+    raise Exception("The token stands for an unsupported {}".format(type(value).__name__))
+
+
 class SenderStep(HKSEnum):
     NONE = "none"
     REQUESTING = "requesting"
@@ -23,7 +68,7 @@ class SenderStep(HKSEnum):
 
 
 @csbuilder.scheme(SFTProtocols.SFT, SFTRoles.SENDER, SFTReceiverStates.REQUEST)
-class SFTSenderScheme(Scheme):
+class SFTSenderScheme(SFTScheme):
     def __init__(self, forwarder: str) -> None:
         super().__init__()
 
@@ -32,16 +77,86 @@ class SFTSenderScheme(Scheme):
         self._detoken_fn: Callable = lambda x: x
 
         self._buffer_size = DEFAULT_BUFFER_SIZE
+        self._window_size = DEFAULT_WINDOW_SIZE
+        self._trailing_digest = False
+        self._digest_cache: DigestCache = None
+        self._memory_map = False
+
+        # The codecs which the sender may use, in order of preference.
+        self._codecs: List[int] = []
+        self._compressor: ChunkCompressor = None
+
+        # The hash algorithms which the sender may use for the digest, in
+        # order of preference, and the one chosen for the current transfer.
+        self._hashes: List[int] = [HASH_SHA256]
+        self._hash = HASH_SHA256
+
+        # The size of the blocks hashed for a receiver which asks for the
+        # chunk tree of the file, and the tree of the current transfer.
+        self._tree_block_size = DEFAULT_TREE_BLOCK_SIZE
+        self._tree_supported = False
+        self._tree: ChunkTree = None
+
+        self._metrics_sink: MetricsSink = None
+        self._metrics = TransferMetrics("sender")
+
+        # Limit the bandwidth of the transfers (see sft.ratelimit), the
+        # share of a transfer is proportional to weight. The peer is the
+        # host at the other end of the connection.
+        self._rate_limiter: RateLimiter = None
+        self._weight = 1
+        self._peer: str = None
+        self._throttle: Throttle = None
+
+        # Admit the transfers requested by the peer by priority (see
+        # sft.scheduler), the slot is held until the transfer ends.
+        self._scheduler: TransferScheduler = None
+        self._slot: Slot = None
+
+        # The admission of the next request and its waiting time, when the
+        # engine admits it before it is answered (see
+        # get_admission_priority()), and the token resolved for it.
+        self._admission: Tuple[Slot, float] = None
+        self._detoken_result: Tuple[str, object] = None
 
         self._step: str = SenderStep.NONE
 
         self._file: FileReader = None
 
+        # True if the digest will be sent in a DIGEST packet after the file
+        # is completely read.
+        self._digest_pending = False
+        self._digest_key = None
+
+        # The part (index, count) of the file sent in this session.
+        self._part: Tuple[int, int] = None
+
+        # Whether the receiver accepts a directory sent as a batch.
+        self._batch_supported = False
+
+        # The stream sent instead of a file, if any (see sft.file.open_stream).
+        self._stream = None
+
+        self._version = LEGACY_VERSION
+        self._int_size = get_int_size(LEGACY_VERSION)
+
         self._info = {}
 
     def config(self, **kwargs):
         detoken = kwargs.pop("detoken", None)
         buffer_size = kwargs.pop("buffer_size", None)
+        window_size = kwargs.pop("window_size", None)
+        trailing_digest = kwargs.pop("trailing_digest", None)
+        digest_cache = kwargs.pop("digest_cache", None)
+        memory_map = kwargs.pop("memory_map", None)
+        compression = kwargs.pop("compression", None)
+        hashes = kwargs.pop("hashes", None)
+        tree_block_size = kwargs.pop("tree_block_size", None)
+        metrics_sink = kwargs.pop("metrics_sink", None)
+        rate_limiter = kwargs.pop("rate_limiter", None)
+        weight = kwargs.pop("weight", None)
+        peer = kwargs.pop("peer", None)
+        scheduler = kwargs.pop("scheduler", None)
         forwarder = kwargs.pop("forwarder", None)
 
         if kwargs:
@@ -53,6 +168,78 @@ class SFTSenderScheme(Scheme):
 
             self._buffer_size = buffer_size
 
+        if window_size:
+            if not isinstance(window_size, int) or window_size <= 0:
+                raise Exception("Window size must be a positive integer.")
+
+            self._window_size = window_size
+
+        if trailing_digest is not None:
+            if not isinstance(trailing_digest, bool):
+                raise Exception("Parameter trailing_digest must be a bool.")
+
+            self._trailing_digest = trailing_digest
+
+        if digest_cache:
+            if not isinstance(digest_cache, DigestCache):
+                raise Exception("Parameter digest_cache must be a DigestCache.")
+
+            self._digest_cache = digest_cache
+
+        if memory_map is not None:
+            if not isinstance(memory_map, bool):
+                raise Exception("Parameter memory_map must be a bool.")
+
+            self._memory_map = memory_map
+
+        if compression is not None:
+            if not isinstance(compression, (list, tuple)):
+                raise Exception("Parameter compression must be a list of codec names.")
+
+            self._codecs = get_codecs(compression)
+
+        if hashes is not None:
+            if not isinstance(hashes, (list, tuple)) or not hashes:
+                raise Exception("Parameter hashes must be a non-empty list of hash algorithm names.")
+
+            self._hashes = get_hashes(hashes)
+
+        if tree_block_size:
+            if not isinstance(tree_block_size, int) or tree_block_size <= 0:
+                raise Exception("Parameter tree_block_size must be a positive integer.")
+
+            self._tree_block_size = tree_block_size
+
+        if metrics_sink:
+            if not isinstance(metrics_sink, MetricsSink):
+                raise Exception("Parameter metrics_sink must be a MetricsSink.")
+
+            self._metrics_sink = metrics_sink
+
+        if rate_limiter:
+            if not isinstance(rate_limiter, RateLimiter):
+                raise Exception("Parameter rate_limiter must be a RateLimiter.")
+
+            self._rate_limiter = rate_limiter
+
+        if weight is not None:
+            if not isinstance(weight, (int, float)) or weight <= 0:
+                raise Exception("Parameter weight must be a positive number.")
+
+            self._weight = weight
+
+        if peer is not None:
+            if not isinstance(peer, str):
+                raise Exception("Parameter peer must be a str.")
+
+            self._peer = peer
+
+        if scheduler:
+            if not isinstance(scheduler, TransferScheduler):
+                raise Exception("Parameter scheduler must be a TransferScheduler.")
+
+            self._scheduler = scheduler
+
         if detoken:
             if not callable(detoken):
                 raise Exception("Token must must be a Callable object.")
@@ -72,27 +259,166 @@ class SFTSenderScheme(Scheme):
             self._file.close()
             self._file = None
 
+        self._digest_pending = False
+        self._digest_key = None
+
+        self._compressor = None
+
+        self._hash = HASH_SHA256
+
+        self._tree_supported = False
+        self._tree = None
+
+        if self._throttle is not None:
+            self._throttle.close()
+            self._throttle = None
+
+        if self._slot is not None:
+            self._slot.release()
+            self._slot = None
+
+        # The request was denied before its admission was taken.
+        if self._admission is not None:
+            if self._admission[0] is not None:
+                self._admission[0].release()
+            self._admission = None
+
+        self._detoken_result = None
+
+        self._part = None
+
+        self._batch_supported = False
+
+        self._stream = None
+
+        self._version = LEGACY_VERSION
+        self._int_size = get_int_size(LEGACY_VERSION)
+
         self._info = {}
 
+        metrics, self._metrics = self._metrics, TransferMetrics("sender")
+
         super().cancel(*args, **kwargs)
 
+        if metrics.is_started():
+            metrics.stop()
+
+            if self._metrics_sink is not None:
+                self._metrics_sink.record(metrics)
+
+    def metrics(self) -> TransferMetrics:
+        """Return the metrics of the current transfer."""
+        return self._metrics
+
+    def scheduler(self) -> TransferScheduler:
+        return self._scheduler
+
+    def __get_throttle(self) -> Throttle:
+        """Return the share of the bandwidth of the current transfer, or None
+        if it is not limited."""
+        if self._rate_limiter is not None and self._throttle is None:
+            self._throttle = self._rate_limiter.open(self._peer, self._weight)
+
+        return self._throttle
+
+    def __throttle(self, nbytes: int):
+        throttle = self.__get_throttle()
+        if throttle is not None:
+            self._metrics.add_time(PHASE_THROTTLE, throttle.wait(nbytes))
+
+    def __admit(self, priority: int) -> bool:
+        """Wait for the scheduler to admit the transfer, return False if it
+        is not admitted in time."""
+        if self._admission is not None:
+            self._slot, admission_time = self._admission
+            self._admission = None
+            self._metrics.add_time(PHASE_ADMISSION, admission_time)
+        else:
+            with self._metrics.measure(PHASE_ADMISSION):
+                self._slot = self._scheduler.admit(priority)
+
+        if self._slot is None:
+            return False
+
+        self._info["priority"] = priority
+        return True
+
+    def __detoken(self, token: str):
+        if self._detoken_result is not None and self._detoken_result[0] == token:
+            value = self._detoken_result[1]
+        else:
+            value = self._detoken_fn(token)
+
+        self._detoken_result = None
+        return value
+
+    def get_admission_priority(self, packet: CSPacket) -> int:
+        """Return the priority of the transfer requested by packet if the
+        scheduler has to admit it, None otherwise.
+
+        admit() of the scheduler blocks the thread answering the request.
+        An engine which doesn't want that (see sft.aio) admits the transfer
+        itself, e.g. with admit_async(), and gives the slot with
+        set_admission() before the packet is answered.
+        """
+        if self._scheduler is None or self._step is not SenderStep.NONE \
+                or packet.state() != SFTReceiverStates.REQUEST:
+            return None
+
+        try:
+            token = packet.payload().decode()
+            value = self._detoken_fn(token)
+            priority = self._scheduler.get_priority(token, value)
+        except Exception:
+            # The request is denied when it is answered.
+            return None
+
+        self._detoken_result = (token, value)
+        return priority
+
+    def set_admission(self, slot: Slot, admission_time: float):
+        """Give the slot of the next request (None if it was not admitted in
+        time) and the seconds it waited for it."""
+        self._admission = (slot, admission_time)
+
     @csbuilder.active_activation
-    def activation(self, path: str, token: str = DEFAULT_TOKEN):
+    def activation(self,
+                    path: str,
+                    token: str = DEFAULT_TOKEN,
+                    part: Tuple[int, int] = None,
+                    stream=None
+                ):
+        """Send the file at path. If stream is given, it is sent instead and
+        path is only the name announced to the receiver."""
         if self._step is not SenderStep.NONE:
             return None, None
 
-        if os.path.isfile(path) is False:
+        if stream is None and os.path.isfile(path) is False and os.path.isdir(path) is False:
             raise Exception("File not found ({})".format(path))
 
         if not isinstance(token, str):
             raise Exception("Parameter token must be a str.")
 
+        if part is not None and (stream is not None or os.path.isdir(path)):
+            raise Exception("A directory or a stream can't be sent in parts.")
+
+        self._stream = stream
+
+        options = {}
+        if part is not None:
+            self._part = decode_part(encode_part(part))
+            options[OPTION_PART] = encode_part(self._part)
+
         request_packet = self.generate_packet(self._states.REQUEST)
+        request_packet.option(encode_options(PROTOCOL_VERSION, options))
         request_packet.payload(token.encode())
 
         self._step = SenderStep.REQUESTING
+        self._metrics.start()
 
-        self._file = FileReader(path)
+        self._info["filename"] = path
+        if self._part is not None:
+            self._info["part"] = self._part
 
         return self._forwarder, request_packet
 
@@ -104,33 +430,194 @@ class SFTSenderScheme(Scheme):
                 False,
                 Done(False, reason="Ignore", message=packet.payload()))
 
+    def __negotiate(self, option: bytes):
+        self._version = min(get_version(option), PROTOCOL_VERSION)
+        self._int_size = get_int_size(self._version)
+
+        self._batch_supported = OPTION_BATCH in get_options(option)
+        self._tree_supported = self._version >= CHUNK_TREE_VERSION \
+                                and OPTION_CHUNK_TREE in get_options(option)
+
+        # Use the first of our codecs which the receiver accepts.
+        accepted_codecs = get_options(option).get(OPTION_CODECS, b"")
+        for codec in self._codecs:
+            if codec in accepted_codecs:
+                self._compressor = ChunkCompressor(codec)
+                break
+
+        # Use the first of our hash algorithms which the receiver accepts,
+        # SHA256 is the digest of older receivers.
+        self._hash = HASH_SHA256
+        if self._version >= HASH_VERSION:
+            accepted_hashes = get_options(option).get(OPTION_HASHES, b"") + bytes([HASH_SHA256])
+            for algorithm in self._hashes:
+                if algorithm in accepted_hashes:
+                    self._hash = algorithm
+                    break
+
+    def __check_source(self) -> str:
+        """Return the reason why the receiver can't receive the source, or
+        None if it can."""
+        if self._stream is not None:
+            if self._version < STREAM_VERSION:
+                return "Stream transfer is not supported"
+        elif os.path.isdir(self._info["filename"]) and not self._batch_supported:
+            return "Batch transfer is not supported"
+
+        return None
+
+    def __uses_tree(self) -> bool:
+        """Return True if the blocks of the file are hashed for the receiver."""
+        return self._tree_supported and self._part is None and self._stream is None \
+                and not os.path.isdir(self._info["filename"])
+
+    def __open_file(self, path: str):
+        reader_cls = MappedFileReader if self._memory_map else FileReader
+
+        # The size and the digest of a stream are known at its end only.
+        if self._stream is not None:
+            self._file = StreamReader(path, self._stream, new_hash(self._hash), 2 * self._window_size)
+            self._digest_pending = True
+            return
+
+        # A directory is sent as a batch of its files, the manifest and the
+        # files are hashed with SHA256.
+        if os.path.isdir(path):
+            self._hash = HASH_SHA256
+
+            with self._metrics.measure(PHASE_DIGEST):
+                manifest = BatchManifest.from_directory(path, self._digest_cache)
+
+            self._file = BatchReader(path, manifest, reader_cls)
+            self._info["files"] = [entry.path for entry in manifest.entries]
+            return
+
+        hash_obj = None
+
+        # The receiver of a part needs the digest up front. The digest comes
+        # with the chunk tree if the file is read for it.
+        if self._trailing_digest and self._version >= TRAILING_DIGEST_VERSION \
+                and self._part is None and not self.__uses_tree():
+            hash_obj = new_hash(self._hash)
+
+            if self._digest_cache is not None:
+                self._digest_key = self._digest_cache.key(path, type(hash_obj).__name__)
+
+                # A cached digest is announced in INFO right away.
+                if self._digest_cache.get(self._digest_key) is not None:
+                    hash_obj = None
+
+        self._file = reader_cls(path, hash_obj)
+
+        self._digest_pending = hash_obj is not None and self._file.size() > 0
+
+    def __push_digest(self, source: str):
+        """Queue the DIGEST packet once the file is completely read."""
+        if not self._digest_pending or self._file.streamed_digest() is None:
+            return
+
+        digest = self._file.streamed_digest()
+
+        digest_packet = self.generate_packet(self._states.DIGEST)
+        digest_packet.payload(digest)
+
+        if isinstance(self._file, StreamReader):
+            digest_packet.option(self._file.size().to_bytes(self._int_size, "big"))
+
+        self.push_packet(source, digest_packet)
+
+        self._digest_pending = False
+
+        if self._digest_cache is not None and self._digest_key is not None:
+            key = self._digest_cache.key(self._file.name(), self._digest_key[-1])
+            if key == self._digest_key:
+                self._digest_cache.put(key, digest)
+
     def __create_info_packet(self):
         self._info["filename"] = self._file.name()
 
-        file_digest = self._file.digest()
-        filesize = self._file.size()
+        # The size of a stream comes with its digest.
+        filesize = 0 if isinstance(self._file, StreamReader) else self._file.size()
+
+        if filesize.bit_length() > 8 * self._int_size:
+            return None
+
+        if self._digest_pending:
+            file_digest = b""
+        elif self.__uses_tree():
+            # The file is read once for both its tree and its digest.
+            hash_obj = new_hash(self._hash)
+            with self._metrics.measure(PHASE_DIGEST):
+                self._tree = ChunkTree.from_file(
+                        self._file.name(), self._tree_block_size, hash_obj, algorithm=self._hash)
+                file_digest = hash_obj.finalize()
+        else:
+            with self._metrics.measure(PHASE_DIGEST):
+                file_digest = self._file.digest(new_hash(self._hash), cache=self._digest_cache)
+
+        options = {}
+        if self._compressor is not None:
+            options[OPTION_CODECS] = self._compressor.codec().to_bytes(CODEC_SIZE, "big")
+
+        if self._part is not None:
+            options[OPTION_PART] = encode_part(self._part)
+
+        if isinstance(self._file, BatchReader):
+            options[OPTION_BATCH] = b""
+
+        if isinstance(self._file, StreamReader):
+            options[OPTION_STREAM] = b""
+
+        if self._tree is not None:
+            options[OPTION_CHUNK_TREE] = self._tree.to_option()
 
         info_packet = self.generate_packet(self._states.INFO)
+        info_packet.option(encode_options(self._version, options))
 
         info_packet.payload(len(self._file.name()).to_bytes(DEFAULT_INT_SIZE, "big"))
         info_packet.update_payload(self._file.name().encode())
 
         info_packet.update_payload(len(file_digest).to_bytes(DEFAULT_INT_SIZE, "big"))
+        if self._version >= HASH_VERSION:
+            info_packet.update_payload(self._hash.to_bytes(HASH_ID_SIZE, "big"))
         info_packet.update_payload(file_digest)
 
-        info_packet.update_payload(filesize.to_bytes(DEFAULT_INT_SIZE, "big"))
+        info_packet.update_payload(filesize.to_bytes(self._int_size, "big"))
+
+        if isinstance(self._file, BatchReader):
+            info_packet.update_payload(self._file.manifest().to_bytes(self._int_size))
 
         return info_packet
 
+    def __push_hashes(self, source: str):
+        """Queue the HASHES packet right after INFO."""
+        if self._tree is None:
+            return
+
+        hashes_packet = self.generate_packet(self._states.HASHES)
+        hashes_packet.payload(self._tree.to_bytes())
+
+        self.push_packet(source, hashes_packet)
+
     @csbuilder.response(SFTReceiverStates.REQUEST)
     def resp_request(self, source: str, packet: CSPacket):
         if self._step is SenderStep.NONE:
+            self._metrics.start()
+
             deny_reason = None
             deny_packet = self.generate_packet(self._states.DENY)
 
             try:
                 recv_token = packet.payload().decode()
-                self._info["filename"] = self._detoken_fn(recv_token)
+                detoken_value = self.__detoken(recv_token)
+
+                # The token may be resolved to a stream instead of a path.
+                path, stream = resolve_token_value(detoken_value)
+                if path is not None:
+                    self._info["filename"] = path
+                else:
+                    self._info["filename"] = recv_token
+                    self._stream = stream
             except TimeoutError:
                 deny_packet.payload(b"Expired token")
                 deny_reason = "Expired token"
@@ -138,6 +625,30 @@ class SFTSenderScheme(Scheme):
                 deny_packet.payload(b"Invalid token")
                 deny_reason = "Invalid token ({})".format(e)
 
+            options = get_options(packet.option())
+            if not deny_reason and OPTION_PART in options:
+                try:
+                    self._part = decode_part(options[OPTION_PART])
+                    self._info["part"] = self._part
+                except Exception as e:
+                    deny_packet.payload(b"Invalid part")
+                    deny_reason = "Invalid part ({})".format(e)
+
+                if not deny_reason and self._stream is not None:
+                    deny_packet.payload(b"Parallel transfer is not supported")
+                    deny_reason = "A stream can't be sent in parts"
+
+            if not deny_reason and self._scheduler is not None:
+                try:
+                    priority = self._scheduler.get_priority(recv_token, detoken_value)
+                except Exception as e:
+                    deny_packet.payload(b"Invalid token")
+                    deny_reason = "Invalid priority ({})".format(e)
+                else:
+                    if not self.__admit(priority):
+                        deny_packet.payload(b"Server busy")
+                        deny_reason = "Server busy"
+
             if deny_reason:
                 return SchemeResult(
                         source,
@@ -146,11 +657,34 @@ class SFTSenderScheme(Scheme):
                         Done(False, reason=deny_reason)
                     )
 
-            self._file = FileReader(self._info["filename"])
+            self.__negotiate(packet.option())
+
+            deny_reason = self.__check_source()
+            if deny_reason:
+                deny_packet.payload(deny_reason.encode())
+                return SchemeResult(
+                        source,
+                        deny_packet,
+                        False,
+                        Done(False, reason="{} by the receiver".format(deny_reason))
+                    )
+
+            self.__open_file(self._info["filename"])
 
             info_packet = self.__create_info_packet()
 
+            if info_packet is None:
+                deny_packet.payload(b"File too large")
+                return SchemeResult(
+                        source,
+                        deny_packet,
+                        False,
+                        Done(False, reason="File too large for the protocol version "
+                        "of the receiver ({})".format(self._version))
+                    )
+
             self._step = SenderStep.WAITING
+            self.__push_hashes(source)
 
             return SchemeResult(source, info_packet, True)
         else:
@@ -159,9 +693,47 @@ class SFTSenderScheme(Scheme):
     @csbuilder.response(SFTReceiverStates.ACCEPT)
     def resp_accept(self, source: str, packet: CSPacket):
         if self._step == SenderStep.REQUESTING:
+            if self._part is not None and \
+                    get_options(packet.option()).get(OPTION_PART, None) != encode_part(self._part):
+                deny_packet = self.generate_packet(self._states.DENY)
+                deny_packet.payload(b"Parallel transfer is not supported")
+                return SchemeResult(
+                        source,
+                        deny_packet,
+                        False,
+                        Done(False, reason="Parallel transfer is not supported by the receiver")
+                    )
+
+            self.__negotiate(packet.option())
+
+            deny_reason = self.__check_source()
+            if deny_reason:
+                deny_packet = self.generate_packet(self._states.DENY)
+                deny_packet.payload(deny_reason.encode())
+                return SchemeResult(
+                        source,
+                        deny_packet,
+                        False,
+                        Done(False, reason="{} by the receiver".format(deny_reason))
+                    )
+
+            self.__open_file(self._info["filename"])
+
             info_packet = self.__create_info_packet()
 
+            if info_packet is None:
+                deny_packet = self.generate_packet(self._states.DENY)
+                deny_packet.payload(b"File too large")
+                return SchemeResult(
+                        source,
+                        deny_packet,
+                        False,
+                        Done(False, reason="File too large for the protocol version "
+                        "of the receiver ({})".format(self._version))
+                    )
+
             self._step = SenderStep.WAITING
+            self.__push_hashes(source)
 
             return SchemeResult(source, info_packet, True, Done(None))
         else:
@@ -184,30 +756,117 @@ class SFTSenderScheme(Scheme):
         if self._step == SenderStep.SENDING or self._step == SenderStep.WAITING:
             payload = packet.payload()
 
-            boffset = payload[0: DEFAULT_INT_SIZE]
-            bbuffer_size = payload[DEFAULT_INT_SIZE: 2 * DEFAULT_INT_SIZE]
+            int_size = self._int_size
+
+            boffset = payload[0: int_size]
+            bbuffer_size = payload[int_size: 2 * int_size]
 
             offset = int.from_bytes(boffset, "big")
             buffer_size = int.from_bytes(bbuffer_size, "big")
 
+            # The window field is optional, legacy receivers don't send it and
+            # keep working in stop-and-wait mode.
+            bwindow_size = payload[2 * int_size: 3 * int_size]
+
             nbytes_to_read = min(buffer_size, self._buffer_size)
 
-            data = self._file.read(offset, nbytes_to_read)
+            # A throttled chunk is cut so that it doesn't wait too long, the
+            # receiver requires the rest again.
+            throttle = self.__get_throttle()
+            if throttle is not None and throttle.chunk_size() is not None:
+                nbytes_to_read = min(nbytes_to_read, throttle.chunk_size())
+
+            try:
+                with self._metrics.measure(PHASE_READ):
+                    data = self._file.read(offset, nbytes_to_read)
+            except Exception as e:
+                deny_packet = self.generate_packet(self._states.DENY)
+                deny_packet.payload(b"Invalid offset")
+                return SchemeResult(
+                        source,
+                        deny_packet,
+                        False,
+                        Done(False, reason="Invalid offset ({})".format(e))
+                    )
+
+            if not data and isinstance(self._file, StreamReader):
+                # Past the end of the stream, the receiver learns where it is
+                # from the DIGEST packet.
+                self.__push_digest(source)
+                return SchemeResult(source, None, True, Done(None))
+
+            self._metrics.bytes += len(data)
+            self._metrics.chunks += 1
 
             send_packet = self.generate_packet(self._states.SEND)
 
-            send_packet.option(offset.to_bytes(DEFAULT_INT_SIZE, "big"))
+            send_packet.option(offset.to_bytes(int_size, "big"))
+
+            if bwindow_size:
+                window_size = min(int.from_bytes(bwindow_size, "big"), self._window_size)
+                send_packet.update_option(window_size.to_bytes(int_size, "big"))
+
+            # Only receivers sending windows negotiate a codec, the codec
+            # follows the window in the option field.
+            if self._compressor is not None:
+                with self._metrics.measure(PHASE_COMPRESSION):
+                    codec, data = self._compressor.compress(data)
+
+                send_packet.update_option(codec.to_bytes(CODEC_SIZE, "big"))
+
+            self._metrics.wire_bytes += len(data)
+
+            self.__throttle(len(data))
+
             send_packet.payload(data)
 
+            self.__push_digest(source)
+
             self._step = SenderStep.SENDING
 
             return SchemeResult(source, send_packet, True, Done(None))
         else:
             return self.ignore(source, reason="Invalid payload")
 
+    @csbuilder.response(SFTReceiverStates.SIGNATURE)
+    def resp_signature(self, source: str, packet: CSPacket):
+        if self._step == SenderStep.WAITING and not isinstance(self._file, StreamReader):
+            try:
+                signatures = Signatures.from_bytes(packet.payload(), self._int_size)
+            except Exception as e:
+                deny_packet = self.generate_packet(self._states.DENY)
+                deny_packet.payload(b"Invalid signatures")
+                return SchemeResult(
+                        source,
+                        deny_packet,
+                        False,
+                        Done(False, reason="Invalid signatures ({})".format(e))
+                    )
+
+            with self._metrics.measure(PHASE_DELTA):
+                runs = match_blocks(self._file, signatures, self._buffer_size)
+
+            delta_packet = self.generate_packet(self._states.DELTA)
+            delta_packet.payload(encode_runs(runs, self._int_size))
+
+            if self._digest_pending:
+                # Reading at the end of the file hashes what the scan left.
+                with self._metrics.measure(PHASE_DIGEST):
+                    self._file.read(self._file.size(), 0)
+
+                self.__push_digest(source)
+
+            return SchemeResult(source, delta_packet, True, Done(None))
+        else:
+            return self.ignore(source, reason="Invalid step")
+
     @csbuilder.response(SFTReceiverStates.SUCCESS)
     def resp_success(self, source: str, packet: CSPacket):
         if self._step == SenderStep.SENDING or self._step == SenderStep.WAITING:
+            self._metrics.success = True
+            self._metrics.stop()
+            self._info["metrics"] = self._metrics.to_dict()
+
             return SchemeResult(
                     None,
                     None,
@@ -1,2 +1,3 @@
 from sft.qsft.client import QSFTClient
 from sft.qsft.server import QSFTServer
+from sft.qsft.pool import QSFTClientPool
@@ -1,33 +1,142 @@
 import os
+import copy
+import itertools
+from typing import Callable, List
 
+from hks_pylib.done import Done
 from hks_pylib.logger import Display
 from hks_pylib.logger.standard import StdUsers
 from hks_pylib.cryptography.ciphers.hkscipher import HKSCipher
 from hks_pylib.cryptography.ciphers.symmetrics import NoCipher
 from hks_pylib.logger.logger_generator import InvisibleLoggerGenerator, LoggerGenerator
 
+from sft.file import File
+from sft.cache import DigestCache
+from sft.hashes import HASH_SHA256, get_hashes, new_hash
+from sft.parallel import merge_results, local_nodes
 from sft.client import SFTClientResponser
 from sft.qsft.definition import DEFAULT_ADDRESS
 from sft.protocol.definition import SFTProtocols, SFTRoles
 
 
+# The local nodes of the clients need names which are unique in the process.
+_client_numbers = itertools.count(1)
+
+
+def new_client_name(prefix: str = "SFTClient") -> str:
+    return "{} #{}".format(prefix, next(_client_numbers))
+
+
 class QSFTClient(object):
     def __init__(self,
                 cipher: HKSCipher = NoCipher(),
                 address: tuple = DEFAULT_ADDRESS,
                 logger_generator: LoggerGenerator = InvisibleLoggerGenerator(),
-                display: dict = {StdUsers.DEV: Display.ALL}
+                display: dict = {StdUsers.DEV: Display.ALL},
+                keep_alive: bool = False,
+                name: str = None
             ):
-        self._client = SFTClientResponser(
+        """If keep_alive is True, the connection stays open after a transfer
+        and is used by the next ones until close() is called. The name must
+        be unique among the clients of the process, a unique one is
+        generated if it is None."""
+        if name is None:
+            name = new_client_name()
+
+        self._cipher = cipher
+        self._address = address
+        self._logger_generator = logger_generator
+        self._display = display
+        self._keep_alive = keep_alive
+        self._name = name
+
+        # The configurations are applied again to the extra connections of
+        # parallel transfers.
+        self._configs = []
+
+        self._client = self.__connect(copy.copy(cipher), name)
+
+    def __connect(self, cipher: HKSCipher, name: str) -> SFTClientResponser:
+        client = SFTClientResponser(
                 cipher=cipher,
-                address=address,
-                logger_generator=logger_generator,
-                display=display
+                address=self._address,
+                logger_generator=self._logger_generator,
+                display=self._display,
+                name=name
             )
 
-        self._client.connect()
+        for role, kwargs in self._configs:
+            client.session_manager().get_scheme(SFTProtocols.SFT, role).config(**kwargs)
+
+        client.connect()
+
+        client.start(True)
+
+        return client
+
+    def __connect_parts(self, parallel: int) -> List[SFTClientResponser]:
+        # The server may have closed the connection since the last transfer.
+        if not self._client.is_connected():
+            self._client.close()
+            self._client = self.__connect(copy.copy(self._cipher), self._name)
+
+        # Each connection needs its own cipher and node name.
+        clients = [self._client]
+        try:
+            for index in range(1, parallel):
+                name = "{} part {}".format(self._name, index)
+                clients.append(self.__connect(copy.copy(self._cipher), name))
+        except Exception:
+            for client in clients[1:]:
+                client.close()
+
+            raise
+
+        return clients
+
+    def __wait_results(self, clients: List[SFTClientResponser], role: SFTRoles) -> List[Done]:
+        results = []
+        for client in clients:
+            # A closed connection (e.g. a busy server rejected it) fails now.
+            results.append(client.wait_transfer_result(role))
+
+            if client is not self._client or not self._keep_alive:
+                client.close()
+
+        return results
+
+    def __transfer(self, role: SFTRoles, parallel: int, activate: Callable) -> List[Done]:
+        """Connect the parts, start them with activate(clients) and return
+        their results."""
+        if not isinstance(parallel, int) or parallel <= 0:
+            raise Exception("Parameter parallel must be a positive integer.")
+
+        # The extra connections of the parts take local nodes until they are
+        # closed.
+        with local_nodes(parallel - 1):
+            clients = self.__connect_parts(parallel)
 
-        self._client.start(True)
+            try:
+                activate(clients)
+            except Exception:
+                for client in clients[1:]:
+                    client.close()
+
+                raise
+
+            return self.__wait_results(clients, role)
+
+    def is_connected(self) -> bool:
+        return self._client.is_connected()
+
+    def close(self):
+        self._client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def config(self, role: SFTRoles, **kwargs):
         self._client.session_manager().get_scheme(
@@ -35,23 +144,68 @@ class QSFTClient(object):
                 role
             ).config(**kwargs)
 
-    def send(self, path: str):
-        if not os.path.isfile(path):
+        self._configs.append((role, kwargs))
+
+    def send(self, path: str, parallel: int = 1, stream=None):
+        """Send the file, split into parallel parts over as many connections
+        if parallel is greater than 1. A directory is sent with all of its
+        files in a single session. If stream is given (see
+        sft.file.open_stream), it is sent under the name path instead."""
+        if stream is not None:
+            if parallel != 1:
+                raise Exception("A stream can't be sent in parallel parts.")
+
+            def activate_stream(clients: List[SFTClientResponser]):
+                clients[0].activate(SFTProtocols.SFT, SFTRoles.SENDER, path=path, stream=stream)
+
+            return merge_results(self.__transfer(SFTRoles.SENDER, 1, activate_stream))
+
+        if not os.path.isfile(path) and not os.path.isdir(path):
             raise Exception("File not found.")
 
-        self._client.activate(SFTProtocols.SFT, SFTRoles.SENDER, path=path)
+        if parallel != 1 and os.path.isdir(path):
+            raise Exception("A directory can't be sent in parallel parts.")
 
-        result = self._client.wait_result(SFTProtocols.SFT, SFTRoles.SENDER, timeout=60)
+        def activate_parts(clients: List[SFTClientResponser]):
+            # Every part announces the digest of the whole file, it is
+            # computed only once for all of them.
+            if parallel > 1 and not any("digest_cache" in kwargs for _, kwargs in self._configs):
+                # The preferred hash algorithm of the sender, it is the one
+                # used unless the receiver doesn't accept it.
+                algorithm = HASH_SHA256
+                for role, kwargs in self._configs:
+                    if role == SFTRoles.SENDER and kwargs.get("hashes"):
+                        algorithm = get_hashes(kwargs["hashes"])[0]
 
-        self._client.close()
+                cache = DigestCache()
+                File(path).digest(new_hash(algorithm), cache=cache)
 
-        return result
+                for client in clients:
+                    client.get_scheme(SFTProtocols.SFT, SFTRoles.SENDER).config(digest_cache=cache)
 
-    def receive(self, filename):
-        self._client.activate(SFTProtocols.SFT, SFTRoles.RECEIVER, token=filename)
+            for index, client in enumerate(clients):
+                part = (index, parallel) if parallel > 1 else None
+                client.activate(SFTProtocols.SFT, SFTRoles.SENDER, path=path, part=part)
 
-        result = self._client.wait_result(SFTProtocols.SFT, SFTRoles.RECEIVER, timeout=60)
+        return merge_results(self.__transfer(SFTRoles.SENDER, parallel, activate_parts))
 
-        self._client.close()
+    def receive(self, filename, parallel: int = 1, sink=None):
+        """Receive the file, split into parallel parts over as many
+        connections if parallel is greater than 1. If sink is given (see
+        sft.sink.get_sink), the data is passed to it instead of being
+        written into the directory."""
+        if sink is not None and parallel != 1:
+            raise Exception("A file can't be received into a sink in parallel parts.")
+
+        kwargs = {}
+        if sink is not None:
+            kwargs["sink"] = sink
+
+        def activate_parts(clients: List[SFTClientResponser]):
+            for index, client in enumerate(clients):
+                part = (index, parallel) if parallel > 1 else None
+                client.activate(SFTProtocols.SFT, SFTRoles.RECEIVER, token=filename, part=part, **kwargs)
+
+        results = self.__transfer(SFTRoles.RECEIVER, parallel, activate_parts)
 
-        return result
+        return merge_results(results, verify=True)
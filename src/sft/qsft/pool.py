@@ -0,0 +1,167 @@
+import copy
+import threading
+from typing import Dict, List
+
+from hks_pylib.done import Done
+from hks_pylib.logger import Display
+from hks_pylib.logger.standard import StdUsers
+from hks_pylib.cryptography.ciphers.hkscipher import HKSCipher
+from hks_pylib.cryptography.ciphers.symmetrics import NoCipher
+from hks_pylib.logger.logger_generator import InvisibleLoggerGenerator, LoggerGenerator
+
+from sft.parallel import reserve_local_nodes, release_local_nodes
+from sft.qsft.client import QSFTClient, new_client_name
+from sft.protocol import DEFAULT_TIMEOUT
+from sft.protocol.definition import SFTRoles
+
+
+DEFAULT_POOL_SIZE = 4  # connections per address
+
+
+class QSFTClientPool(object):
+    """A pool of kept-alive QSFTClients, keyed by the address of the server.
+
+    Threads sending or receiving at the same time use different connections,
+    at most max_size connections are opened to each address. A connection
+    is reused by the next transfers unless a transfer over it fails.
+    """
+    def __init__(self,
+                cipher: HKSCipher = NoCipher(),
+                max_size: int = DEFAULT_POOL_SIZE,
+                logger_generator: LoggerGenerator = InvisibleLoggerGenerator(),
+                display: dict = {StdUsers.DEV: Display.ALL}
+            ) -> None:
+        if not isinstance(max_size, int) or max_size <= 0:
+            raise Exception("Parameter max_size must be a positive integer.")
+
+        self._cipher = cipher
+        self._max_size = max_size
+        self._logger_generator = logger_generator
+        self._display = display
+
+        self._configs = []
+
+        self._idle_clients: Dict[tuple, List[QSFTClient]] = {}
+        self._nclients: Dict[tuple, int] = {}
+        self._is_closed = False
+
+        self._condition = threading.Condition()
+
+    def config(self, role: SFTRoles, **kwargs):
+        """Configure the clients which are created from now on."""
+        self._configs.append((role, kwargs))
+
+    def __create_client(self, address: tuple) -> QSFTClient:
+        # The local nodes of the connection are given back when the client
+        # is closed.
+        reserve_local_nodes(1)
+
+        try:
+            client = QSFTClient(
+                    cipher=copy.copy(self._cipher),
+                    address=address,
+                    logger_generator=self._logger_generator,
+                    display=self._display,
+                    keep_alive=True,
+                    name=new_client_name("SFTClient {}:{}".format(address[0], address[1]))
+                )
+        except Exception:
+            release_local_nodes(1)
+            raise
+
+        for role, kwargs in self._configs:
+            client.config(role, **kwargs)
+
+        return client
+
+    def __close_client(self, client: QSFTClient):
+        client.close()
+        release_local_nodes(1)
+
+    def acquire(self, address: tuple, timeout: float = DEFAULT_TIMEOUT) -> QSFTClient:
+        """Return a client connected to the address, wait for a client to be
+        released if there are already max_size of them."""
+        address = tuple(address)
+
+        with self._condition:
+            while True:
+                if self._is_closed:
+                    raise Exception("The pool is closed.")
+
+                idle_clients = self._idle_clients.setdefault(address, [])
+                while idle_clients:
+                    client = idle_clients.pop()
+                    if client.is_connected():
+                        return client
+
+                    self.__close_client(client)
+                    self._nclients[address] -= 1
+
+                if self._nclients.get(address, 0) < self._max_size:
+                    self._nclients[address] = self._nclients.get(address, 0) + 1
+                    break
+
+                if not self._condition.wait(timeout):
+                    raise Exception("No connection to {} is available.".format(address))
+
+        try:
+            return self.__create_client(address)
+        except Exception:
+            with self._condition:
+                self._nclients[address] -= 1
+                self._condition.notify()
+
+            raise
+
+    def release(self, client: QSFTClient, address: tuple, discard: bool = False):
+        """Give the client back to the pool. The connection is closed if
+        discard is True (e.g. its last transfer failed)."""
+        address = tuple(address)
+
+        with self._condition:
+            if discard or self._is_closed or not client.is_connected():
+                self.__close_client(client)
+                self._nclients[address] -= 1
+            else:
+                self._idle_clients.setdefault(address, []).append(client)
+
+            self._condition.notify()
+
+    def send(self, address: tuple, path: str, parallel: int = 1) -> Done:
+        client = self.acquire(address)
+
+        try:
+            result = client.send(path, parallel)
+        except Exception:
+            self.release(client, address, discard=True)
+            raise
+
+        self.release(client, address, discard=not result.value)
+
+        return result
+
+    def receive(self, address: tuple, filename: str, parallel: int = 1) -> Done:
+        client = self.acquire(address)
+
+        try:
+            result = client.receive(filename, parallel)
+        except Exception:
+            self.release(client, address, discard=True)
+            raise
+
+        self.release(client, address, discard=not result.value)
+
+        return result
+
+    def close(self):
+        with self._condition:
+            self._is_closed = True
+
+            for address, idle_clients in self._idle_clients.items():
+                for client in idle_clients:
+                    self.__close_client(client)
+
+                self._nclients[address] -= len(idle_clients)
+                idle_clients.clear()
+
+            self._condition.notify_all()
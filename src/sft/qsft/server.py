@@ -1,12 +1,15 @@
-import os
+from typing import List
 
+from hks_pylib.done import Done
 from hks_pylib.logger import Display
 from hks_pylib.logger.standard import StdUsers
 from hks_pylib.cryptography.ciphers.hkscipher import HKSCipher
 from hks_pylib.cryptography.ciphers.symmetrics import NoCipher
 from hks_pylib.logger.logger_generator import InvisibleLoggerGenerator, LoggerGenerator
 
-from sft.listener import SFTListener
+from sft.listener import SFTListener, DEFAULT_MAX_CONNECTIONS
+from sft.server import SFTServerResponser
+from sft.parallel import merge_results
 from sft.qsft.definition import DEFAULT_ADDRESS
 from sft.protocol.definition import SFTProtocols, SFTRoles
 
@@ -16,40 +19,67 @@ class QSFTServer(object):
                 address: tuple = DEFAULT_ADDRESS,
                 cipher: HKSCipher = NoCipher(),
                 logger_generator: LoggerGenerator = InvisibleLoggerGenerator(),
-                display: dict = {StdUsers.DEV: Display.ALL}
+                display: dict = {StdUsers.DEV: Display.ALL},
+                keep_alive: bool = False,
+                max_connections: int = DEFAULT_MAX_CONNECTIONS
             ) -> None:
+        """If keep_alive is True, the listener and the connection of the client
+        stay open after a transfer, the next send() or receive() serves the
+        next transfer of the same client until close() is called.
+        max_connections bounds the parallel parts of a transfer."""
 
         self._listener = SFTListener(
                 cipher=cipher,
                 address=address,
+                max_connections=max_connections,
                 logger_generator=logger_generator,
                 display=display
             )
 
+        self._keep_alive = keep_alive
+        self._is_listening = False
+        self._responser: SFTServerResponser = None
+
     def config(self, role: SFTRoles, **kwargs):
         self._listener.session_manager().get_session(
                 SFTProtocols.SFT,
                 role
             ).scheme().config(**kwargs)
 
-    def send(self):
-        self._listener.listen()
-        self._server = self._listener.accept()
-        self._listener.close()
+    def __serve(self, role: SFTRoles) -> List[Done]:
+        if not self._is_listening:
+            self._listener.listen()
+            self._is_listening = True
 
-        result = self._server.wait_result(SFTProtocols.SFT, SFTRoles.SENDER)
+        # The client may have closed the kept-alive connection.
+        if self._responser is not None and not self._responser.is_connected():
+            self._responser.close()
+            self._responser = None
 
-        self._server.close()
+        if self._responser is None:
+            self._responser = self._listener.next_responser()
 
-        return result
+        if self._responser is None:
+            results = [Done(False, reason="No client connected")]
+        else:
+            results = self._listener.accept_parts(role, responser=self._responser)
 
-    def receive(self):
-        self._listener.listen()
-        self._server = self._listener.accept()
-        self._listener.close()
+        if not self._keep_alive:
+            self.close()
+
+        return results
 
-        result = self._server.wait_result(SFTProtocols.SFT, SFTRoles.RECEIVER)
+    def send(self):
+        return merge_results(self.__serve(SFTRoles.SENDER))
+
+    def receive(self):
+        return merge_results(self.__serve(SFTRoles.RECEIVER), verify=True)
 
-        self._server.close()
+    def close(self):
+        if self._responser is not None:
+            self._responser.close()
+            self._responser = None
 
-        return result
+        if self._is_listening:
+            self._listener.close()
+            self._is_listening = False
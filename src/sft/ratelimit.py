@@ -0,0 +1,210 @@
+import time
+import threading
+from typing import Dict, List
+
+
+DEFAULT_BURST_TIME = 0.5  # seconds of the rate which may go at once
+MAX_THROTTLE_DELAY = 1  # seconds, a chunk is cut so that it waits at most this long
+MIN_THROTTLED_CHUNK_SIZE = 2 ** 12  # bytes
+
+
+class TokenBucket(object):
+    """A token bucket of rate bytes per second which holds at most burst
+    bytes.
+
+    The tokens may go negative: the bytes taken beyond the bucket are a debt
+    which the caller waits for, so that a chunk larger than the bucket still
+    goes, at the rate.
+    """
+    def __init__(self, rate: float, burst: float = None) -> None:
+        self._rate = rate
+        self._burst = burst if burst is not None else rate * DEFAULT_BURST_TIME
+        self._tokens = self._burst
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def rate(self) -> float:
+        return self._rate
+
+    def __refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._last_time) * self._rate)
+        self._last_time = now
+
+    def set_rate(self, rate: float, burst: float = None):
+        with self._lock:
+            self.__refill()
+            self._rate = rate
+            self._burst = burst if burst is not None else rate * DEFAULT_BURST_TIME
+            self._tokens = min(self._tokens, self._burst)
+
+    def reserve(self, nbytes: int) -> float:
+        """Take nbytes, return the seconds to wait before they may go."""
+        with self._lock:
+            self.__refill()
+            self._tokens -= nbytes
+
+            if self._tokens >= 0:
+                return 0.0
+
+            return -self._tokens / self._rate
+
+
+class Throttle(object):
+    """The share of the bandwidth of a single transfer, see
+    RateLimiter.open()."""
+    def __init__(self, limiter, peer: str, weight: float) -> None:
+        self._limiter = limiter
+        self._peer = peer
+        self._weight = weight
+
+        # The share of the global rate, capped by the rate of a session.
+        self._bucket: TokenBucket = None
+
+        self._is_closed = False
+
+    def peer(self) -> str:
+        return self._peer
+
+    def weight(self) -> float:
+        return self._weight
+
+    def __buckets(self) -> List[TokenBucket]:
+        buckets = [self._limiter.get_peer_bucket(self._peer)]
+        if self._bucket is not None:
+            buckets.append(self._bucket)
+
+        return [bucket for bucket in buckets if bucket is not None]
+
+    def chunk_size(self) -> int:
+        """Return the size of the largest chunk which should go at once, or
+        None if the transfer is not limited."""
+        rates = [bucket.rate() for bucket in self.__buckets()]
+        if not rates:
+            return None
+
+        return max(MIN_THROTTLED_CHUNK_SIZE, int(min(rates) * MAX_THROTTLE_DELAY))
+
+    def wait(self, nbytes: int) -> float:
+        """Wait until nbytes may go, return the seconds waited."""
+        delay = max([bucket.reserve(nbytes) for bucket in self.__buckets()], default=0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+        return delay
+
+    def close(self):
+        if not self._is_closed:
+            self._is_closed = True
+            self._limiter._close(self)
+
+
+class RateLimiter(object):
+    """Limit the bandwidth of the transfers globally, per peer and per
+    session with token buckets.
+
+    The global rate is shared between the open transfers in proportion to
+    their weights, so that concurrent transfers get a predictable share of
+    it instead of the first one taking everything. The share of a
+    transfer is updated each time a transfer starts or ends. The transfers
+    of a peer share the bucket of the peer. A rate of None is not limited.
+
+    The limiter is shared by all sessions which are cloned from the same
+    scheme, the schemes of several listeners may share one limiter too.
+    """
+    def __init__(self,
+                    rate: float = None,
+                    peer_rate: float = None,
+                    session_rate: float = None,
+                    burst_time: float = DEFAULT_BURST_TIME
+                ) -> None:
+        for name, value in (("rate", rate), ("peer_rate", peer_rate), ("session_rate", session_rate)):
+            if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+                raise Exception("Parameter {} must be a positive number.".format(name))
+
+        if not isinstance(burst_time, (int, float)) or burst_time <= 0:
+            raise Exception("Parameter burst_time must be a positive number.")
+
+        self._rate = rate
+        self._peer_rate = peer_rate
+        self._session_rate = session_rate
+        self._burst_time = burst_time
+
+        self._throttles: List[Throttle] = []
+
+        # The bucket of each peer and the number of its open transfers.
+        self._peer_buckets: Dict[str, TokenBucket] = {}
+        self._peer_counts: Dict[str, int] = {}
+
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def open(self, peer: str = None, weight: float = 1) -> Throttle:
+        """Return the throttle of a new transfer with peer, which must be
+        closed once the transfer ends."""
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            raise Exception("Parameter weight must be a positive number.")
+
+        throttle = Throttle(self, peer, weight)
+
+        with self._lock:
+            self._throttles.append(throttle)
+
+            if self._peer_rate is not None:
+                if peer not in self._peer_buckets:
+                    self._peer_buckets[peer] = TokenBucket(
+                            self._peer_rate, self._peer_rate * self._burst_time)
+                    self._peer_counts[peer] = 0
+
+                self._peer_counts[peer] += 1
+
+            self.__share()
+
+        return throttle
+
+    def _close(self, throttle: Throttle):
+        with self._lock:
+            self._throttles.remove(throttle)
+
+            peer = throttle.peer()
+            if peer in self._peer_counts:
+                self._peer_counts[peer] -= 1
+
+                if self._peer_counts[peer] == 0:
+                    del self._peer_counts[peer]
+                    del self._peer_buckets[peer]
+
+            self.__share()
+
+    def get_peer_bucket(self, peer: str) -> TokenBucket:
+        return self._peer_buckets.get(peer, None)
+
+    def shares(self) -> Dict[Throttle, float]:
+        """Return the rate of each open transfer, None if it is not
+        limited."""
+        with self._lock:
+            return {throttle: self.__get_share(throttle) for throttle in self._throttles}
+
+    def __get_share(self, throttle: Throttle) -> float:
+        rates = []
+        if self._rate is not None:
+            total_weight = sum(other.weight() for other in self._throttles)
+            rates.append(self._rate * throttle.weight() / total_weight)
+
+        if self._session_rate is not None:
+            rates.append(self._session_rate)
+
+        return min(rates) if rates else None
+
+    def __share(self):
+        for throttle in self._throttles:
+            rate = self.__get_share(throttle)
+            if rate is None:
+                continue
+
+            if throttle._bucket is None:
+                throttle._bucket = TokenBucket(rate, rate * self._burst_time)
+            else:
+                throttle._bucket.set_rate(rate, rate * self._burst_time)
@@ -0,0 +1,234 @@
+import copy
+import time
+import socket as pysocket
+
+from hks_pylib.done import Done
+from hks_pynetwork.external import STCPSocket
+from hks_pynetwork.secure_packet import SecurePacketDecoder
+
+from csbuilder.scheme import Scheme
+from csbuilder.session import Session
+from csbuilder.cspacket import CSPacket
+
+from sft.metrics import Stopwatch, PHASE_CRYPTO
+from sft.protocol import SFTProtocols, SFTRoles
+
+
+SOCKET_RELOAD_TIME = 0.001  # seconds
+
+# The responses which are still on their way to the socket when the
+# connection is closed are waited for at most this long.
+FLUSH_TIMEOUT = 1  # seconds
+POLL_INTERVAL = 0.5  # seconds
+
+
+def separate_ciphers(socket: STCPSocket, stopwatch: Stopwatch = None):
+    """STCPSocket encrypts outgoing and decrypts incoming packets with the same
+    cipher object, which breaks as soon as packets flow in both directions at
+    the same time (e.g. pipelined REQUIRE/SEND). Give the receiving side its
+    own copy of the cipher. The decryption is timed by stopwatch, if any."""
+    packet_buffer = socket._STCPSocket__buffer
+    cipher = copy.copy(packet_buffer._packet_decoder.cipher)
+    decoder = SecurePacketDecoder(cipher)
+
+    if stopwatch is not None:
+        decode = decoder.decode
+
+        def timed_decode(*args, **kwargs):
+            with stopwatch.measure():
+                return decode(*args, **kwargs)
+
+        decoder.decode = timed_decode
+
+    packet_buffer._packet_decoder = decoder
+
+
+def send_completely(socket: STCPSocket, stopwatch: Stopwatch = None):
+    """STCPSocket sends a packet with a single send() call on a socket with a
+    timeout, the end of a packet which doesn't fit in the socket buffer
+    (e.g. a chunk of a few MB) is silently dropped. Send the whole packet.
+    The encryption is timed by stopwatch, if any. The packets which are
+    sent completely are counted in socket.sent_packets."""
+    encoder = socket._STCPSocket__packet_encoder
+    socket.sent_packets = 0
+
+    def send(data: bytes) -> int:
+        start = time.perf_counter()
+        encoder.cipher.reset()
+        packet = memoryview(encoder.encode(data))
+
+        if stopwatch is not None:
+            stopwatch.add(time.perf_counter() - start)
+
+        sent_size = 0
+        while sent_size < len(packet):
+            try:
+                sent_size += socket._socket.send(packet[sent_size:])
+            except pysocket.timeout:
+                if socket.isclosed():
+                    raise
+
+        socket.sent_packets += 1
+
+        return sent_size
+
+    socket.send = send
+
+
+def prepare_socket(socket: STCPSocket) -> Stopwatch:
+    """Fix the STCPSocket of a connection before it is used by SFT, return
+    the stopwatch of the time spent encrypting and decrypting its packets."""
+    stopwatch = Stopwatch()
+
+    separate_ciphers(socket, stopwatch)
+    send_completely(socket, stopwatch)
+
+    # STCPSocket sleeps this long each time a packet is still incomplete,
+    # that is for each TCP segment of a large packet.
+    socket.set_reload_time(SOCKET_RELOAD_TIME)
+
+    return stopwatch
+
+
+def rebind_session_hooks(session: Session):
+    """A cloned session keeps the hooks of the original one, so its begin
+    and cancel hooks reset the original scheme and result instead of its
+    own. A connection serving several transfers needs its scheme to be reset
+    after each one, the hooks are bound to the clone again."""
+    scheme = session.scheme()
+
+    for hooks in (session._begin_hook, session._cancel_hook, session._timeout_hook):
+        rebound_hooks = {}
+        for hook_fn, arguments in hooks.items():
+            owner = getattr(hook_fn, "__self__", None)
+
+            if isinstance(owner, Session):
+                hook_fn = getattr(session, hook_fn.__name__)
+            elif isinstance(owner, Scheme):
+                hook_fn = getattr(scheme, hook_fn.__name__)
+
+            rebound_hooks[hook_fn] = arguments
+
+        hooks.clear()
+        hooks.update(rebound_hooks)
+
+
+class SFTResponser(object):
+    """Mixin flushing the extra packets which SFT schemes queued while they
+    were responding (see `SFTScheme.push_packet`), it also tracks when the
+    connection was last active.
+
+    The result of a transfer is set before its last response is sent, a
+    connection is only closed once the responses which were handed to the
+    forwarder are sent (see flush()), so that the peer ends its transfer
+    too."""
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+
+        self._last_activity = time.monotonic()
+
+        # Set by the subclasses once the socket is prepared.
+        self._crypto_stopwatch: Stopwatch = None
+
+        # A packet is being answered, and the number of the packets handed
+        # to the forwarder.
+        self._is_responding = False
+        self._forwarded_packets = 0
+
+    def get_response(self, source: str, packet: CSPacket):
+        self._last_activity = time.monotonic()
+        self._is_responding = True
+
+        # The packets are encrypted and decrypted by other threads, the time
+        # spent since the previous packet goes to the scheme answering this
+        # one.
+        try:
+            if self._crypto_stopwatch is not None and packet is not None \
+                    and packet.protocol() == SFTProtocols.SFT:
+                role = SFTRoles.RECEIVER if packet.role() == SFTRoles.SENDER else SFTRoles.SENDER
+                scheme = self.session_manager().get_scheme(SFTProtocols.SFT, role)
+                scheme.metrics().add_time(PHASE_CRYPTO, self._crypto_stopwatch.take())
+
+            return super().get_response(source, packet)
+        except Exception:
+            self._is_responding = False
+            raise
+
+    def __send_response(self, destination: str, response_packet: CSPacket) -> bool:
+        is_sent = super().send_response(destination, response_packet)
+        if is_sent and destination == self._forwarder.name:
+            self._forwarded_packets += 1
+
+        return is_sent
+
+    def send_response(self, destination: str, response_packet: CSPacket) -> bool:
+        try:
+            is_sent = self.__send_response(destination, response_packet)
+
+            for role in (SFTRoles.SENDER, SFTRoles.RECEIVER):
+                scheme = self.session_manager().get_scheme(SFTProtocols.SFT, role)
+
+                for extra_destination, extra_packet in scheme.pop_packets():
+                    self.__send_response(extra_destination, extra_packet)
+        finally:
+            self._is_responding = False
+
+        return is_sent
+
+    def flush(self, timeout: float = FLUSH_TIMEOUT) -> bool:
+        """Wait until the responses handed to the forwarder are sent, return
+        False if the connection closes or the timeout passes first."""
+        end_time = time.monotonic() + timeout
+        while self._is_responding \
+                or getattr(self._socket, "sent_packets", 0) < self._forwarded_packets:
+            if not self.is_connected() or self._forwarder._closed or time.monotonic() >= end_time:
+                return False
+
+            time.sleep(SOCKET_RELOAD_TIME)
+
+        return True
+
+    def wait_transfer_result(self, role: SFTRoles, timeout: float = None) -> Done:
+        """Wait for the result of the transfer of the role, it fails as soon
+        as the connection is closed. Return None if the timeout passes
+        first, the session times out by itself if the peer stops
+        responding."""
+        end_time = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            wait_time = POLL_INTERVAL
+            if end_time is not None:
+                wait_time = min(wait_time, end_time - time.monotonic())
+                if wait_time <= 0:
+                    return None
+
+            result = self.wait_result(SFTProtocols.SFT, role, timeout=wait_time)
+            if result is not None:
+                return result
+
+            if not self.is_connected():
+                # The last packets of the peer may still be processed.
+                result = self.wait_result(SFTProtocols.SFT, role, timeout=POLL_INTERVAL)
+                if result is None:
+                    result = Done(False, reason="Connection closed")
+
+                return result
+
+    def close(self) -> None:
+        self.flush()
+        super().close()
+
+    def is_connected(self) -> bool:
+        return self._socket.isworking()
+
+    def is_busy(self) -> bool:
+        """Return True if a transfer is in process on this connection."""
+        for role in (SFTRoles.SENDER, SFTRoles.RECEIVER):
+            if self.session_manager().get_session(SFTProtocols.SFT, role)._is_running:
+                return True
+
+        return False
+
+    def idle_time(self) -> float:
+        """Return the seconds since the last packet was received, or since
+        the connection was established."""
+        return time.monotonic() - self._last_activity
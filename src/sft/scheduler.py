@@ -0,0 +1,224 @@
+import time
+import asyncio
+import itertools
+import threading
+from typing import Callable, List
+
+
+# The priority classes of the transfers, the lower the sooner.
+PRIORITY_URGENT = 0  # latency-sensitive, e.g. small configuration pushes
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2  # e.g. backups
+
+DEFAULT_MAX_TRANSFERS = 4
+DEFAULT_ADMISSION_DEADLINE = 30  # seconds, less than the timeout of the sessions
+DEFAULT_AGING_TIME = 10  # seconds of waiting which raise a transfer by one class
+
+# The order of the waiting transfers changes as they age, they check it again
+# at least this often.
+POLL_INTERVAL = 1  # seconds
+
+# The transfers waiting in an event loop are not notified, they check
+# whether they may run this often.
+ASYNC_POLL_INTERVAL = 0.05  # seconds
+
+
+def default_priority(token: str, detoken_value) -> int:
+    """Take the priority from the detoken result if it has one (e.g. an
+    object with a priority attribute), PRIORITY_NORMAL otherwise."""
+    priority = getattr(detoken_value, "priority", PRIORITY_NORMAL)
+    if isinstance(detoken_value, dict):
+        priority = detoken_value.get("priority", priority)
+
+    return priority
+
+
+class Slot(object):
+    """The right of a transfer to run, see TransferScheduler.admit()."""
+    def __init__(self, scheduler, priority: int) -> None:
+        self._scheduler = scheduler
+        self._priority = priority
+        self._is_released = False
+
+    def priority(self) -> int:
+        return self._priority
+
+    def release(self):
+        if not self._is_released:
+            self._is_released = True
+            self._scheduler._release(self)
+
+
+class _Waiter(object):
+    def __init__(self, priority: int, sequence: int) -> None:
+        self.priority = priority
+        self.sequence = sequence
+        self.arrival_time = time.monotonic()
+
+
+class TransferScheduler(object):
+    """Admit the transfers of a server by priority.
+
+    At most max_transfers transfers run at the same time, the next ones
+    wait in a queue until a transfer ends. The waiting transfer of the
+    lowest priority class goes first, in order of arrival within a class. A
+    transfer is raised by one class for each aging_time seconds it waits,
+    so that bulk transfers are not starved by a stream of urgent ones. A
+    transfer which is not admitted within deadline seconds is denied.
+
+    The priority of a transfer is given by priority_fn(token, detoken_value)
+    (see default_priority). The scheduler is shared by all sessions which
+    are cloned from the same scheme, both schemes of a server should be
+    given the same scheduler.
+
+    A waiting transfer of a threaded server holds the thread of its
+    connection until it is admitted or denied, so a server runs up to
+    max_transfers plus the waiting transfers threads. The connections of
+    sft.aio wait in the event loop instead (see admit_async()), they don't
+    hold a thread of the executor.
+    """
+    def __init__(self,
+                    max_transfers: int = DEFAULT_MAX_TRANSFERS,
+                    deadline: float = DEFAULT_ADMISSION_DEADLINE,
+                    aging_time: float = DEFAULT_AGING_TIME,
+                    priority_fn: Callable = default_priority
+                ) -> None:
+        if not isinstance(max_transfers, int) or max_transfers <= 0:
+            raise Exception("Parameter max_transfers must be a positive integer.")
+
+        if deadline is not None and (not isinstance(deadline, (int, float)) or deadline <= 0):
+            raise Exception("Parameter deadline must be positive or None.")
+
+        if aging_time is not None and (not isinstance(aging_time, (int, float)) or aging_time <= 0):
+            raise Exception("Parameter aging_time must be positive or None.")
+
+        if not callable(priority_fn):
+            raise Exception("Parameter priority_fn must be a Callable.")
+
+        self._max_transfers = max_transfers
+        self._deadline = deadline
+        self._aging_time = aging_time
+        self._priority_fn = priority_fn
+
+        self._active_slots: List[Slot] = []
+        self._waiters: List[_Waiter] = []
+        self._sequence = itertools.count()
+
+        self._condition = threading.Condition()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def get_priority(self, token: str, detoken_value=None) -> int:
+        priority = self._priority_fn(token, detoken_value)
+        if not isinstance(priority, int):
+            raise Exception("The priority must be an int.")
+
+        return priority
+
+    def active_transfers(self) -> int:
+        with self._condition:
+            return len(self._active_slots)
+
+    def waiting_transfers(self) -> int:
+        with self._condition:
+            return len(self._waiters)
+
+    def __get_key(self, waiter: _Waiter, now: float):
+        priority = waiter.priority
+        if self._aging_time is not None:
+            priority -= (now - waiter.arrival_time) / self._aging_time
+
+        return priority, waiter.sequence
+
+    def __is_next(self, waiter: _Waiter) -> bool:
+        now = time.monotonic()
+        return min(self._waiters, key=lambda other: self.__get_key(other, now)) is waiter
+
+    def __enqueue(self, priority: int) -> _Waiter:
+        waiter = _Waiter(priority, next(self._sequence))
+        self._waiters.append(waiter)
+
+        return waiter
+
+    def __take_slot(self, waiter: _Waiter) -> Slot:
+        """Return the slot of the waiter if it may run now, None otherwise."""
+        if len(self._active_slots) >= self._max_transfers or not self.__is_next(waiter):
+            return None
+
+        slot = Slot(self, waiter.priority)
+        self._active_slots.append(slot)
+
+        return slot
+
+    def __dequeue(self, waiter: _Waiter):
+        self._waiters.remove(waiter)
+
+        # The next waiter may run if a slot is free.
+        self._condition.notify_all()
+
+    def __get_end_time(self, deadline: float) -> float:
+        if deadline is None:
+            deadline = self._deadline
+
+        return time.monotonic() + deadline if deadline is not None else None
+
+    def admit(self, priority: int = PRIORITY_NORMAL, deadline: float = None) -> Slot:
+        """Wait until the transfer may run, return its slot which must be
+        released once the transfer ends, or None if the deadline (by default
+        the one of the scheduler) passes first.
+
+        The calling thread is blocked while the transfer waits, see
+        admit_async() for an event loop."""
+        end_time = self.__get_end_time(deadline)
+
+        with self._condition:
+            waiter = self.__enqueue(priority)
+
+            try:
+                while True:
+                    slot = self.__take_slot(waiter)
+                    if slot is not None:
+                        return slot
+
+                    timeout = POLL_INTERVAL
+                    if end_time is not None:
+                        remaining_time = end_time - time.monotonic()
+                        if remaining_time <= 0:
+                            return None
+
+                        timeout = min(timeout, remaining_time)
+
+                    self._condition.wait(timeout)
+            finally:
+                self.__dequeue(waiter)
+
+    async def admit_async(self, priority: int = PRIORITY_NORMAL, deadline: float = None) -> Slot:
+        """The awaitable version of admit(), the transfer waits in the event
+        loop instead of holding a thread. It is queued along with the
+        transfers waiting in admit()."""
+        end_time = self.__get_end_time(deadline)
+
+        with self._condition:
+            waiter = self.__enqueue(priority)
+
+        try:
+            while True:
+                with self._condition:
+                    slot = self.__take_slot(waiter)
+
+                if slot is not None:
+                    return slot
+
+                if end_time is not None and time.monotonic() >= end_time:
+                    return None
+
+                await asyncio.sleep(ASYNC_POLL_INTERVAL)
+        finally:
+            with self._condition:
+                self.__dequeue(waiter)
+
+    def _release(self, slot: Slot):
+        with self._condition:
+            self._active_slots.remove(slot)
+            self._condition.notify_all()
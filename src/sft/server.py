@@ -0,0 +1,13 @@
+from hks_pynetwork.external import STCPSocket
+
+from csbuilder.server import ServerResponser
+
+from sft.responser import SFTResponser, prepare_socket
+
+
+class SFTServerResponser(SFTResponser, ServerResponser):
+    def __init__(self, socket: STCPSocket, *args, **kwargs) -> None:
+        crypto_stopwatch = prepare_socket(socket)
+        super().__init__(socket, *args, **kwargs)
+
+        self._crypto_stopwatch = crypto_stopwatch
@@ -0,0 +1,246 @@
+import queue
+import socket
+import threading
+import time
+from typing import List
+
+from hks_pylib.logger import LoggerGenerator, Display
+from hks_pylib.logger import InvisibleLoggerGenerator
+from hks_pylib.logger.standard import StdUsers, StdLevels
+from hks_pylib.cryptography.ciphers.hkscipher import HKSCipher
+
+from sft.listener import SFTListener
+from sft.server import SFTServerResponser
+from sft.scheduler import TransferScheduler
+from sft.protocol import DEFAULT_TIMEOUT
+from sft.protocol import DEFAULT_BUFFER_SIZE
+from sft.protocol import SFTProtocols, SFTRoles
+
+
+DEFAULT_MAX_SESSIONS = 8  # connections served at the same time
+DEFAULT_MAX_QUEUE_SIZE = 16  # connections waiting for a worker
+
+POLL_INTERVAL = 0.5  # seconds
+
+
+class SFTService(object):
+    """A long-running server serving many clients at the same time.
+
+    The connections are accepted continuously and served by a bounded pool
+    of max_sessions worker threads. At most max_queue_size accepted
+    connections wait for a free worker, the next ones are closed right away.
+    A worker serves every transfer of its connection until the client
+    disconnects or the connection is idle for idle_timeout seconds.
+
+    If a scheduler is given, the transfers requested by the clients are
+    admitted by priority (see sft.scheduler). A transfer waiting to be
+    admitted holds its worker, max_sessions should leave room above the
+    max_transfers of the scheduler for the urgent transfers to come in.
+    """
+    def __init__(self,
+                cipher: HKSCipher,
+                address: tuple,
+                max_sessions: int = DEFAULT_MAX_SESSIONS,
+                max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+                idle_timeout: float = DEFAULT_TIMEOUT,
+                scheduler: TransferScheduler = None,
+                name: str = "SFTService",
+                buffer_size: int = DEFAULT_BUFFER_SIZE,
+                logger_generator: LoggerGenerator = InvisibleLoggerGenerator(),
+                display: dict = {StdUsers.DEV: Display.ALL}
+            ) -> None:
+        if not isinstance(max_sessions, int) or max_sessions <= 0:
+            raise Exception("Parameter max_sessions must be a positive integer.")
+
+        if not isinstance(max_queue_size, int) or max_queue_size < 0:
+            raise Exception("Parameter max_queue_size must be a non-negative integer.")
+
+        if idle_timeout is not None and idle_timeout <= 0:
+            raise Exception("Parameter idle_timeout must be positive or None.")
+
+        if scheduler is not None and not isinstance(scheduler, TransferScheduler):
+            raise Exception("Parameter scheduler must be a TransferScheduler.")
+
+        self._listener = SFTListener(
+                cipher=cipher,
+                address=address,
+                name=name,
+                buffer_size=buffer_size,
+                # All the connections which may be open at once, and the one
+                # which is being accepted.
+                max_connections=max_sessions + max_queue_size + 1,
+                logger_generator=logger_generator,
+                display=display
+            )
+
+        self._name = name
+        self._max_sessions = max_sessions
+        self._max_queue_size = max_queue_size
+        self._idle_timeout = idle_timeout
+
+        self._print = logger_generator.generate(name, display)
+
+        if scheduler is not None:
+            for role in (SFTRoles.SENDER, SFTRoles.RECEIVER):
+                self.config(role, scheduler=scheduler)
+
+        # The size of the queue is checked when a connection is accepted, a
+        # queue.Queue of size 0 would be unbounded.
+        self._waiting_responsers: queue.Queue = queue.Queue()
+        self._active_responsers: List[SFTServerResponser] = []
+        self._lock = threading.Lock()
+
+        self._workers: List[threading.Thread] = []
+        self._accept_thread: threading.Thread = None
+        self._is_running = False
+
+    def config(self, role: SFTRoles, **kwargs):
+        """Configure the scheme of the role for the connections which are
+        accepted from now on."""
+        self._listener.session_manager().get_session(
+                SFTProtocols.SFT,
+                role
+            ).scheme().config(**kwargs)
+
+    def active_sessions(self) -> int:
+        with self._lock:
+            return len(self._active_responsers)
+
+    def waiting_sessions(self) -> int:
+        return self._waiting_responsers.qsize()
+
+    def start(self, thread: bool = True):
+        """Start serving. If thread is False, block until close() is called
+        from another thread."""
+        if self._is_running:
+            raise Exception("The service is already running.")
+
+        self._listener.listen()
+        self._is_running = True
+
+        for i in range(self._max_sessions):
+            worker = threading.Thread(
+                    target=self.__serve_loop,
+                    name="Worker {} of {}".format(i, self._name),
+                    daemon=True
+                )
+            worker.start()
+            self._workers.append(worker)
+
+        self._accept_thread = threading.Thread(
+                target=self.__accept_loop,
+                name="Accept thread of {}".format(self._name),
+                daemon=True
+            )
+        self._accept_thread.start()
+
+        if not thread:
+            self._accept_thread.join()
+
+    def __accept_loop(self):
+        while self._is_running:
+            try:
+                # The listener waits at most 3s for a connection.
+                responser: SFTServerResponser = self._listener.accept(start_responser=False)
+            except socket.timeout:
+                self.__close_idle_responsers()
+                continue
+            except Exception as e:
+                # The listener is closed.
+                if not self._is_running:
+                    break
+
+                # e.g. the handshake with the client failed.
+                self._print(StdUsers.DEV, StdLevels.WARNING, "Failed to accept "
+                "a connection ({}).".format(e))
+                continue
+
+            if not self._is_running:
+                responser.close()
+                break
+
+            with self._lock:
+                # The free workers take some of the waiting connections.
+                free_workers = self._max_sessions - len(self._active_responsers)
+                if self._waiting_responsers.qsize() - free_workers >= self._max_queue_size:
+                    is_rejected = True
+                else:
+                    is_rejected = False
+                    self._waiting_responsers.put(responser)
+
+            if is_rejected:
+                self._print(StdUsers.DEV, StdLevels.WARNING, "Too many connections, "
+                "the connection of {} is closed.".format(responser._address))
+                responser.close()
+
+            self.__close_idle_responsers()
+
+    def __close_idle_responsers(self):
+        if self._idle_timeout is None:
+            return
+
+        with self._lock:
+            idle_responsers = [responser for responser in self._active_responsers
+                if not responser.is_busy() and responser.idle_time() > self._idle_timeout]
+
+        for responser in idle_responsers:
+            self._print(StdUsers.DEV, StdLevels.INFO, "The connection of {} is "
+            "idle, it is closed.".format(responser._address))
+            responser.close()
+
+    def __serve_loop(self):
+        while True:
+            responser: SFTServerResponser = self._waiting_responsers.get()
+            if responser is None:
+                break
+
+            with self._lock:
+                self._active_responsers.append(responser)
+
+            # Serve the connection in this thread until it is closed.
+            try:
+                responser.start(thread=False)
+            except Exception as e:
+                self._print(StdUsers.DEV, StdLevels.ERROR, "The connection of {} "
+                "failed ({}).".format(responser._address, e))
+                responser.close()
+
+            with self._lock:
+                self._active_responsers.remove(responser)
+
+    def close(self, timeout: float = DEFAULT_TIMEOUT):
+        """Stop accepting connections and wait at most timeout seconds for
+        the transfers in process, the remaining connections are closed."""
+        if not self._is_running:
+            return
+
+        self._is_running = False
+        self._listener.close()
+        self._accept_thread.join()
+
+        # The connections which have not been served yet.
+        with self._lock:
+            while not self._waiting_responsers.empty():
+                self._waiting_responsers.get().close()
+
+            for _ in self._workers:
+                self._waiting_responsers.put(None)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                responsers = list(self._active_responsers)
+
+            if not responsers:
+                break
+
+            for responser in responsers:
+                if not responser.is_busy() or time.monotonic() >= deadline:
+                    responser.close()
+
+            time.sleep(POLL_INTERVAL)
+
+        for worker in self._workers:
+            worker.join()
+
+        self._workers.clear()
@@ -0,0 +1,216 @@
+import inspect
+from typing import Dict
+
+from hks_pylib.cryptography.hashes import HKSHash, SHA256
+
+from sft.file import FSYNC_NONE
+
+
+class SinkAborted(Exception):
+    """Thrown into a generator sink when the transfer fails."""
+
+
+class Sink(object):
+    """Receive the data of a file as it comes, in order, instead of writing
+    it into the directory of the receiver.
+
+    write() is called with each piece of the file, close() once the whole
+    file is received and its digest is checked. abort() is called instead
+    of close() if the transfer fails, e.g. the digest doesn't match. A sink
+    receives a single transfer at a time, it is shared by all sessions which
+    are cloned from the same scheme.
+    """
+    def write(self, data: memoryview):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def abort(self, reason: str):
+        pass
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class FileObjectSink(Sink):
+    """Write the data into a writable file object, e.g. a pipe or a socket
+    file. The file object is flushed but left open."""
+    def __init__(self, stream) -> None:
+        self._stream = stream
+
+    def write(self, data: memoryview):
+        view = data
+        while len(view) > 0:
+            written_nbytes = self._stream.write(view)
+
+            # Non-raw streams write everything and may return None.
+            if written_nbytes is None:
+                break
+
+            view = view[written_nbytes:]
+
+    def close(self):
+        self._stream.flush()
+
+
+class CallableSink(Sink):
+    """Call a function with each piece of the data. It is not told about
+    the end of the transfer, the Done result tells whether it succeeded."""
+    def __init__(self, function) -> None:
+        self._function = function
+
+    def write(self, data: memoryview):
+        self._function(data)
+
+
+class GeneratorSink(Sink):
+    """Send the data to a generator, e.g.
+
+        def upload():
+            while True:
+                data = yield
+                ...
+
+    The generator is closed (GeneratorExit) once the transfer succeeds,
+    SinkAborted is thrown into it if the transfer fails.
+    """
+    def __init__(self, generator) -> None:
+        self._generator = generator
+        self._is_started = False
+
+    def __start(self):
+        if not self._is_started:
+            next(self._generator)
+            self._is_started = True
+
+    def write(self, data: memoryview):
+        self.__start()
+        self._generator.send(data)
+
+    def close(self):
+        self._generator.close()
+
+    def abort(self, reason: str):
+        if not self._is_started:
+            self._generator.close()
+            return
+
+        try:
+            self._generator.throw(SinkAborted(reason))
+        except (SinkAborted, StopIteration):
+            pass
+        finally:
+            self._generator.close()
+
+
+def get_sink(sink) -> Sink:
+    """Return the Sink of a Sink, a generator, a writable file object or a
+    callable."""
+    if isinstance(sink, Sink):
+        return sink
+
+    if inspect.isgenerator(sink):
+        return GeneratorSink(sink)
+
+    if callable(getattr(sink, "write", None)):
+        return FileObjectSink(sink)
+
+    if callable(sink):
+        return CallableSink(sink)
+
+    raise Exception("Parameter sink must be a Sink, a generator, a writable file object or a Callable.")
+
+
+class SinkWriter(object):
+    """A FileWriter which passes the data to a sink instead of a file.
+
+    The chunks may be written out of order (e.g. several REQUIREs are in
+    flight), the ones written ahead are kept in memory until the gap before
+    them is filled, then they are passed to the sink and hashed in order.
+    """
+    def __init__(self, sink: Sink, hash_obj: HKSHash = None) -> None:
+        self._sink = sink
+
+        self._hash_obj = hash_obj if hash_obj is not None else SHA256()
+        self._digest: bytes = None
+
+        self._current_size = 0
+        self._position = 0
+
+        # The size of the prefix which is passed to the sink.
+        self._delivered_size = 0
+
+        # Chunks written ahead of the delivered part (offset -> data).
+        self._pending_chunks: Dict[int, bytes] = {}
+
+        self._is_finished = False
+        self._is_aborted = False
+
+    def name(self):
+        return None
+
+    def write(self, data: bytes, offset: int = None):
+        if offset is None:
+            offset = self._position
+
+        if offset < self._delivered_size or offset in self._pending_chunks:
+            raise Exception("Chunk at offset {} is written twice".format(offset))
+
+        self._current_size += len(data)
+        self._position = offset + len(data)
+
+        if offset != self._delivered_size:
+            self._pending_chunks[offset] = data
+            return len(data)
+
+        self.__deliver(data)
+
+        while self._delivered_size in self._pending_chunks:
+            self.__deliver(self._pending_chunks.pop(self._delivered_size))
+
+        return len(data)
+
+    def __deliver(self, data: bytes):
+        self._hash_obj.update(data)
+        self._sink.write(memoryview(data))
+        self._delivered_size += len(data)
+
+    def hashed_size(self):
+        """Return the size of the prefix which is passed to the sink."""
+        return self._delivered_size
+
+    def preallocate(self, size: int):
+        pass
+
+    def flush(self, fsync: str = FSYNC_NONE):
+        pass
+
+    def digest(self, *args, **kwargs):
+        if self._pending_chunks:
+            raise Exception("Some chunks are not passed to the sink")
+
+        if self._digest is None:
+            self._digest = self._hash_obj.finalize()
+
+        return self._digest
+
+    def size(self):
+        return self._current_size
+
+    def finish(self):
+        """Tell the sink that the transfer succeeded."""
+        if not self._is_finished and not self._is_aborted:
+            self._is_finished = True
+            self._sink.close()
+
+    def abort(self, reason: str):
+        """Tell the sink that the transfer failed."""
+        if not self._is_finished and not self._is_aborted:
+            self._is_aborted = True
+            self._pending_chunks.clear()
+            self._sink.abort(reason)
+
+    def close(self):
+        # A transfer which is closed before it is finished is interrupted.
+        self.abort("Transfer is interrupted")
@@ -0,0 +1,175 @@
+import os
+import json
+import shutil
+import threading
+from collections import OrderedDict
+
+
+DEFAULT_STORE_CAPACITY = 10 * 2 ** 30  # bytes
+INDEX_FILENAME = "index.json"
+OBJECTS_DIRECTORY = "objects"
+
+
+class ContentStore(object):
+    """A content-addressed store of the received files.
+
+    A file is stored under its digest in directory, hardlinked to the
+    received file if both are on the same file system, copied otherwise. The
+    index is kept in directory and reloaded on the next start. The least
+    recently used files are evicted once the stored files exceed capacity
+    bytes.
+
+    An entry is dropped as soon as its file is modified (e.g. through a
+    hardlink), so that a stored file always matches its digest. The store
+    is shared by all sessions which are cloned from the same scheme.
+    """
+    def __init__(self, directory: str, capacity: int = DEFAULT_STORE_CAPACITY) -> None:
+        if not isinstance(directory, str):
+            raise Exception("Parameter directory must be a str.")
+
+        if not isinstance(capacity, int) or capacity <= 0:
+            raise Exception("Parameter capacity must be a positive integer.")
+
+        self._directory = directory
+        self._capacity = capacity
+
+        self._objects_directory = os.path.join(directory, OBJECTS_DIRECTORY)
+        self._index_path = os.path.join(directory, INDEX_FILENAME)
+
+        os.makedirs(self._objects_directory, exist_ok=True)
+
+        # digest (hex) -> (size, mtime_ns) of the stored file.
+        self._entries: OrderedDict = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        if os.path.isfile(self._index_path):
+            self._load()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def size(self):
+        """Return the total size of the stored files."""
+        return self._size
+
+    def __get_object_path(self, key: str) -> str:
+        return os.path.join(self._objects_directory, key)
+
+    def __is_valid(self, key: str) -> bool:
+        size, mtime_ns = self._entries[key]
+        try:
+            stat = os.stat(self.__get_object_path(key))
+        except OSError:
+            return False
+
+        return stat.st_size == size and stat.st_mtime_ns == mtime_ns
+
+    def __remove(self, key: str):
+        size, _ = self._entries.pop(key)
+        self._size -= size
+
+        try:
+            os.remove(self.__get_object_path(key))
+        except OSError:
+            pass
+
+    def get(self, digest: bytes, size: int) -> str:
+        """Return the path of the stored file with the digest and the size,
+        or None if there is no such file."""
+        key = digest.hex()
+
+        self._lock.acquire()
+
+        path = None
+        if key in self._entries:
+            if self._entries[key][0] == size and self.__is_valid(key):
+                self._entries.move_to_end(key)
+                path = self.__get_object_path(key)
+            else:
+                self.__remove(key)
+                self._save()
+
+        self._lock.release()
+
+        return path
+
+    def restore(self, digest: bytes, size: int, path: str) -> bool:
+        """Hardlink or copy the stored file with the digest and the size to
+        path, return False if there is no such file."""
+        object_path = self.get(digest, size)
+        if object_path is None:
+            return False
+
+        try:
+            link_or_copy(object_path, path)
+        except OSError:
+            return False
+
+        return True
+
+    def add(self, digest: bytes, path: str):
+        """Store the file at path, whose digest is already checked."""
+        key = digest.hex()
+        object_path = self.__get_object_path(key)
+
+        self._lock.acquire()
+
+        try:
+            if key in self._entries:
+                self.__remove(key)
+
+            size = os.path.getsize(path)
+            if size > self._capacity:
+                return
+
+            link_or_copy(path, object_path)
+
+            stat = os.stat(object_path)
+            self._entries[key] = (stat.st_size, stat.st_mtime_ns)
+            self._size += stat.st_size
+
+            while self._size > self._capacity:
+                self.__remove(next(iter(self._entries)))
+        except OSError:
+            # A file which can't be stored is received again next time.
+            pass
+        finally:
+            self._save()
+            self._lock.release()
+
+    def _load(self):
+        try:
+            with open(self._index_path, "r") as stream:
+                entries = json.load(stream)
+        except (OSError, ValueError):
+            # A broken index only costs a retransmission of the files.
+            return
+
+        for key, size, mtime_ns in entries:
+            self._entries[key] = (size, mtime_ns)
+            self._size += size
+
+        while self._size > self._capacity:
+            self.__remove(next(iter(self._entries)))
+
+    def _save(self):
+        entries = [[key, size, mtime_ns] for key, (size, mtime_ns) in self._entries.items()]
+
+        tmp_path = "{}.tmp".format(self._index_path)
+        with open(tmp_path, "w") as stream:
+            json.dump(entries, stream)
+
+        os.replace(tmp_path, self._index_path)
+
+
+def link_or_copy(source: str, destination: str):
+    """Hardlink source to destination, or copy it if they are on different
+    file systems (or the file system doesn't support hardlinks)."""
+    if os.path.exists(destination):
+        os.remove(destination)
+
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
@@ -0,0 +1,226 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from hks_pylib.cryptography.hashes import HKSHash
+
+from sft.hashes import HASH_SHA256, new_hash, get_digest_size
+
+
+DEFAULT_TREE_BLOCK_SIZE = 2 ** 20  # bytes
+BLOCK_SIZE_FIELD_SIZE = 4  # bytes
+
+# The blocks of a chunk are hashed in parallel, the hash functions release
+# the GIL while hashing.
+_executor: ThreadPoolExecutor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                    max_workers=os.cpu_count() or 1,
+                    thread_name_prefix="SFT block hashing"
+                )
+
+    return _executor
+
+
+def hash_block(data: bytes, algorithm: int = HASH_SHA256) -> bytes:
+    hash_obj = new_hash(algorithm)
+    hash_obj.update(data)
+    return hash_obj.finalize()
+
+
+def hash_blocks(blocks: List[bytes], algorithm: int = HASH_SHA256) -> List[bytes]:
+    if len(blocks) <= 1:
+        return [hash_block(block, algorithm) for block in blocks]
+
+    return list(get_executor().map(hash_block, blocks, [algorithm] * len(blocks)))
+
+
+def merkle_root(hashes: List[bytes], algorithm: int = HASH_SHA256) -> bytes:
+    """Return the root of the binary hash tree over the hashes of the blocks,
+    a node without sibling is moved up as is."""
+    if not hashes:
+        return hash_block(b"", algorithm)
+
+    level = hashes
+    while len(level) > 1:
+        next_level = [hash_block(level[i] + level[i + 1], algorithm)
+                        for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2 == 1:
+            next_level.append(level[-1])
+
+        level = next_level
+
+    return level[0]
+
+
+class ChunkTree(object):
+    """The hashes of the blocks of a file and their Merkle root.
+
+    The root is announced in INFO and the hashes follow it in a HASHES
+    packet, so that the receiver checks each block as soon as it lands. The
+    blocks are hashed with the algorithm of the digest of the file.
+    """
+    def __init__(self,
+                    block_size: int,
+                    filesize: int,
+                    hashes: List[bytes],
+                    algorithm: int = HASH_SHA256
+                ) -> None:
+        self.block_size = block_size
+        self.filesize = filesize
+        self.hashes = hashes
+        self.algorithm = algorithm
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def root(self) -> bytes:
+        return merkle_root(self.hashes, self.algorithm)
+
+    def block_range(self, index: int) -> Tuple[int, int]:
+        """Return the range [start, end) of the block."""
+        start = index * self.block_size
+        return start, min(start + self.block_size, self.filesize)
+
+    @staticmethod
+    def count_blocks(filesize: int, block_size: int) -> int:
+        return (filesize + block_size - 1) // block_size
+
+    @staticmethod
+    def from_file(path: str,
+                    block_size: int = DEFAULT_TREE_BLOCK_SIZE,
+                    hash_obj: HKSHash = None,
+                    batch_size: int = None,
+                    algorithm: int = HASH_SHA256
+                ):
+        """Return the tree of the file, hash_obj (if any) is updated with the
+        whole file in the same pass."""
+        if batch_size is None:
+            batch_size = os.cpu_count() or 1
+
+        hashes = []
+        filesize = 0
+        with open(path, "rb") as stream:
+            while True:
+                blocks = []
+                for _ in range(batch_size):
+                    block = stream.read(block_size)
+                    if not block:
+                        break
+
+                    blocks.append(block)
+
+                if not blocks:
+                    break
+
+                if hash_obj is not None:
+                    for block in blocks:
+                        hash_obj.update(block)
+
+                hashes.extend(hash_blocks(blocks, algorithm))
+                filesize += sum(len(block) for block in blocks)
+
+        return ChunkTree(block_size, filesize, hashes, algorithm)
+
+    def to_option(self) -> bytes:
+        """Return the value of the chunk tree option of INFO."""
+        return self.block_size.to_bytes(BLOCK_SIZE_FIELD_SIZE, "big") + self.root()
+
+    @staticmethod
+    def parse_option(value: bytes, algorithm: int = HASH_SHA256) -> Tuple[int, bytes]:
+        """Return the block size and the root announced in INFO."""
+        if len(value) != BLOCK_SIZE_FIELD_SIZE + get_digest_size(algorithm):
+            raise Exception("Invalid chunk tree")
+
+        block_size = int.from_bytes(value[0: BLOCK_SIZE_FIELD_SIZE], "big")
+        if block_size <= 0:
+            raise Exception("Invalid block size")
+
+        return block_size, value[BLOCK_SIZE_FIELD_SIZE:]
+
+    def to_bytes(self) -> bytes:
+        return b"".join(self.hashes)
+
+    @staticmethod
+    def from_bytes(data: bytes,
+                    block_size: int,
+                    filesize: int,
+                    root: bytes,
+                    algorithm: int = HASH_SHA256
+                ):
+        """Return the tree of the hashes in data, which must match the root
+        announced in INFO."""
+        hash_size = get_digest_size(algorithm)
+
+        count = ChunkTree.count_blocks(filesize, block_size)
+        if len(data) != count * hash_size:
+            raise Exception("Invalid number of hashes")
+
+        hashes = [data[i: i + hash_size] for i in range(0, len(data), hash_size)]
+
+        tree = ChunkTree(block_size, filesize, hashes, algorithm)
+        if tree.root() != root:
+            raise Exception("The hashes don't match the root")
+
+        return tree
+
+
+class BlockVerifier(object):
+    """Check the chunks of a file against its tree as they land.
+
+    A chunk is cut at the boundaries of the blocks. The pieces of a block
+    which comes in several chunks (e.g. the sender clamped a chunk) are kept
+    until the block is complete.
+    """
+    def __init__(self, tree: ChunkTree) -> None:
+        self._tree = tree
+
+        # block index -> offset -> piece of the block.
+        self._pieces: Dict[int, Dict[int, bytes]] = {}
+
+    def verify(self, offset: int, data: bytes) -> Tuple[List[Tuple[int, bytes]], List[Tuple[int, int]]]:
+        """Return the complete blocks of the chunk which are valid, as
+        (offset, data), and the ranges (offset, length) of the ones which
+        are not."""
+        blocks = []
+
+        position = offset
+        end = offset + len(data)
+        while position < end:
+            index = position // self._tree.block_size
+            if index >= len(self._tree):
+                raise Exception("Offset {} is out of the file".format(position))
+
+            block_start, block_end = self._tree.block_range(index)
+            piece_end = min(end, block_end)
+            piece = data[position - offset: piece_end - offset]
+
+            if position == block_start and piece_end == block_end:
+                blocks.append((index, piece))
+            else:
+                pieces = self._pieces.setdefault(index, {})
+                pieces[position] = piece
+
+                if sum(len(piece) for piece in pieces.values()) == block_end - block_start:
+                    del self._pieces[index]
+                    blocks.append((index, b"".join(pieces[start] for start in sorted(pieces))))
+
+            position = piece_end
+
+        valid_blocks, invalid_ranges = [], []
+        for (index, block), block_hash in zip(blocks, hash_blocks([block for _, block in blocks], self._tree.algorithm)):
+            block_start, _ = self._tree.block_range(index)
+            if block_hash == self._tree.hashes[index]:
+                valid_blocks.append((block_start, block))
+            else:
+                invalid_ranges.append((block_start, len(block)))
+
+        return valid_blocks, invalid_ranges
@@ -0,0 +1,42 @@
+import os
+import time
+
+from sft.cache import DigestCache
+from sft.file import FileReader
+
+
+def write_file(path, data):
+    with open(path, "wb") as stream:
+        stream.write(data)
+
+
+def test_cache():
+    path = "tests/cache.bin"
+    index_path = "tests/cache.index"
+
+    write_file(path, b"version 1")
+    cache = DigestCache(capacity=2, index_path=index_path)
+
+    digest = FileReader(path).digest(cache=cache)
+    key = cache.key(path, "SHA256")
+    assert cache.get(key) == digest
+
+    # The index is reloaded by a new cache.
+    assert DigestCache(index_path=index_path).get(key) == digest
+
+    # Modifying the file invalidates the entry.
+    time.sleep(0.01)
+    write_file(path, b"version 2")
+    assert cache.get(cache.key(path, "SHA256")) is None
+    assert FileReader(path).digest(cache=cache) != digest
+
+    # The least recently used entry is evicted.
+    cache.put(("another", 0, 0, 0, "SHA256"), b"digest")
+    assert cache.get(key) is None
+
+    os.remove(path)
+    os.remove(index_path)
+
+
+if __name__ == "__main__":
+    test_cache()
@@ -0,0 +1,84 @@
+import sys
+import threading
+
+from hks_pynetwork.internal import LocalNode
+from hks_pylib.cryptography.ciphers.symmetrics import NoCipher
+
+from sft.listener import SFTListener
+from sft.parallel import local_nodes, NODES_PER_CONNECTION
+
+
+def test_local_nodes():
+    max_nodes = LocalNode.MAX_NODES
+
+    with local_nodes(3):
+        assert LocalNode.MAX_NODES == max_nodes + 3 * NODES_PER_CONNECTION
+
+        with local_nodes(1):
+            assert LocalNode.MAX_NODES == max_nodes + 4 * NODES_PER_CONNECTION
+
+    assert LocalNode.MAX_NODES == max_nodes
+
+    try:
+        with local_nodes(2):
+            raise ValueError()
+    except ValueError:
+        pass
+
+    assert LocalNode.MAX_NODES == max_nodes
+
+
+def test_close_local_nodes():
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+
+    try:
+        with local_nodes(20):
+            for _ in range(200):
+                nodes_before = list(LocalNode.nodes)
+                names_before = list(LocalNode.node_names)
+
+                kept = LocalNode()
+                nodes = [LocalNode() for _ in range(16)]
+                barrier = threading.Barrier(len(nodes))
+
+                def close(node):
+                    barrier.wait()
+                    node.close()
+
+                threads = [threading.Thread(target=close, args=(node,)) for node in nodes]
+                for thread in threads:
+                    thread.start()
+
+                for thread in threads:
+                    thread.join()
+
+                # The nodes closing at the same time don't delete the slot of
+                # another node.
+                assert LocalNode.nodes == nodes_before + [kept]
+                assert LocalNode.node_names == names_before + [kept.name]
+
+                kept.close()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+
+def test_listener_local_nodes():
+    max_nodes = LocalNode.MAX_NODES
+
+    listener = SFTListener(NoCipher(), ("127.0.0.1", 8902), max_connections=5)
+    listener.listen()
+    assert LocalNode.MAX_NODES == max_nodes + 5 * NODES_PER_CONNECTION
+
+    # The limit is raised once, not for each connection.
+    listener.close()
+    assert LocalNode.MAX_NODES == max_nodes
+
+    listener.close()
+    assert LocalNode.MAX_NODES == max_nodes
+
+
+if __name__ == "__main__":
+    test_local_nodes()
+    test_close_local_nodes()
+    test_listener_local_nodes()
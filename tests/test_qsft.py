@@ -1,26 +1,44 @@
+import io
+import os
 import time
+import shutil
+import pathlib
+import tempfile
+import asyncio
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from hks_pylib.logger.standard import StdUsers, StdLevels
+from hks_pynetwork.internal import LocalNode
 from sft.protocol import DEFAULT_TOKEN
 
 from sft.protocol.definition import SFTRoles
 from hks_pylib.logger import StandardLoggerGenerator
+from hks_pylib.cryptography.ciphers.symmetrics import NoCipher
 
+from sft.service import SFTService
+from sft.store import ContentStore
+from sft.hashes import HASH_BLAKE2B
+from sft.ratelimit import RateLimiter
+from sft.scheduler import TransferScheduler
+from sft.metrics import PrometheusMetricsSink
+from sft.aio import AsyncSFTListener, AsyncSFTClient
 from sft.qsft.server import QSFTServer
 from sft.qsft.client import QSFTClient
+from sft.qsft.pool import QSFTClientPool
+from sft.qsft.definition import DEFAULT_IP
 
 
 KEY = b"0123456789abcedffedcba9876543210"
 
 
-def run_server(role: SFTRoles):
+def run_server(role: SFTRoles, port: int = 8888):
     logger_generator = StandardLoggerGenerator("tests/qsftserver.{}.log".format(role.name))
 
     logger = logger_generator.generate("SERVER", {StdUsers.USER: [StdLevels.INFO]})
 
     logger(StdUsers.USER, StdLevels.INFO, "SERVER RUN AS", role.name)
-    server = QSFTServer(logger_generator=logger_generator)
+    server = QSFTServer(address=(DEFAULT_IP, port), logger_generator=logger_generator)
     server.config(SFTRoles.RECEIVER, directory="./tests")
 
     if role == SFTRoles.SENDER:
@@ -31,19 +49,19 @@ def run_server(role: SFTRoles):
     logger(StdUsers.USER, StdLevels.INFO, "SERVER RESULT :", result)
 
 
-def run_client(role: SFTRoles, filename):
+def run_client(role: SFTRoles, filename, port: int = 8888, parallel: int = 1):
     logger_generator = StandardLoggerGenerator("tests/qsftclient.{}.log".format(role.name))
 
     logger = logger_generator.generate("CLIENT", {StdUsers.USER: [StdLevels.INFO]})
 
     logger(StdUsers.USER, StdLevels.INFO, "CLIENT RUN AS", role.name)
-    client = QSFTClient(logger_generator=logger_generator)
-    client.config(SFTRoles.RECEIVER, directory="./tests")
+    with QSFTClient(address=(DEFAULT_IP, port), logger_generator=logger_generator) as client:
+        client.config(SFTRoles.RECEIVER, directory="./tests")
 
-    if role == SFTRoles.SENDER:
-        result = client.send(filename)
-    else:
-        result = client.receive(filename)
+        if role == SFTRoles.SENDER:
+            result = client.send(filename, parallel=parallel)
+        else:
+            result = client.receive(filename, parallel=parallel)
 
     logger(StdUsers.USER, StdLevels.INFO, "CLIENT RESULT:", result)
 
@@ -68,5 +86,500 @@ def test_qsft():
     t1.join()
     t2.join()
 
+
+def test_qsft_parallel():
+    max_nodes = LocalNode.MAX_NODES
+
+    t1 = threading.Thread(
+            target=run_server,
+            args=(SFTRoles.RECEIVER, 8889),
+            name="SERVER"
+        )
+    t1.start()
+
+    time.sleep(1)
+
+    t2 = threading.Thread(
+            target=run_client,
+            args=(SFTRoles.SENDER, "tests/file.500MB", 8889, 4),
+            name="CLIENT"
+        )
+    t2.start()
+
+    t1.join()
+    t2.join()
+
+    # The local nodes of the parts are given back.
+    assert LocalNode.MAX_NODES == max_nodes
+
+def test_qsft_keep_alive():
+    server = QSFTServer(address=(DEFAULT_IP, 8890), keep_alive=True)
+    server.config(SFTRoles.RECEIVER, directory="./tests")
+
+    server_results = []
+
+    def run_keep_alive_server():
+        # The same connection serves both transfers.
+        server_results.append(server.receive())
+        server_results.append(server.send())
+        server.close()
+
+    t1 = threading.Thread(target=run_keep_alive_server, name="SERVER")
+    t1.start()
+
+    time.sleep(1)
+
+    with QSFTClient(address=(DEFAULT_IP, 8890), keep_alive=True) as client:
+        client.config(SFTRoles.RECEIVER, directory="./tests")
+
+        assert client.send("tests/file.500MB").value
+        assert client.receive("tests/file.500MB").value
+
+    t1.join()
+
+    assert all(result.value for result in server_results)
+
+
+def test_service():
+    # One worker, the second client waits in the queue.
+    service = SFTService(NoCipher(), (DEFAULT_IP, 8891), max_sessions=1, max_queue_size=1)
+    service.config(SFTRoles.RECEIVER, directory="./tests")
+    service.start()
+
+    results = []
+
+    def run_service_client():
+        with QSFTClient(address=(DEFAULT_IP, 8891)) as client:
+            results.append(client.send("tests/file.500MB"))
+
+    threads = [threading.Thread(target=run_service_client) for _ in range(2)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    service.close()
+
+    assert len(results) == 2 and all(result.value for result in results)
+
+
+def test_pool(tmp_path):
+    service = SFTService(NoCipher(), (DEFAULT_IP, 8901), max_sessions=2)
+    service.start()
+
+    results = []
+
+    pool = QSFTClientPool(max_size=2)
+    pool.config(SFTRoles.RECEIVER, directory=str(tmp_path))
+    try:
+        def run_pool_client():
+            for _ in range(2):
+                results.append(pool.receive((DEFAULT_IP, 8901), "tests/file.500MB"))
+
+        threads = [threading.Thread(target=run_pool_client) for _ in range(3)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.close()
+        service.close()
+
+    assert len(results) == 6 and all(result.value for result in results)
+
+
+def test_service_scheduler():
+    # Two workers, the transfers are admitted one by one.
+    scheduler = TransferScheduler(max_transfers=1)
+
+    service = SFTService(NoCipher(), (DEFAULT_IP, 8900), max_sessions=2, scheduler=scheduler)
+    service.config(SFTRoles.RECEIVER, directory="./tests")
+    service.start()
+
+    results = []
+
+    def run_service_client():
+        with QSFTClient(address=(DEFAULT_IP, 8900)) as client:
+            results.append(client.send("tests/file.500MB"))
+
+    threads = [threading.Thread(target=run_service_client) for _ in range(2)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    service.close()
+
+    assert len(results) == 2 and all(result.value for result in results)
+    assert scheduler.active_transfers() == 0 and scheduler.waiting_transfers() == 0
+
+
+def test_async():
+    async def run_async():
+        listener = AsyncSFTListener(NoCipher(), (DEFAULT_IP, 8892))
+        listener.config(SFTRoles.RECEIVER, directory="./tests")
+        await listener.listen()
+
+        async def run_async_client(name):
+            async with AsyncSFTClient(NoCipher(), (DEFAULT_IP, 8892), name=name) as client:
+                client.config(SFTRoles.RECEIVER, directory="./tests")
+
+                return [await client.send("tests/file.500MB"), await client.receive("tests/file.500MB")]
+
+        results = await asyncio.gather(*[run_async_client("SFTClient {}".format(i)) for i in range(4)])
+        await listener.close()
+
+        return [result for client_results in results for result in client_results]
+
+    results = asyncio.run(run_async())
+
+    assert len(results) == 8 and all(result.value for result in results)
+
+
+def test_async_scheduler():
+    # Two executor threads, the transfers waiting for their admission must
+    # not hold them.
+    scheduler = TransferScheduler(max_transfers=1, deadline=20)
+
+    async def run_async():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=2))
+
+        listener = AsyncSFTListener(NoCipher(), (DEFAULT_IP, 8904))
+        listener.config(SFTRoles.SENDER, scheduler=scheduler)
+        await listener.listen()
+
+        async def run_async_client(name):
+            async with AsyncSFTClient(NoCipher(), (DEFAULT_IP, 8904), name=name) as client:
+                sink = io.BytesIO()
+                result = await client.receive("tests/file.500MB", sink=sink)
+
+                return result, sink.getvalue()
+
+        results = await asyncio.gather(*[run_async_client("SFTClient {}".format(i)) for i in range(4)])
+
+        # The server ends a transfer once it has the last packet of the client.
+        end_time = time.monotonic() + 5
+        while scheduler.active_transfers() > 0 and time.monotonic() < end_time:
+            await asyncio.sleep(0.05)
+
+        await listener.close()
+
+        return results
+
+    start_time = time.monotonic()
+    results = asyncio.run(run_async())
+
+    with open("tests/file.500MB", "rb") as stream:
+        expected_data = stream.read()
+
+    assert all(result.value and data == expected_data for result, data in results)
+    assert time.monotonic() - start_time < 20
+    assert scheduler.active_transfers() == 0 and scheduler.waiting_transfers() == 0
+
+
+def test_metrics():
+    sink = PrometheusMetricsSink()
+
+    server = QSFTServer(address=(DEFAULT_IP, 8893))
+    server.config(SFTRoles.RECEIVER, directory="./tests", metrics_sink=sink)
+
+    server_results = []
+    t1 = threading.Thread(target=lambda: server_results.append(server.receive()), name="SERVER")
+    t1.start()
+
+    time.sleep(1)
+
+    client = QSFTClient(address=(DEFAULT_IP, 8893))
+    result = client.send("tests/file.500MB")
+    t1.join()
+
+    filesize = os.path.getsize("tests/file.500MB")
+
+    assert result.value and result.metrics["bytes"] == filesize
+    assert server_results[0].value and server_results[0].metrics["bytes"] == filesize
+    assert "write" in server_results[0].metrics["phases"]
+
+    # The sink records the transfer once the session is canceled.
+    for _ in range(10):
+        if sink.counter("transfers_total", role="receiver", result="success") == 1:
+            break
+        time.sleep(0.1)
+
+    assert sink.counter("bytes_total", role="receiver") == filesize
+    assert sink.histogram("transfer_duration_seconds", role="receiver")["count"] == 1
+    assert "sft_bytes_total" in sink.expose()
+
+
+def test_sink():
+    server = QSFTServer(address=(DEFAULT_IP, 8894), keep_alive=True)
+
+    def run_keep_alive_server():
+        server.send()
+        server.send()
+        server.close()
+
+    t1 = threading.Thread(target=run_keep_alive_server, name="SERVER")
+    t1.start()
+
+    time.sleep(1)
+
+    with open("tests/file.500MB", "rb") as stream:
+        expected_data = stream.read()
+
+    received = []
+
+    def consumer():
+        try:
+            while True:
+                received.append(bytes((yield)))
+        except GeneratorExit:
+            received.append(None)
+
+    with QSFTClient(address=(DEFAULT_IP, 8894), keep_alive=True) as client:
+        # Small chunks, so that several of them are in flight.
+        client.config(SFTRoles.RECEIVER, buffer_size=2 ** 14)
+
+        stream = io.BytesIO()
+        result = client.receive("tests/file.500MB", sink=stream)
+        assert result.value and not result.has("path")
+        assert stream.getvalue() == expected_data
+
+        result = client.receive("tests/file.500MB", sink=consumer())
+        assert result.value
+        assert received[-1] is None and b"".join(received[:-1]) == expected_data
+
+    t1.join()
+
+
+def test_stream():
+    server = QSFTServer(address=(DEFAULT_IP, 8895), keep_alive=True)
+    server.config(SFTRoles.RECEIVER, directory="./tests", buffer_size=2 ** 14)
+
+    server_results = []
+
+    def run_keep_alive_server():
+        server_results.append(server.receive())
+        server_results.append(server.receive())
+        server.close()
+
+    t1 = threading.Thread(target=run_keep_alive_server, name="SERVER")
+    t1.start()
+
+    time.sleep(1)
+
+    # The size of the second stream is a multiple of the chunk size.
+    data = os.urandom(100000)
+    pieces = [os.urandom(1000) for _ in range(2 ** 14 * 4 // 1000)] + [os.urandom(2 ** 14 * 4 % 1000)]
+
+    with QSFTClient(address=(DEFAULT_IP, 8895), keep_alive=True) as client:
+        assert client.send("stream.bin", stream=data).value
+
+        # The server waits for the result of the first transfer.
+        while not server_results:
+            time.sleep(0.1)
+
+        assert client.send("stream.bin", stream=iter(pieces)).value
+
+    t1.join()
+
+    for result, expected_data in zip(server_results, [data, b"".join(pieces)]):
+        assert result.value
+
+        with open(result.path, "rb") as stream:
+            assert stream.read() == expected_data
+
+        os.remove(result.path)
+
+
+def test_detoken_values():
+    data = os.urandom(10000)
+    values = {
+        "path": pathlib.Path("tests/file.500MB"),
+        "object": {"path": "tests/file.500MB", "priority": 0},
+        "stream": data,
+        "list": ["tests/file.500MB"]
+    }
+
+    server = QSFTServer(address=(DEFAULT_IP, 8903), keep_alive=True)
+    server.config(SFTRoles.SENDER, detoken=lambda token: values[token])
+
+    server_results = []
+    # The transfers have the same role, the client waits until the server
+    # takes the result of a transfer before it starts the next one.
+    served = threading.Semaphore(0)
+
+    def run_keep_alive_server():
+        for _ in values:
+            server_results.append(server.send())
+            served.release()
+
+        server.close()
+
+    t1 = threading.Thread(target=run_keep_alive_server, name="SERVER")
+    t1.start()
+
+    time.sleep(1)
+
+    with open("tests/file.500MB", "rb") as stream:
+        expected_data = stream.read()
+
+    with QSFTClient(address=(DEFAULT_IP, 8903), keep_alive=True) as client:
+        for token, expected in (("path", expected_data), ("object", expected_data), ("stream", data)):
+            sink = io.BytesIO()
+            assert client.receive(token, sink=sink).value
+            assert sink.getvalue() == expected
+            assert served.acquire(timeout=10)
+
+        # Neither a path nor a stream.
+        assert not client.receive("list", sink=io.BytesIO()).value
+
+    t1.join()
+
+    assert [result.value for result in server_results] == [True, True, True, False]
+    assert server_results[-1].reason.startswith("Invalid token")
+
+
+def test_store():
+    store = ContentStore("tests/store")
+
+    server = QSFTServer(address=(DEFAULT_IP, 8896), keep_alive=True)
+    server.config(SFTRoles.RECEIVER, directory="./tests", store=store)
+
+    server_results = []
+
+    def run_keep_alive_server():
+        server_results.append(server.receive())
+        server_results.append(server.receive())
+        server.close()
+
+    t1 = threading.Thread(target=run_keep_alive_server, name="SERVER")
+    t1.start()
+
+    time.sleep(1)
+
+    with QSFTClient(address=(DEFAULT_IP, 8896), keep_alive=True) as client:
+        assert client.send("tests/file.500MB").value
+
+        # The server waits for the result of the first transfer.
+        while not server_results:
+            time.sleep(0.1)
+
+        assert client.send("tests/file.500MB").value
+
+    t1.join()
+
+    assert all(result.value for result in server_results)
+    assert not server_results[0].has("deduplicated")
+
+    # The second file is taken from the store, nothing is required.
+    assert server_results[1].deduplicated and server_results[1].metrics["chunks"] == 0
+    assert store.size() == os.path.getsize("tests/file.500MB")
+
+    with open(server_results[1].path, "rb") as stream, open("tests/file.500MB", "rb") as expected_stream:
+        assert stream.read() == expected_stream.read()
+
+    shutil.rmtree("tests/store")
+
+
+def test_chunk_tree():
+    server = QSFTServer(address=(DEFAULT_IP, 8897))
+    server.config(SFTRoles.RECEIVER, directory="./tests", chunk_tree=True, buffer_size=2 ** 15)
+
+    server_results = []
+    t1 = threading.Thread(target=lambda: server_results.append(server.receive()), name="SERVER")
+    t1.start()
+
+    time.sleep(1)
+
+    client = QSFTClient(address=(DEFAULT_IP, 8897))
+    client.config(SFTRoles.SENDER, tree_block_size=2 ** 14)
+    assert client.send("tests/file.500MB").value
+
+    t1.join()
+
+    result = server_results[0]
+    assert result.value
+
+    with open(result.path, "rb") as stream, open("tests/file.500MB", "rb") as expected_stream:
+        assert stream.read() == expected_stream.read()
+
+    os.remove(result.path)
+
+
+def test_hashes():
+    server = QSFTServer(address=(DEFAULT_IP, 8898))
+    server.config(SFTRoles.RECEIVER, directory="./tests", hashes=["blake2b"], chunk_tree=True)
+
+    server_results = []
+    t1 = threading.Thread(target=lambda: server_results.append(server.receive()), name="SERVER")
+    t1.start()
+
+    time.sleep(1)
+
+    client = QSFTClient(address=(DEFAULT_IP, 8898))
+    client.config(SFTRoles.SENDER, hashes=["blake2s", "blake2b"], tree_block_size=2 ** 14)
+    assert client.send("tests/file.500MB").value
+
+    t1.join()
+
+    # The first algorithm of the sender which the receiver accepts.
+    result = server_results[0]
+    assert result.value and result.hash == HASH_BLAKE2B
+
+    with open(result.path, "rb") as stream, open("tests/file.500MB", "rb") as expected_stream:
+        assert stream.read() == expected_stream.read()
+
+    os.remove(result.path)
+
+
+def test_rate_limit():
+    # 300KB at 400KB/s, the first 100KB go at once.
+    limiter = RateLimiter(rate=400000, burst_time=0.25)
+
+    server = QSFTServer(address=(DEFAULT_IP, 8899))
+    server.config(SFTRoles.RECEIVER, directory="./tests", buffer_size=2 ** 15, rate_limiter=limiter)
+
+    server_results = []
+    t1 = threading.Thread(target=lambda: server_results.append(server.receive()), name="SERVER")
+    t1.start()
+
+    time.sleep(1)
+
+    client = QSFTClient(address=(DEFAULT_IP, 8899))
+    assert client.send("tests/file.500MB").value
+
+    t1.join()
+
+    result = server_results[0]
+    assert result.value
+    assert result.metrics["seconds"] >= 0.4 and result.metrics["phases"]["throttle"] > 0
+
+    # The throttle of the transfer is closed.
+    assert not limiter.shares()
+
+    os.remove(result.path)
+
+
 if __name__ == "__main__":
     test_qsft()
+    test_qsft_parallel()
+    test_qsft_keep_alive()
+    test_service()
+    test_pool(pathlib.Path(tempfile.mkdtemp()))
+    test_service_scheduler()
+    test_async()
+    test_async_scheduler()
+    test_metrics()
+    test_sink()
+    test_stream()
+    test_detoken_values()
+    test_store()
+    test_chunk_tree()
+    test_hashes()
+    test_rate_limit()
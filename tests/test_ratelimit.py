@@ -0,0 +1,29 @@
+from sft.ratelimit import RateLimiter, TokenBucket, MIN_THROTTLED_CHUNK_SIZE
+
+
+def test_rate_limiter():
+    bucket = TokenBucket(1000, 100)
+    assert bucket.reserve(100) == 0
+
+    # The bytes beyond the bucket are a debt paid at the rate.
+    assert abs(bucket.reserve(500) - 0.5) < 0.05
+
+    limiter = RateLimiter(rate=3000, peer_rate=1000, session_rate=1500)
+
+    small = limiter.open("host", weight=1)
+    large = limiter.open("other host", weight=2)
+
+    # The global rate is shared by weight, a share is capped by the rate of
+    # a session.
+    shares = limiter.shares()
+    assert shares[small] == 1000 and shares[large] == 1500
+
+    large.close()
+    assert limiter.shares() == {small: 1500}
+    assert limiter.get_peer_bucket("other host") is None
+
+    # A chunk waits at most a second, down to a minimal size.
+    assert small.chunk_size() == MIN_THROTTLED_CHUNK_SIZE
+
+    small.close()
+    assert limiter.shares() == {}
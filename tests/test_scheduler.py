@@ -0,0 +1,65 @@
+import time
+import threading
+
+from sft.scheduler import TransferScheduler, PRIORITY_URGENT, PRIORITY_BULK
+
+
+def test_scheduler():
+    scheduler = TransferScheduler(max_transfers=1, deadline=5, aging_time=None)
+
+    slot = scheduler.admit()
+    admitted = []
+
+    def run_transfer(priority):
+        transfer_slot = scheduler.admit(priority)
+        admitted.append(priority)
+        transfer_slot.release()
+
+    # The bulk transfer comes first but the urgent one goes first.
+    threads = [threading.Thread(target=run_transfer, args=(priority,))
+        for priority in (PRIORITY_BULK, PRIORITY_URGENT)]
+
+    for thread in threads:
+        thread.start()
+        time.sleep(0.1)
+
+    assert scheduler.waiting_transfers() == 2
+
+    slot.release()
+    for thread in threads:
+        thread.join()
+
+    assert admitted == [PRIORITY_URGENT, PRIORITY_BULK]
+    assert scheduler.active_transfers() == 0
+
+    # A transfer which is not admitted in time is denied.
+    slot = scheduler.admit()
+    assert scheduler.admit(deadline=0.2) is None
+    slot.release()
+
+
+def test_scheduler_aging():
+    # A bulk transfer waiting long enough goes before a new urgent one.
+    scheduler = TransferScheduler(max_transfers=1, deadline=5, aging_time=0.1)
+
+    slot = scheduler.admit()
+    admitted = []
+
+    def run_transfer(priority):
+        transfer_slot = scheduler.admit(priority)
+        admitted.append(priority)
+        transfer_slot.release()
+
+    bulk_thread = threading.Thread(target=run_transfer, args=(PRIORITY_BULK,))
+    bulk_thread.start()
+    time.sleep(0.5)
+
+    urgent_thread = threading.Thread(target=run_transfer, args=(PRIORITY_URGENT,))
+    urgent_thread.start()
+    time.sleep(0.1)
+
+    slot.release()
+    bulk_thread.join()
+    urgent_thread.join()
+
+    assert admitted == [PRIORITY_BULK, PRIORITY_URGENT]
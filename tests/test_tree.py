@@ -0,0 +1,38 @@
+import os
+
+from hks_pylib.cryptography.hashes import SHA256
+
+from sft.tree import ChunkTree, BlockVerifier
+
+
+def test_tree():
+    path = "tests/tree.bin"
+    data = os.urandom(10000)
+    with open(path, "wb") as stream:
+        stream.write(data)
+
+    hash_obj = SHA256()
+    tree = ChunkTree.from_file(path, 1024, hash_obj)
+    os.remove(path)
+
+    expected_hash_obj = SHA256()
+    expected_hash_obj.update(data)
+    assert hash_obj.finalize() == expected_hash_obj.finalize()
+    assert len(tree) == 10
+
+    # The receiver rebuilds the tree from the HASHES packet.
+    block_size, root = ChunkTree.parse_option(tree.to_option())
+    tree = ChunkTree.from_bytes(tree.to_bytes(), block_size, len(data), root)
+
+    verifier = BlockVerifier(tree)
+
+    # A block which comes in several chunks is checked once it is complete.
+    assert verifier.verify(0, data[0: 512]) == ([], [])
+    assert verifier.verify(512, data[512: 2048]) == ([(0, data[0: 1024]), (1024, data[1024: 2048])], [])
+
+    # Only the corrupted block is required again.
+    corrupted = data[2048: 3072] + b"x" + data[3073: 4096]
+    assert verifier.verify(2048, corrupted) == ([(2048, data[2048: 3072])], [(3072, 1024)])
+
+    # The last block is shorter.
+    assert verifier.verify(9216, data[9216:]) == ([(9216, data[9216:])], [])